@@ -305,22 +305,40 @@ def in_flight(script):
         return execute_script(script)
 
 
-@removed
-def wait_for_ajax():
-    """
-    Waits until all ajax timers are complete, in other words, waits until there are no
-    more pending ajax requests, page load should be finished completely.
+def wait_for_quiet_page(driver, timeout):
+    """Wait in the browser until no ajax is in flight, in a single WebDriver call
 
-    Raises:
-        TimedOutError: when ajax did not load in time
+    The waiting is done by the :py:data:`cfme.js.wait_for_quiet` async script, so it doesn't
+    matter how many times the page has to be checked.
+
+    Args:
+        driver: The selenium WebDriver
+        timeout: How long to wait for the page to become quiet, in seconds
+
+    Returns:
+        Dictionary with ``quiet``, whether nothing was in flight in the end, ``statuses``,
+        the list of the distinct states of what was in flight, and ``error`` if the page
+        couldn't be checked.
     """
+    # the script finishes on its own timeout, webdriver's only has to let it
+    script_timeout = timeout + 5
+    if getattr(driver, '_cfme_script_timeout', None) != script_timeout:
+        driver.set_script_timeout(script_timeout)
+        driver._cfme_script_timeout = script_timeout
+    return driver.execute_async_script(js.wait_for_quiet, int(timeout * 1000))
+
 
-    execute_script("""
-        try {
-            angular.element('error-modal').hide();
-        } catch(err) {
-        }""")
+def _log_ajax_statuses(statuses, quiet):
+    """Log the states of what was in flight the way polling for them used to"""
+    for running in statuses:
+        log_msg = ', '.join(["{}: {}".format(k, str(v)) for k, v in running.iteritems()])
+        logger.trace('Ajax running: %s', log_msg)
+    if quiet and len(statuses) > 1:
+        logger.trace('Ajax done')
 
+
+def _poll_for_ajax():
+    """Polls the page until there is no ajax in flight"""
     _thread_local.ajax_log_msg = ''
 
     def _nothing_in_flight():
@@ -374,6 +392,37 @@ def wait_for_ajax():
         num_sec=_thread_local.ajax_timeout, delay=0.1, message="wait for ajax", quiet=True,
         silent_failure=True)
 
+
+@removed
+def wait_for_ajax():
+    """
+    Waits until all ajax timers are complete, in other words, waits until there are no
+    more pending ajax requests, page load should be finished completely.
+
+    The page is watched by :py:func:`wait_for_quiet_page`. Pages that can't be watched that way
+    (e.g. when the page is reloaded while waiting) are polled instead.
+
+    Raises:
+        TimedOutError: when ajax did not load in time
+    """
+    try:
+        result = wait_for_quiet_page(browser(), _thread_local.ajax_timeout)
+    except UnexpectedAlertPresentException:
+        raise
+    except WebDriverException as e:
+        logger.debug('Could not wait for a quiet page (%s), polling for ajax', e)
+        _poll_for_ajax()
+    else:
+        error = result.get('error')
+        if error and "jquery" not in error.lower():
+            # let polling raise it, if it still happens
+            logger.debug('Could not check the page for ajax (%s), polling for ajax', error)
+            _poll_for_ajax()
+        else:
+            # if jQuery is in the error, a non-cfme page (proxy error) is displayed
+            # should be handled by something else
+            _log_ajax_statuses(result.get('statuses', []), result.get('quiet'))
+
     # If we are not supposed to take page screenshots...well...then...dont.
     if store.config and not store.config.getvalue('page_screenshots'):
         return
@@ -253,6 +253,8 @@ class InfraProvider(Pretty, CloudInfraProvider):
 @navigator.register(InfraProvider, 'All')
 class All(CFMENavigateStep):
     VIEW = ProvidersView
+    # ems_infra/show_list
+    URL_JUMP = True
     prerequisite = NavigateToObject(Server, 'LoggedIn')
 
     def step(self):
@@ -290,6 +292,8 @@ class Discover(CFMENavigateStep):
 @navigator.register(InfraProvider, 'Details')
 class Details(CFMENavigateStep):
     VIEW = ProviderDetailsView
+    # ems_infra/<id>
+    URL_JUMP = True
     prerequisite = NavigateToSibling('All')
 
     def step(self):
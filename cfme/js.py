@@ -26,6 +26,140 @@ return {
 };
 """)
 
+# Async script, resolves once nothing is in flight or when the timeout (ms) passes. The page is
+# checked on every DOM mutation, finished XHR and every 100ms (for timers, which don't show up
+# as either), all inside the browser. Resolves with {quiet, statuses, error}, where statuses are
+# the distinct states of what was in flight, in order.
+wait_for_quiet = jsmin("""
+var timeout = arguments[0];
+var done = arguments[arguments.length - 1];
+function isHidden(el) {if(el === null) return true; return el.offsetParent === null;}
+
+try {
+    angular.element('error-modal').hide();
+} catch(err) {
+}
+
+function state() {
+    if(typeof ManageIQ !== "undefined" && ManageIQ.qe && ManageIQ.qe.anythingInFlight) {
+        return {busy: ManageIQ.qe.anythingInFlight(), running: ManageIQ.qe.inFlight()};
+    }
+    var running = {
+        jquery: jQuery.active,
+        prototype: (typeof Ajax === "undefined") ? 0 : Ajax.activeRequestCount,
+        miq: window.miqAjaxTimers,
+        spinner: (!isHidden(document.getElementById("spinner_div")))
+            && isHidden(document.getElementById("lightbox_div")),
+        document: document.readyState,
+        autofocus: (typeof checkMiqQE === "undefined") ? 0 : checkMiqQE('autofocus'),
+        debounce: (typeof checkMiqQE === "undefined") ? 0 : checkMiqQE('debounce'),
+        miqQE: (typeof checkAllMiqQE === "undefined") ? 0 : checkAllMiqQE()
+    };
+    return {
+        busy: running.jquery > 0 || running.prototype > 0 || running.spinner ||
+            running.document != "complete" || running.autofocus > 0 || running.debounce > 0 ||
+            running.miqQE > 0,
+        running: running
+    };
+}
+
+var statuses = [], last = null, finished = false, observer = null, interval = null, timer = null;
+
+function finish(result) {
+    if(finished) return;
+    finished = true;
+    if(observer !== null) observer.disconnect();
+    clearInterval(interval);
+    clearTimeout(timer);
+    window.cfmeQuietCheck = null;
+    result.statuses = statuses;
+    done(result);
+}
+
+function check() {
+    if(finished) return;
+    var current;
+    try {
+        current = state();
+    } catch(err) {
+        finish({quiet: false, error: String(err)});
+        return;
+    }
+    var serialized = JSON.stringify(current.running);
+    if(serialized !== last) {
+        last = serialized;
+        statuses.push(current.running);
+    }
+    if(!current.busy) finish({quiet: true});
+}
+
+check();
+if(!finished) {
+    if(typeof MutationObserver !== "undefined") {
+        observer = new MutationObserver(check);
+        observer.observe(document, {childList: true, subtree: true, attributes: true});
+    }
+    if(!XMLHttpRequest.prototype.cfmeQuietHooked) {
+        var send = XMLHttpRequest.prototype.send;
+        XMLHttpRequest.prototype.send = function() {
+            this.addEventListener("loadend", function() {
+                // let the request's own callbacks run first
+                setTimeout(function() { if(window.cfmeQuietCheck) window.cfmeQuietCheck(); }, 0);
+            });
+            return send.apply(this, arguments);
+        };
+        XMLHttpRequest.prototype.cfmeQuietHooked = true;
+    }
+    window.cfmeQuietCheck = check;
+    interval = setInterval(check, 100);
+    timer = setTimeout(function() { finish({quiet: false}); }, timeout);
+}
+""")
+
+# Reads a whole table in one go. Takes the header row element, the body element and a list of
+# attribute names to read from every cell. Only displayed cells and rows are read, the same way
+# pytest_selenium.elements filters them, and their positions among all of their siblings are
+# returned so they can be located again.
+table_snapshot = jsmin("""
+var headerRow = arguments[0], body = arguments[1], attributes = arguments[2];
+function isDisplayed(el) {
+    return el.offsetParent !== null && window.getComputedStyle(el).visibility !== "hidden";
+}
+function text(el) {
+    return (typeof el.innerText === "undefined") ? el.textContent : el.innerText;
+}
+function children(el, tags) {
+    var result = [];
+    for(var i = 0; i < el.children.length; i++) {
+        if(tags.indexOf(el.children[i].tagName.toLowerCase()) >= 0) {
+            result.push(el.children[i]);
+        }
+    }
+    return result;
+}
+var headers = [];
+if(headerRow !== null) {
+    children(headerRow, ["td", "th"]).forEach(function(cell) {
+        if(isDisplayed(cell)) headers.push(text(cell));
+    });
+}
+var rows = [];
+children(body, ["tr"]).forEach(function(row, rowPosition) {
+    if(!isDisplayed(row)) return;
+    var cells = [];
+    children(row, ["td"]).forEach(function(cell, cellPosition) {
+        if(!isDisplayed(cell)) return;
+        var cellAttributes = {};
+        attributes.forEach(function(name) {
+            cellAttributes[name] = cell.getAttribute(name);
+        });
+        cells.push({position: cellPosition + 1, text: text(cell), attributes: cellAttributes});
+    });
+    rows.push({position: rowPosition + 1, cells: cells});
+});
+return {headers: headers, rows: rows};
+""")
+
 update_retirement_date_function_script = """\
 function updateDate(newValue) {
     if(typeof $j == "undefined") {
@@ -316,6 +316,11 @@ class Table(Pretty):
         * :py:meth:`click_rows_by_cells`
         * :py:meth:`click_row_by_cells`
 
+    Rows are read in bulk by default: :py:meth:`snapshot` reads the texts of all the cells
+    with a single script call, and the rows and cells are only located in the page when they
+    are needed for anything else, like clicking. The texts don't change with the page, read the
+    rows again to see changes. Set ``bulk`` to ``False`` to read live rows element by element.
+
     Note:
 
         A table is defined by the containers of the header and data areas, and offsets to them.
@@ -325,6 +330,8 @@ class Table(Pretty):
     """
 
     pretty_attrs = ['_loc']
+    #: Whether rows are read by :py:meth:`snapshot`
+    bulk = True
 
     def __init__(self, table_locator, header_offset=0, body_offset=0, hidden_locator=None):
         self._headers = None
@@ -395,15 +402,42 @@ class Table(Pretty):
     def _root_loc(self):
         return self.locate()
 
+    def snapshot(self, attributes=()):
+        """Reads all the displayed rows of the table in a single browser call
+
+        Args:
+            attributes: Names of the attributes to read from every cell, along with the texts
+
+        Returns: A list of :py:class:`Table.RowSnapshot` objects, starting at the first data row.
+        """
+        try:
+            header_row = self.header_row
+        except NoSuchElementException:
+            # headers are then only looked up when a cell is accessed by name
+            header_row = None
+        data = sel.execute_script(js.table_snapshot, header_row, self.body, list(attributes))
+        header_indexes = {
+            attributize_string(text.strip()): index
+            for index, text in enumerate(data['headers'])}
+        rows = [
+            Table.RowSnapshot(row['position'], row['cells'], header_indexes, self)
+            for row in data['rows']]
+        return rows[self.body_offset:]
+
     def rows(self):
         """A generator method holding the Row objects
 
         This generator yields Row objects starting at the first data row.
 
         Yields:
-            :py:class:`Table.Row` object corresponding to the next row in the table.
+            :py:class:`Table.Row` object corresponding to the next row in the table,
+            :py:class:`Table.RowSnapshot` objects when reading rows in ``bulk``.
         """
         try:
+            if self.bulk:
+                for row in self.snapshot():
+                    yield row
+                return
             index = self.body_offset
             row_elements = sel.elements('./tr', root=self.body)
             for row_element in row_elements[index:]:
@@ -480,9 +514,13 @@ class Table(Pretty):
         Returns: A list of containing :py:class:`Table.Row` objects whose contents
             match all of the header: value pairs in ``cells``
 
+        When reading rows in ``bulk``, the rows are matched in python, on a :py:meth:`snapshot`.
+
         """
         # accept dicts or supertuples
         cells = dict(cells)
+        if self.bulk:
+            return self._find_rows_by_cells_in_snapshot(cells, partial_check)
         cell_text_loc = (
             './/td/descendant-or-self::*[contains(normalize-space(text()), "{}")]/ancestor::tr[1]')
         matching_rows_list = list()
@@ -525,6 +563,40 @@ class Table(Pretty):
 
         return matching_rows
 
+    def _find_rows_by_cells_in_snapshot(self, cells, partial_check=False):
+        """:py:meth:`find_rows_by_cells` on a :py:meth:`snapshot`"""
+        rows = self.snapshot()
+        if not rows:
+            return []
+        header_indexes = rows[0].header_indexes or self.header_indexes
+        indexes = {}
+        for heading in cells:
+            if isinstance(heading, basestring):
+                if attributize_string(heading) not in header_indexes:
+                    # Suspected shared table use
+                    self.verify_headers()
+                    return []
+                indexes[heading] = header_indexes[attributize_string(heading)]
+            else:
+                indexes[heading] = heading
+
+        def matching_row_filter(row, heading, value):
+            try:
+                text = normalize_space(row.columns[indexes[heading]].text)
+            except IndexError:
+                # rows like group summaries may have fewer cells
+                return False
+            if isinstance(value, re._pattern_type):
+                return value.match(text) is not None
+            elif partial_check:
+                return value in text
+            else:
+                return text == value
+
+        return [
+            row for row in rows
+            if all(matching_row_filter(row, *cell) for cell in cells.items())]
+
     def find_row_by_cells(self, cells, partial_check=False):
         """Find the first row containing cells
 
@@ -711,6 +783,84 @@ class Table(Pretty):
             # table.create_row_from_element(row_instance) might actually work...
             return sel.move_to_element(self.row_element)
 
+    class CellSnapshot(Pretty):
+        """The text and attributes of a cell, as read by :py:meth:`Table.snapshot`
+
+        Anything else is passed to the cell's ``<td>`` WebElement, which is located on demand.
+
+        Args:
+            row: The :py:class:`Table.RowSnapshot` of the cell
+            position: Position of the ``<td>`` among the row's ``<td>`` elements, 1-indexed
+            text: Text of the cell
+            attributes: Dict of the attributes read from the cell
+        """
+        pretty_attrs = ['text']
+
+        def __init__(self, row, position, text, attributes):
+            self.row = row
+            self.position = position
+            self.text = text.strip()
+            self.attributes = attributes
+
+        def get_attribute(self, name):
+            try:
+                return self.attributes[name]
+            except KeyError:
+                return self.locate().get_attribute(name)
+
+        def locate(self):
+            return sel.element('./td[{}]'.format(self.position), root=self.row.row_element)
+
+        def __getattr__(self, name):
+            if name.startswith('_'):
+                # private and special names, e.g. _custom_click_handler, aren't the element's
+                raise AttributeError(name)
+            return getattr(self.locate(), name)
+
+    class RowSnapshot(Row):
+        """A :py:class:`Table.Row` as read by :py:meth:`Table.snapshot`
+
+        The columns are :py:class:`Table.CellSnapshot` objects, and the row element is only
+        located when it is needed.
+
+        Args:
+            position: Position of the ``<tr>`` among the body's ``<tr>`` elements, 1-indexed
+            cells: List of the ``position``, ``text`` and ``attributes`` dicts of the cells
+            header_indexes: Header name: column index dict of the snapshot
+            parent_table: :py:class:`Table` containing the row
+        """
+        pretty_attrs = ['position', 'table']
+
+        def __init__(self, position, cells, header_indexes, parent_table):
+            self.table = parent_table
+            self.position = position
+            self.header_indexes = header_indexes
+            self._columns = [Table.CellSnapshot(self, **cell) for cell in cells]
+
+        @property
+        def columns(self):
+            """A list of :py:class:`Table.CellSnapshot` for the ``<td>`` elements in this row"""
+            return self._columns
+
+        @cached_property
+        def row_element(self):
+            return sel.element('./tr[{}]'.format(self.position), root=self.table.body)
+
+        def __getattr__(self, name):
+            """
+            Returns Row cell by header name
+            """
+            if name.startswith('__'):
+                raise AttributeError(name)
+            header_indexes = self.header_indexes or self.table.header_indexes
+            try:
+                return self.columns[header_indexes[attributize_string(name)]]
+            except (KeyError, IndexError):
+                # Suspected shared table use
+                self.table.verify_headers()
+                # If it did not fail at that time, reraise
+                raise
+
 
 class CAndUGroupTable(Table):
     """Type of tables used in C&U, not tested in others.
@@ -755,6 +905,12 @@ class CAndUGroupTable(Table):
             raise KeyError('Group {} not found'.format(group_id))
 
     def groups(self):
+        if self.bulk:
+            # snapshot texts are already read
+            def cell_text(cell):
+                return cell.text
+        else:
+            cell_text = sel.text
         headers = map(sel.text, self.headers)
         headers_length = len(headers)
         rows = self.paginated_rows()
@@ -772,15 +928,15 @@ class CAndUGroupTable(Table):
                     break
             if state == self.States.NORMAL_ROWS:
                 if len(row.columns) == headers_length:
-                    current_group_rows.append(tuple(map(sel.text, row.columns)))
+                    current_group_rows.append(tuple(map(cell_text, row.columns)))
                 else:
                     # Transition to the group summary
-                    current_group_id = sel.text(row.columns[0]).strip()
+                    current_group_id = cell_text(row.columns[0]).strip()
                     state = self.States.GROUP_SUMMARY
             elif state == self.States.GROUP_SUMMARY:
                 # row is None == we are at the end of the table so a slightly different behaviour
                 if row is not None:
-                    fc_length = len(sel.text(row.columns[0]).strip())
+                    fc_length = len(cell_text(row.columns[0]).strip())
                 if row is None or fc_length == 0:
                     # Done with group
                     yield self.Group(
@@ -790,7 +946,7 @@ class CAndUGroupTable(Table):
                     current_group_id = None
                     state = self.States.NORMAL_ROWS
                 else:
-                    current_group_summary_rows.append(tuple(map(sel.text, row.columns)))
+                    current_group_summary_rows.append(tuple(map(cell_text, row.columns)))
             else:
                 raise RuntimeError('This should never happen')
 
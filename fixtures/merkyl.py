@@ -1,6 +1,11 @@
+from collections import deque
+from urlparse import urlparse
+
 import pytest
 
 from fixtures.artifactor_plugin import appliance_ip_address, art_client, get_test_idents
+from utils import conf
+from utils.ssh import TAIL_BUFFER_SIZE, SSHClient, tail_service
 
 
 class MerkylInspector(object):
@@ -16,6 +21,10 @@ class MerkylInspector(object):
         self.test_name = name
         self.test_location = location
         self.ip = appliance_ip_address
+        self._ssh_client = None
+        self._tails = {}
+        self._seen_lines = {}
+        request.addfinalizer(self.close_tails)
 
     def get_log(self, log_name):
         """ A simple getter for log files.
@@ -62,12 +71,52 @@ class MerkylInspector(object):
         trawl the previous contents of the file, but only looks at the log
         information which has been gathered since merkyl was tracking the file.
         """
+        if log_name in self._tails:
+            return any(needle in line for line in self.tail_lines(log_name))
         contents = self.get_log(log_name)
         if needle in contents:
             return True
         else:
             return False
 
+    def tail_log(self, log_name):
+        """ Follows a log file through the appliance's SSH tail service.
+
+        Unlike :py:meth:`add_log`, this does not need merkyl deployed on the appliance. The
+        lines appended to the log from now on are kept in a bounded buffer until the end of the
+        test, :py:meth:`search_log` then searches them instead of asking merkyl.
+
+        Args:
+            log_name: Full path to the log file wishing to be followed.
+
+        Returns:
+            The :py:class:`utils.ssh.TailSubscription` of the log.
+        """
+        if log_name not in self._tails:
+            if self._ssh_client is None:
+                # the appliance merkyl inspects, not necessarily the current one
+                self._ssh_client = SSHClient(
+                    hostname=urlparse('//{}'.format(self.ip)).hostname,
+                    username=conf.credentials['ssh']['username'],
+                    password=conf.credentials['ssh']['password'])
+            self._tails[log_name] = tail_service(self._ssh_client).subscribe(log_name)
+            self._seen_lines[log_name] = deque(maxlen=TAIL_BUFFER_SIZE)
+        return self._tails[log_name]
+
+    def tail_lines(self, log_name):
+        """ Returns the lines appended to a log followed with :py:meth:`tail_log` so far.
+
+        Only the last ``TAIL_BUFFER_SIZE`` lines are kept.
+        """
+        self._seen_lines[log_name].extend(self._tails[log_name].get_lines())
+        return list(self._seen_lines[log_name])
+
+    def close_tails(self):
+        for subscription in self._tails.values():
+            subscription.close()
+        self._tails.clear()
+        self._seen_lines.clear()
+
 
 @pytest.fixture(scope='function')
 def merkyl_inspector(request):
@@ -12,18 +12,28 @@ The Workflow
 
 - Slaves are started
 - Master runs collection, blocks until slaves report their collections
-- Slaves each run collection and submit them to the master, then block inside their runtest loop,
-  waiting for tests to run
-- Master diffs slave collections against its own; the test ids are verified to match
-  across all nodes
+- Slaves each run collection, store it in the collection cache and submit its digest to the
+  master, then block inside their runtest loop, waiting for tests to run
+- Master compares slave collection digests against its own; when they differ, the slave collection
+  is loaded from the collection cache and diffed, the test ids must match across all nodes
+  (see :py:mod:`fixtures.parallelizer.collection`)
 - Master enters main runtest loop, uses a generator to build lists of test groups which are then
   sent to slaves, one group at a time
+
+  - With ``--parallel-scheduler duration``, the groups are ordered longest-expected-first, using
+    test durations recorded in previous runs (see :py:mod:`fixtures.parallelizer.history`)
+  - Which group a slave gets is decided by provider placement, which keeps slaves on the providers
+    their appliances already have and weighs the measured cost of moving them to other providers
+    (see :py:mod:`fixtures.parallelizer.placement`)
 - For each phase of each test, the slave serializes test reports, which are then unserialized on
   the master and handed to the normal pytest reporting hooks, which is able to deal with test
   reports arriving out of order
 - Before running the last test in a group, the slave will request more tests from the master
 
   - If more tests are received, they are run
+  - If the master has nothing left to send, and work stealing is enabled with
+    ``--parallel-steal-min``, it may take back the tail of another slave's unstarted tests and
+    send those instead, once that slave confirmed it dropped them from its queue
   - If no tests are received, the slave will shut down after running its final test
 
 - After all slaves are shut down, the master will do its end-of-session reporting as usual, and
@@ -34,7 +44,6 @@ from itertools import groupby
 
 
 import difflib
-import json
 import os
 import signal
 import subprocess
@@ -54,6 +63,11 @@ from _pytest import runner
 
 from fixtures import terminalreporter
 from fixtures.parallelizer import remote
+from fixtures.parallelizer.collection import CollectionCache
+from fixtures.parallelizer.history import DurationHistory, SwitchCostHistory
+from fixtures.parallelizer.placement import (
+    ProviderPlacement, provider_keys_from_id, provider_keys_from_item)
+from fixtures.parallelizer.transport import get_codec, recv_frames
 from fixtures.pytest_store import store
 from utils import at_exit, conf
 from utils.appliance import IPAppliance
@@ -74,6 +88,29 @@ def pytest_addhooks(pluginmanager):
     pluginmanager.add_hookspecs(hooks)
 
 
+def pytest_addoption(parser):
+    group = parser.getgroup('cfme')
+    group.addoption('--parallel-scheduler', dest='parallel_scheduler', default='modscope',
+        choices=['modscope', 'duration'],
+        help='how the parallelizer orders test groups: "modscope" sends them in collection order, '
+             '"duration" sends the longest groups first based on durations from previous runs')
+    group.addoption('--parallel-transport', dest='parallel_transport', default='json',
+        choices=['json', 'msgpack'],
+        help='encoding of the messages between the parallelizer master and slaves')
+    group.addoption('--parallel-batch', dest='parallel_batch', action='store_true', default=False,
+        help='let parallelizer slaves send test start and report events in one message per test')
+    group.addoption('--parallel-providers-per-appliance', dest='parallel_providers_per_appliance',
+        type=int, default=1,
+        help='how many providers a slave appliance may have set up at once before the '
+             'parallelizer cleanses it to move it to a different provider')
+    group.addoption('--parallel-steal-min', dest='parallel_steal_min', type=int, default=0,
+        help='minimum number of unstarted tests a slave must have queued before an idle slave '
+             'may take some of them over, 0 (the default) disables work stealing')
+    group.addoption('--parallel-steal-timeout', dest='parallel_steal_timeout', type=float,
+        default=60,
+        help='seconds an idle slave waits for the tests taken over for it before it finishes')
+
+
 @pytest.mark.trylast
 def pytest_configure(config):
     # configures the parallel session, then fires pytest_parallel_configured
@@ -108,6 +145,17 @@ class SlaveDetail(object):
     process = attr.ib(default=None, repr=False)
 
     provider_allocation = attr.ib(default=attr.Factory(list), repr=False)
+    #: providers allocated to the slave whose add cost hasn't been measured yet
+    pending_adds = attr.ib(default=attr.Factory(set), repr=False)
+
+    #: tests sent to the slave that it hasn't started yet, in the order they were sent
+    unstarted = attr.ib(default=attr.Factory(list), repr=False)
+    #: tests the master asked the slave to give back, and the id of the slave waiting for them
+    revoke = attr.ib(default=None, repr=False)
+    revoke_for = attr.ib(default=None, repr=False)
+    revoke_sent = attr.ib(default=False, repr=False)
+    #: when the revoke was requested
+    revoke_requested = attr.ib(default=None, repr=False)
 
     def start(self):
         devnull = open(os.devnull, 'w')
@@ -127,6 +175,9 @@ class SlaveDetail(object):
 
 
 class ParallelSession(object):
+    #: How long to block waiting for slave messages before auditing the slaves again, in ms
+    recv_timeout = 1000
+
     def __init__(self, config):
         self.config = config
         self.session = None
@@ -140,13 +191,27 @@ class ParallelSession(object):
         self.terminal = store.terminalreporter
         self.trdist = None
         self.slaves = {}
+        self.scheduler = config.getoption('parallel_scheduler')
+        self.steal_min = config.getoption('parallel_steal_min')
+        self.steal_timeout = config.getoption('parallel_steal_timeout')
+        self.codec = get_codec(config.getoption('parallel_transport'))
+        self._batched = False
+        self.durations = DurationHistory(config.cache)
         self.test_groups = self._test_item_generator()
 
         self._pool = []
+        # provider keys of each test group in the pool
+        self._pool_provs = []
         from utils.conf import cfme_data
         self.provs = sorted(set(cfme_data['management_systems'].keys()),
                             key=len, reverse=True)
-        self.used_prov = set()
+        # provider keys of each test in the master collection
+        self.test_providers = {}
+        self.switch_costs = SwitchCostHistory(config.cache)
+        self.placement = ProviderPlacement(
+            config.getoption('parallel_providers_per_appliance'),
+            self.switch_costs, self.durations.group_duration)
+        self.provider_switches = 0
 
         self.failed_slave_test_groups = deque()
         self.slave_spawn_count = 0
@@ -204,7 +269,13 @@ class ParallelSession(object):
                     self.sent_tests -= num_failed_tests
                     msg += ' and redistributing {} tests'.format(num_failed_tests)
                     self.failed_slave_test_groups.append(failed_tests)
+                slave.unstarted = []
                 self.print_message(msg, purple=True)
+                if slave.revoke is not None:
+                    # the slave waiting for the revoked tests can pick them up from the
+                    # redistributed tests instead
+                    self._cancel_revoke(slave)
+        self._expire_revokes()
 
         # If a slave has lost its base_url for any reason, kill that slave
         # Losing a base_url means the associated appliance died :(
@@ -224,26 +295,27 @@ class ParallelSession(object):
     def send(self, slave, event_data):
         """Send data to slave.
 
-        ``event_data`` will be serialized as JSON, and so must be JSON serializable
+        ``event_data`` will be serialized with the transport codec (JSON by default),
+        and so must be JSON serializable
 
         """
-        event_json = json.dumps(event_data)
-        self.sock.send_multipart([slave.id, '', event_json])
+        self.sock.send_multipart([slave.id, '', self.codec.dumps(event_data)])
 
     def recv(self):
-        # poll the zmq socket, populate the recv queue deque with responses
-
-        events = zmq.zmq_poll([(self.sock, zmq.POLLIN)], 50)
-        if not events:
-            return None, None, None
-        slaveid, _, event_json = self.sock.recv_multipart(flags=zmq.NOBLOCK)
-        event_data = json.loads(event_json)
-        event_name = event_data.pop('_event_name')
-        if slaveid not in self.slaves:
-            self.log.error("message from terminated worker %s %s %s",
-                           slaveid, event_name, event_data)
-            return None, None, None
-        return self.slaves[slaveid], event_data, event_name
+        """Wait for slave messages, then yield ``(slave, event_data, event_name)`` for each
+
+        Blocks for at most :py:attr:`recv_timeout` milliseconds, so the runtest loop still gets
+        to audit the slaves regularly when none of them have anything to say.
+
+        """
+        for slaveid, payload in recv_frames(self.sock, self.recv_timeout):
+            event_data = self.codec.loads(payload)
+            event_name = event_data.pop('_event_name')
+            if slaveid not in self.slaves:
+                self.log.error("message from terminated worker %s %s %s",
+                               slaveid, event_name, event_data)
+                continue
+            yield self.slaves[slaveid], event_data, event_name
 
     def print_message(self, message, prefix='master', **markup):
         """Print a message from a node to the py.test console
@@ -265,8 +337,20 @@ class ParallelSession(object):
             '({})[{}] '.format(prefix, stamp), message, **markup)
 
     def ack(self, slave, event_name):
-        """Acknowledge a slave's message"""
-        self.send(slave, 'ack {}'.format(event_name))
+        """Acknowledge a slave's message
+
+        If tests are to be taken back from the slave, the revoke request is sent
+        in place of the acknowledgement.
+
+        """
+        if self._batched:
+            # the batch as a whole gets acknowledged once all its events were handled
+            return
+        if slave.revoke is not None and not slave.revoke_sent:
+            slave.revoke_sent = True
+            self.send(slave, {'revoke': slave.revoke})
+        else:
+            self.send(slave, 'ack {}'.format(event_name))
 
     def monitor_shutdown(self, slave):
         # non-daemon so slaves get every opportunity to shut down cleanly
@@ -338,8 +422,12 @@ class ParallelSession(object):
             tests = list(self.failed_slave_test_groups.popleft())
         except IndexError:
             tests = self.get(slave)
+        if not tests and self.steal_tests(slave):
+            # the slave gets its reply when the donor slave gives the tests back
+            return []
         self.send(slave, tests)
         slave.tests.update(tests)
+        slave.unstarted.extend(tests)
         collect_len = len(self.collection)
         tests_len = len(tests)
         self.sent_tests += tests_len
@@ -350,6 +438,92 @@ class ParallelSession(object):
             ))
         return tests
 
+    def steal_tests(self, slave):
+        """Ask the busiest compatible slave to give some of its unstarted tests to ``slave``
+
+        The tail half of the donor's unstarted tests is revoked. The request goes out with the
+        next acknowledgement sent to the donor, and ``slave`` is sent the tests the donor actually
+        dropped from its queue once it reports back with a ``revoked`` event.
+
+        Returns:
+            ``True`` if a revoke was requested, ``False`` if there was nothing to steal
+
+        """
+        if not self.steal_min:
+            return False
+        candidates = []
+        for donor in self.slaves.values():
+            if donor is slave or donor.revoke is not None or donor.url is None:
+                continue
+            # the first unstarted test might already be lined up as the donor's next item
+            stealable = donor.unstarted[1:]
+            if len(stealable) < self.steal_min:
+                continue
+            tests = stealable[len(stealable) // 2:]
+            if not self._provs_compatible(slave, self._provs_of_tests(tests)):
+                continue
+            candidates.append((self.durations.group_duration(tests), len(tests), donor, tests))
+        if not candidates:
+            return False
+        _, _, donor, tests = max(candidates, key=lambda candidate: candidate[:2])
+        donor.revoke = tests
+        donor.revoke_for = slave.id
+        donor.revoke_sent = False
+        donor.revoke_requested = time()
+        self.print_message('taking back {} tests from {} for {}'.format(
+            len(tests), donor.id, slave.id))
+        return True
+
+    def tests_revoked(self, donor, node_ids):
+        """Hand the tests given back by ``donor`` to the slave that was waiting for them"""
+        waiting = self.slaves.get(donor.revoke_for)
+        donor.revoke = donor.revoke_for = None
+        donor.revoke_sent = False
+        donor.tests.difference_update(node_ids)
+        revoked = set(node_ids)
+        donor.unstarted = [nodeid for nodeid in donor.unstarted if nodeid not in revoked]
+        if waiting is None or waiting.url is None:
+            if node_ids:
+                self.failed_slave_test_groups.append(node_ids)
+            return
+        for prov in self._provs_of_tests(node_ids):
+            if prov not in waiting.provider_allocation:
+                waiting.provider_allocation.append(prov)
+                waiting.pending_adds.add(prov)
+        # already counted in sent_tests when they were sent to the donor
+        self.send(waiting, node_ids)
+        waiting.tests.update(node_ids)
+        waiting.unstarted.extend(node_ids)
+        if node_ids:
+            self.print_message('sent {} tests taken back from {} to {}'.format(
+                len(node_ids), donor.id, waiting.id))
+
+    def _expire_revokes(self):
+        """Let slaves that waited too long for the tests taken back for them finish instead
+
+        The donor only gets to give the tests back after its current test, which may take long.
+        A revoke that wasn't sent yet is dropped, the tests given back for a revoke that was sent
+        are redistributed when they arrive.
+        """
+        for donor in self.slaves.values():
+            if donor.revoke_for is None or time() - donor.revoke_requested < self.steal_timeout:
+                continue
+            waiting = self.slaves.get(donor.revoke_for)
+            donor.revoke_for = None
+            if not donor.revoke_sent:
+                donor.revoke = None
+            if waiting is not None and waiting.url is not None:
+                self.print_message('{} waited too long for tests from {}, finishing it'.format(
+                    waiting.id, donor.id))
+                self.send(waiting, [])
+
+    def _cancel_revoke(self, donor):
+        waiting = self.slaves.get(donor.revoke_for)
+        donor.revoke = donor.revoke_for = None
+        donor.revoke_sent = False
+        if waiting is not None and waiting.url is not None:
+            self.send_tests(waiting)
+
     def pytest_sessionstart(self, session):
         """pytest sessionstart hook
 
@@ -380,6 +554,10 @@ class ParallelSession(object):
         """
         # Build master collection for slave diffing and distribution
         self.collection = [item.nodeid for item in self.session.items]
+        self.test_providers = {
+            item.nodeid: provider_keys_from_item(item, self.provs) for item in self.session.items}
+        self.collection_cache = CollectionCache(self.config.cache)
+        self.collection_digest = self.collection_cache.store(self.collection)
 
         # Fire up the workers after master collection is complete
         # master and the first slave share an appliance, this is a workaround to prevent a slave
@@ -406,52 +584,8 @@ class ParallelSession(object):
                 if self.session_finished:
                     break
 
-                slave, event_data, event_name = self.recv()
-                if event_name == 'message':
-                    message = event_data.pop('message')
-                    markup = event_data.pop('markup')
-                    # messages are special, handle them immediately
-                    self.print_message(message, slave, **markup)
-                    self.ack(slave, event_name)
-                elif event_name == 'collectionfinish':
-                    slave_collection = event_data['node_ids']
-                    # compare slave collection to the master, all test ids must be the same
-                    self.log.debug('diffing {} collection'.format(slave.id))
-                    diff_err = report_collection_diff(
-                        slave.id, self.collection, slave_collection)
-                    if diff_err:
-                        self.print_message(
-                            'collection differs, respawning', slave.id,
-                            purple=True)
-                        self.print_message(diff_err, purple=True)
-                        self.log.error('{}'.format(diff_err))
-                        self.kill(slave)
-                        slave.start()
-                    else:
-                        self.ack(slave, event_name)
-                elif event_name == 'need_tests':
-                    self.send_tests(slave)
-                    self.log.info('starting master test distribution')
-                elif event_name == 'runtest_logstart':
-                    self.ack(slave, event_name)
-                    self.trdist.runtest_logstart(
-                        slave.id,
-                        event_data['nodeid'],
-                        event_data['location'])
-                elif event_name == 'runtest_logreport':
-                    self.ack(slave, event_name)
-                    report = unserialize_report(event_data['report'])
-                    if report.when in ('call', 'teardown'):
-                        slave.tests.discard(report.nodeid)
-                    self.trdist.runtest_logreport(slave.id, report)
-                elif event_name == 'internalerror':
-                    self.ack(slave, event_name)
-                    self.print_message(event_data['message'], slave, purple=True)
-                    self.kill(slave)
-                elif event_name == 'shutdown':
-                    self.ack(slave, event_name)
-                    del self.slaves[slave.id]
-                    self.monitor_shutdown(slave)
+                for slave, event_data, event_name in self.recv():
+                    self.handle_event(slave, event_name, event_data)
 
                 # total slave spawn count * 3, to allow for each slave's initial spawn
                 # and then each slave (on average) can fail two times
@@ -467,12 +601,115 @@ class ParallelSession(object):
             raise
         finally:
             terminalreporter.enable()
+            self.durations.save()
+            self.switch_costs.save()
 
         # Suppress other runtestloop calls
         return True
 
+    def handle_event(self, slave, event_name, event_data):
+        """Act on one event received from a slave, and answer it"""
+        if event_name == 'batch':
+            # events in a batch only need to be acknowledged, which is done once for the batch
+            self._batched = True
+            try:
+                for event in event_data['events']:
+                    self.handle_event(slave, event.pop('_event_name'), event)
+            finally:
+                self._batched = False
+            self.ack(slave, event_name)
+        elif event_name == 'message':
+            message = event_data.pop('message')
+            markup = event_data.pop('markup')
+            # messages are special, handle them immediately
+            self.print_message(message, slave, **markup)
+            self.ack(slave, event_name)
+        elif event_name == 'collectionfinish':
+            # compare slave collection to the master, all test ids must be the same
+            if event_data['digest'] == self.collection_digest:
+                diff_err = None
+            else:
+                slave_collection = self.collection_cache.load(event_data['digest'])
+                if slave_collection is None:
+                    diff_err = '{} collection {} is missing from the collection cache'.format(
+                        slave.id, event_data['digest'])
+                else:
+                    self.log.debug('diffing {} collection'.format(slave.id))
+                    diff_err = report_collection_diff(
+                        slave.id, self.collection, slave_collection)
+            if diff_err:
+                self.print_message(
+                    'collection differs, respawning', slave.id,
+                    purple=True)
+                self.print_message(diff_err, purple=True)
+                self.log.error('{}'.format(diff_err))
+                self.kill(slave)
+                slave.start()
+            else:
+                self.ack(slave, event_name)
+        elif event_name == 'need_tests':
+            if slave.revoke is not None and not slave.revoke_sent:
+                # the slave ran out of tests before the revoke could be sent
+                self._cancel_revoke(slave)
+            self.send_tests(slave)
+            self.log.info('starting master test distribution')
+        elif event_name == 'runtest_logstart':
+            try:
+                slave.unstarted.remove(event_data['nodeid'])
+            except ValueError:
+                pass
+            self.ack(slave, event_name)
+            self.trdist.runtest_logstart(
+                slave.id,
+                event_data['nodeid'],
+                event_data['location'])
+        elif event_name == 'runtest_logreport':
+            self.ack(slave, event_name)
+            report = unserialize_report(event_data['report'])
+            if report.when in ('call', 'teardown'):
+                slave.tests.discard(report.nodeid)
+            self.durations.record(report)
+            if report.when == 'setup' and slave.pending_adds:
+                # the first test on a newly allocated provider pays for adding it
+                added = slave.pending_adds.intersection(self._provs_of_tests([report.nodeid]))
+                for prov in added:
+                    self.switch_costs.record_add(prov, report.duration / len(added))
+                slave.pending_adds.difference_update(added)
+            self.trdist.runtest_logreport(slave.id, report)
+        elif event_name == 'revoked':
+            self.ack(slave, event_name)
+            self.tests_revoked(slave, event_data['node_ids'])
+        elif event_name == 'internalerror':
+            self.ack(slave, event_name)
+            self.print_message(event_data['message'], slave, purple=True)
+            self.kill(slave)
+        elif event_name == 'shutdown':
+            del self.slaves[slave.id]
+            if slave.revoke is not None:
+                # nothing left to give back, don't send the revoke instead of the ack
+                self._cancel_revoke(slave)
+            self.ack(slave, event_name)
+            self.monitor_shutdown(slave)
+
     def _test_item_generator(self):
-        for tests in self._modscope_item_generator():
+        if self.scheduler == 'duration':
+            for tests in self._duration_item_generator():
+                yield tests
+        else:
+            for tests in self._modscope_item_generator():
+                yield tests
+
+    def _duration_item_generator(self):
+        # longest processing time first: the same groups as the modscope generator,
+        # ordered by their expected duration so the longest groups don't end up in the tail
+        test_groups = list(self._modscope_item_generator())
+        test_groups.sort(key=self.durations.group_duration, reverse=True)
+        expected = sum(self.durations.group_duration(tests) for tests in test_groups)
+        self.print_message(
+            'scheduling {} test groups longest-first, {} tests with known durations, '
+            'expecting {:.0f} test-seconds in total'.format(
+                len(test_groups), len(self.durations), expected))
+        for tests in test_groups:
             yield tests
 
     def _modscope_item_generator(self):
@@ -509,71 +746,62 @@ class ParallelSession(object):
                 self.log.info('sent tests with param {} {!r}'.format(id, tests))
                 yield tests
 
-    def get(self, slave):
-
-        def provs_of_tests(test_group):
-            found = set()
-            for test in test_group:
-                found.update(pv for pv in self.provs
-                             if '[' in test and pv in test)
-            return sorted(found)
+    def _provs_of_tests(self, test_group):
+        found = set()
+        for test in test_group:
+            try:
+                found.update(self.test_providers[test])
+            except KeyError:
+                # not in the master collection, fall back to parsing the parametrization id
+                if '[' in test:
+                    param_id = test.split('[', 1)[1].rstrip(']')
+                    found.update(provider_keys_from_id(param_id, self.provs))
+        return sorted(found)
+
+    def _provs_compatible(self, slave, provs):
+        # tests can move to a slave that has their providers or room to add them
+        allocation = set(slave.provider_allocation)
+        return len(allocation.union(provs)) <= self.placement.providers_per_appliance
 
+    def get(self, slave):
         if not self._pool:
             for test_group in self.test_groups:
                 self._pool.append(test_group)
-                self.used_prov.update(provs_of_tests(test_group))
-            if self.used_prov:
-                self.ratio = float(len(self.slaves)) / len(self.used_prov)
-            else:
-                self.ratio = 0.0
+                self._pool_provs.append(self._provs_of_tests(test_group))
         if not self._pool:
             return []
-        appliance_num_limit = 1
-        for idx, test_group in enumerate(self._pool):
-            provs = provs_of_tests(test_group)
-            if provs:
-                prov = provs[0]
-                if prov in slave.provider_allocation:
-                    # provider is already with the slave, so just return the tests
-                    self._pool.remove(test_group)
-                    return test_group
-                else:
-                    if len(slave.provider_allocation) >= appliance_num_limit:
-                        continue
-                    else:
-                        # Adding provider to slave since there are not too many
-                        slave.provider_allocation.append(prov)
-                        self._pool.remove(test_group)
-                        return test_group
-            else:
-                # No providers - ie, not a provider parametrized test
-                # or no params, so not parametrized at all
-                self._pool.remove(test_group)
-                return test_group
-
-        # Here means no tests were able to be sent
-        for test_group in self._pool:
-
-            provs = provs_of_tests(test_group)
-            if provs:
-                prov = provs[0]
-                # Already too many slaves with provider
-                app_url = slave.url
-                app_ip = urlparse(app_url).netloc
-                app = IPAppliance(app_ip)
-                self.print_message(
-                    'cleansing appliance', slave, purple=True)
-                try:
-                    app.delete_all_providers()
-                except Exception as e:
-                    self.print_message(
-                        'cloud not cleanse', slave, red=True)
-                    self.print_message('error:', e, red=True)
-            slave.provider_allocation = [prov]
-            self._pool.remove(test_group)
-            return test_group
-        assert not self._pool, self._pool
-        return []
+        other_allocations = [
+            other.provider_allocation for other in self.slaves.values() if other is not slave]
+        placement = self.placement.place(
+            slave.provider_allocation, other_allocations, self._pool, self._pool_provs)
+        if placement.cleanse:
+            self.provider_switches += 1
+            self.print_message(
+                'moving from {} to {}, expecting {:.0f}s of provider setup ({} switches so far)'
+                .format(', '.join(slave.provider_allocation), ', '.join(placement.allocation),
+                    placement.cost, self.provider_switches),
+                slave, purple=True)
+            self.cleanse(slave)
+        slave.pending_adds.update(
+            set(placement.allocation).difference(slave.provider_allocation))
+        slave.provider_allocation = placement.allocation
+        self._pool_provs.pop(placement.index)
+        return self._pool.pop(placement.index)
+
+    def cleanse(self, slave):
+        """Remove all providers from the slave's appliance, timing it for the switch cost model"""
+        app = IPAppliance(urlparse(slave.url).netloc)
+        self.print_message('cleansing appliance', slave, purple=True)
+        start = time()
+        try:
+            app.delete_all_providers()
+        except Exception as e:
+            self.print_message('could not cleanse', slave, red=True)
+            self.print_message('error: {}'.format(e), slave, red=True)
+        else:
+            self.switch_costs.record_cleanse(time() - start)
+        slave.provider_allocation = []
+        slave.pending_adds.clear()
 
 
 def report_collection_diff(slaveid, from_collection, to_collection):
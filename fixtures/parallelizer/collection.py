@@ -0,0 +1,53 @@
+"""Content-addressed collection cache for the parallelizer
+
+Every slave runs its own collection, which has to match the master's. Instead of sending the full
+list of node ids to the master to be sorted and diffed, each node stores its collection in the
+pytest cache under the digest of its node ids, and the slaves only send that digest. The master
+only loads a slave's collection from the cache, and diffs it, when the digests don't match.
+
+py.test has to build the test items in every process regardless, so the cache can't save the
+slaves from collecting; it saves the transfer, sorting and diffing of the collections.
+
+"""
+import hashlib
+
+COLLECTIONS_KEY = 'parallelize/collections/{}'
+
+
+def collection_digest(node_ids):
+    """sha1 digest of a collection, independent of the collection order"""
+    digest = hashlib.sha1()
+    for nodeid in sorted(node_ids):
+        digest.update(nodeid.encode('utf-8'))
+        digest.update(b'\n')
+    return digest.hexdigest()
+
+
+class CollectionCache(object):
+    """Collections stored in the pytest cache, addressed by their digests
+
+    Args:
+        cache: The pytest cache (``config.cache``)
+
+    """
+    def __init__(self, cache):
+        self.cache = cache
+
+    def store(self, node_ids):
+        """Store a collection unless it is already cached
+
+        Args:
+            node_ids: The collected node ids
+
+        Returns:
+            The :py:func:`collection_digest` of the collection
+
+        """
+        digest = collection_digest(node_ids)
+        if self.cache.get(COLLECTIONS_KEY.format(digest), None) is None:
+            self.cache.set(COLLECTIONS_KEY.format(digest), sorted(node_ids))
+        return digest
+
+    def load(self, digest):
+        """Get the node ids of a collection by its digest, ``None`` if it isn't cached"""
+        return self.cache.get(COLLECTIONS_KEY.format(digest), None)
@@ -0,0 +1,131 @@
+"""Run history for the parallelizer
+
+The master records how long tests take from the ``runtest_logreport`` events sent by the slaves,
+and how long it takes to move a slave's appliance to a different provider, and keeps that history
+in the pytest cache (``.cache/v/parallelize``), so that later runs are able to make better
+scheduling decisions than plain collection order.
+
+"""
+from collections import defaultdict
+
+DURATIONS_KEY = 'parallelize/durations'
+
+
+class DurationHistory(object):
+    """Per-test duration store, backed by the pytest cache
+
+    The duration of a test is the sum of its setup, call and teardown phases. Durations from
+    previous runs are blended with an exponential moving average, so a single unusually slow
+    run doesn't skew the scheduling for good.
+
+    Args:
+        cache: The pytest cache (``config.cache``), or ``None`` to keep the history in memory only
+        key: The cache key the durations are stored under
+
+    """
+    #: Weight of the newest measurement in the moving average
+    smoothing = 0.5
+    #: Expected duration of a test when there is no history at all, in seconds
+    unknown_duration = 60.0
+
+    def __init__(self, cache, key=DURATIONS_KEY):
+        self.cache = cache
+        self.key = key
+        if cache is not None:
+            self.durations = dict(cache.get(key, {}))
+        else:
+            self.durations = {}
+        self._current = defaultdict(float)
+
+    def __len__(self):
+        return len(self.durations)
+
+    def record(self, report):
+        """Add the duration of one test phase report to the current run"""
+        if report.when == 'setup':
+            # a test can be run again when its slave died, only keep the last attempt
+            self._current[report.nodeid] = 0.0
+        self._current[report.nodeid] += getattr(report, 'duration', 0.0) or 0.0
+
+    def save(self):
+        """Merge durations recorded in this run into the history and store it in the cache"""
+        for nodeid, duration in self._current.items():
+            previous = self.durations.get(nodeid)
+            if previous is None:
+                self.durations[nodeid] = duration
+            else:
+                self.durations[nodeid] = (
+                    self.smoothing * duration + (1 - self.smoothing) * previous)
+        self._current.clear()
+        if self.cache is not None:
+            self.cache.set(self.key, self.durations)
+
+    @property
+    def default(self):
+        """Expected duration of a test without history, the mean of all known durations"""
+        if not self.durations:
+            return self.unknown_duration
+        return sum(self.durations.values()) / len(self.durations)
+
+    def expected(self, nodeid):
+        """Expected duration of a single test, in seconds"""
+        try:
+            return self.durations[nodeid]
+        except KeyError:
+            return self.default
+
+    def group_duration(self, tests):
+        """Expected duration of a group of tests, in seconds"""
+        default = self.default
+        return sum(self.durations.get(nodeid, default) for nodeid in tests)
+
+
+SWITCH_COSTS_KEY = 'parallelize/provider_switch_costs'
+
+
+class SwitchCostHistory(object):
+    """Measured cost of moving a slave's appliance to a different provider, in seconds
+
+    A switch is made of two parts: cleansing the appliance of all its providers, timed by the
+    master around :py:meth:`IPAppliance.delete_all_providers`, and adding the new provider,
+    estimated from the setup phase of the first test a slave runs against it.
+
+    Args:
+        cache: The pytest cache (``config.cache``), or ``None`` to keep the history in memory only
+        key: The cache key the costs are stored under
+
+    """
+    #: Assumed cost of a cleanse or a provider add that was never measured
+    default_cost = 120.0
+    #: Weight of the newest measurement in the moving average
+    smoothing = 0.5
+
+    def __init__(self, cache, key=SWITCH_COSTS_KEY):
+        self.cache = cache
+        self.key = key
+        costs = cache.get(key, {}) if cache is not None else {}
+        self.cleanse = costs.get('cleanse')
+        self.add = dict(costs.get('add', {}))
+
+    def _blend(self, previous, seconds):
+        if previous is None:
+            return seconds
+        return self.smoothing * seconds + (1 - self.smoothing) * previous
+
+    def record_cleanse(self, seconds):
+        self.cleanse = self._blend(self.cleanse, seconds)
+
+    def record_add(self, provider, seconds):
+        self.add[provider] = self._blend(self.add.get(provider), seconds)
+
+    def save(self):
+        if self.cache is not None:
+            self.cache.set(self.key, {'cleanse': self.cleanse, 'add': self.add})
+
+    def cleanse_cost(self):
+        if self.cleanse is None:
+            return self.default_cost
+        return self.cleanse
+
+    def add_cost(self, provider):
+        return self.add.get(provider, self.default_cost)
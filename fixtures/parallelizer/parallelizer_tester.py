@@ -5,6 +5,9 @@ Useful to make sure tests are being parallelized properly, and then reported cor
 This file is named specially to prevent being picked up by py.test's default collector, and should
 not be run during a normal test run.
 
+The tests in here are also the source of the events replayed by
+:py:mod:`transport_benchmark <fixtures.parallelizer.transport_benchmark>`.
+
 """
 import random
 from time import sleep
@@ -0,0 +1,167 @@
+"""Provider-aware placement of test groups on parallelizer slaves
+
+Provider-parametrized tests need their provider set up on the slave's appliance. Adding a
+provider takes minutes, and making room for a different one means cleansing the appliance of
+all its providers first, so the master tries to keep every slave on the providers it already has
+and only moves slaves around when there is nothing else left for them to do.
+
+When a slave asks for tests, the pool of test groups is searched, in pool order, for the first
+group in each of these categories, and the first category that has a group wins:
+
+1. groups whose providers the slave already has
+2. groups for providers no slave has yet, if they fit in the slave's provider allocation
+3. groups without providers
+4. groups for providers other slaves already have, if they fit in the slave's allocation
+5. any other group, cleansing the appliance of its providers first
+
+In the last two categories, the group of the provider with the most remaining work per slave
+working on it, less the cost of moving to it, is picked.
+
+"""
+import attr
+
+#: Placement categories, in the order of preference
+MATCH, ADD_NEW, NO_PROVIDERS, ADD_SHARED, SWITCH = range(5)
+
+
+def provider_keys_from_id(param_id, provider_keys):
+    """Find the provider keys in the id of a parametrized test
+
+    py.test joins the ids of all the parameters of a test with dashes, and provider keys may
+    contain dashes themselves, so a key matches only as a whole run of dash-separated parts.
+
+    Args:
+        param_id: The parametrization id, e.g. ``'rhos-7-small_template'``
+        provider_keys: The known provider keys
+
+    Returns:
+        A sorted list of the provider keys found in the id
+
+    """
+    found = set()
+    remaining = '-{}-'.format(param_id)
+    # longest keys first, so a key doesn't also count as a shorter key it starts with
+    for key in sorted(provider_keys, key=len, reverse=True):
+        token = '-{}-'.format(key)
+        if token in remaining:
+            found.add(key)
+            remaining = remaining.replace(token, '--')
+    return sorted(found)
+
+
+def provider_keys_from_item(item, provider_keys):
+    """Find the provider keys a collected test item is parametrized with
+
+    The parametrized values are checked first, as :py:func:`utils.testgen.providers`
+    parametrizes tests with provider objects that carry their key. The parametrization
+    id is parsed if that finds nothing.
+
+    """
+    callspec = getattr(item, 'callspec', None)
+    if callspec is None:
+        return []
+    found = set()
+    for value in callspec.params.values():
+        key = getattr(value, 'key', value)
+        if isinstance(key, basestring) and key in provider_keys:
+            found.add(key)
+    if not found:
+        found.update(provider_keys_from_id(callspec.id, provider_keys))
+    return sorted(found)
+
+
+@attr.s
+class Placement(object):
+    #: Index of the test group in the pool
+    index = attr.ib()
+    #: Placement category, one of the module constants
+    category = attr.ib()
+    #: The slave's provider allocation once it takes the group
+    allocation = attr.ib()
+    #: Whether the appliance has to be cleansed of its providers first
+    cleanse = attr.ib(default=False)
+    #: Expected time spent on provider setup, in seconds
+    cost = attr.ib(default=0.0)
+    #: Remaining work per slave on the providers moved to, less the cost; used to rank moves
+    gain = attr.ib(default=0.0)
+
+
+class ProviderPlacement(object):
+    """Chooses which test group from the pool a slave should run next
+
+    Args:
+        providers_per_appliance: How many providers a slave's appliance may have at once
+        switch_costs: A :py:class:`fixtures.parallelizer.history.SwitchCostHistory`
+        group_duration: Callable returning the expected duration of a test group
+
+    """
+    def __init__(self, providers_per_appliance, switch_costs, group_duration):
+        self.providers_per_appliance = providers_per_appliance
+        self.switch_costs = switch_costs
+        self.group_duration = group_duration
+
+    def place(self, allocation, other_allocations, pool, group_providers):
+        """Pick a test group from the pool for a slave
+
+        Args:
+            allocation: The providers the slave's appliance has
+            other_allocations: The provider allocations of all the other slaves
+            pool: List of test groups
+            group_providers: List of the provider keys of each test group in ``pool``
+
+        Returns:
+            A :py:class:`Placement`, or ``None`` if the pool is empty
+
+        """
+        allocation = set(allocation)
+        holders = {}
+        for other in other_allocations:
+            for provider in other:
+                holders[provider] = holders.get(provider, 0) + 1
+        remaining = {}
+        for tests, providers in zip(pool, group_providers):
+            for provider in providers:
+                remaining[provider] = remaining.get(provider, 0.0) + self.group_duration(tests)
+
+        best = None
+        for index, providers in enumerate(group_providers):
+            placement = self._categorize(index, allocation, set(providers), holders, remaining)
+            if best is None or self._better(placement, best):
+                best = placement
+                if best.category == MATCH:
+                    break
+        return best
+
+    def _categorize(self, index, allocation, providers, holders, remaining):
+        # checked first, an empty set is a subset of any allocation
+        if not providers:
+            return Placement(index, NO_PROVIDERS, sorted(allocation))
+        if providers <= allocation:
+            return Placement(index, MATCH, sorted(allocation))
+        new = providers - allocation
+        if len(allocation | providers) <= self.providers_per_appliance:
+            cost = sum(self.switch_costs.add_cost(provider) for provider in new)
+            if not any(holders.get(provider) for provider in new):
+                category = ADD_NEW
+            else:
+                category = ADD_SHARED
+            placement = Placement(index, category, sorted(allocation | providers), cost=cost)
+        else:
+            # cleansing removes all the providers, so all of the group's providers are re-added
+            new = providers
+            cost = self.switch_costs.cleanse_cost() + sum(
+                self.switch_costs.add_cost(provider) for provider in providers)
+            placement = Placement(index, SWITCH, sorted(providers), cleanse=True, cost=cost)
+        # the remaining work per slave working on the new providers, less the cost of moving
+        placement.gain = min(
+            remaining.get(provider, 0.0) / (holders.get(provider, 0) + 1)
+            for provider in new) - cost
+        return placement
+
+    def _better(self, placement, best):
+        if placement.category != best.category:
+            return placement.category < best.category
+        if placement.category in (ADD_SHARED, SWITCH):
+            return placement.gain > best.gain
+        # otherwise keep the pool order
+        return False
@@ -1,9 +1,13 @@
 import signal
+from collections import deque
 from urlparse import urlparse
 
 import zmq
 from py.path import local
 
+from collection import CollectionCache
+from transport import BATCHABLE_EVENTS, get_codec
+
 SLAVEID = None
 
 
@@ -26,17 +30,40 @@ class SlaveManager(object):
         self.sock.connect(zmq_endpoint)
 
         self.messages = {}
+        self.codec = get_codec(config.getoption('parallel_transport'))
+        self.batch_events = config.getoption('parallel_batch')
+        self._batch = []
+        # node ids received from the master that haven't been started yet
+        self._queue = deque()
 
         self.quit_signaled = False
 
     def send_event(self, name, **kwargs):
         kwargs['_event_name'] = name
-        self.log.trace("sending {} {!r}".format(name, kwargs))
-        self.sock.send_json(kwargs)
-        recv = self.sock.recv_json()
+        if self.batch_events and name in BATCHABLE_EVENTS:
+            # held back until the next test starts, so the master knows what's running
+            self._batch.append(kwargs)
+            if name == 'runtest_logstart':
+                self.flush_events()
+            return
+        self.flush_events()
+        return self._send(kwargs)
+
+    def flush_events(self):
+        """Send the events held back for batching to the master"""
+        if self._batch:
+            events, self._batch = self._batch, []
+            self._send({'_event_name': 'batch', 'events': events})
+
+    def _send(self, event):
+        self.log.trace("sending {} {!r}".format(event['_event_name'], event))
+        self.sock.send(self.codec.dumps(event))
+        recv = self.codec.loads(self.sock.recv())
         if recv == 'die':
             self.log.info('Slave instructed to die by master; shutting down')
             raise SystemExit()
+        elif isinstance(recv, dict) and 'revoke' in recv:
+            self.revoke_tests(recv['revoke'])
         else:
             self.log.trace('received "{!r}" from master'.format(recv))
             if recv != 'ack':
@@ -49,14 +76,16 @@ class SlaveManager(object):
     def pytest_collection_finish(self, session):
         """pytest collection hook
 
-        - Sends collected tests to the master for comparison
+        - Stores the collection in the collection cache, and sends its digest to the master
+          for comparison
 
         """
         self.log.debug('collection finished')
         self.session = session
         self.collection = {item.nodeid: item for item in session.items}
         terminalreporter.disable()
-        self.send_event("collectionfinish", node_ids=self.collection.keys())
+        digest = CollectionCache(self.config.cache).store(self.collection.keys())
+        self.send_event("collectionfinish", digest=digest)
 
     def pytest_runtest_logstart(self, nodeid, location):
         """pytest runtest logstart hook
@@ -116,6 +145,19 @@ class SlaveManager(object):
         self.send_event('shutdown')
         self.quit_signaled = True
 
+    def revoke_tests(self, node_ids):
+        """Drop tests the master took back from the queue, and report which ones were dropped
+
+        Tests that were already started, or lined up as the next item, stay with this slave.
+
+        """
+        revoke = set(node_ids)
+        revoked = [nodeid for nodeid in self._queue if nodeid in revoke]
+        self._queue = deque(nodeid for nodeid in self._queue if nodeid not in revoke)
+        self.log.info('master took back {} of {} requested tests'.format(
+            len(revoked), len(node_ids)))
+        self.send_event('revoked', node_ids=revoked)
+
     def _test_generator(self):
         node_iter = self._iter_nodes()
         run_node = next(node_iter)
@@ -130,9 +172,10 @@ class SlaveManager(object):
             node_ids = self.send_event('need_tests')
             if not node_ids:
                 break
-            for nodeid in node_ids:
+            self._queue.extend(node_ids)
+            while self._queue:
                 # TODO: take non-unique node ids into account
-                yield self.collection[nodeid]
+                yield self.collection[self._queue.popleft()]
 
 
 def serialize_report(rep):
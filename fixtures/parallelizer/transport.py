@@ -0,0 +1,80 @@
+"""Message transport between the parallelizer master and its slaves
+
+Slaves talk to the master over a zmq REQ socket, and the master answers on a ROUTER socket. Every
+zmq message carries one encoded event dict, the name of the event is stored under the
+``_event_name`` key.
+
+Two encodings are available, selected with ``--parallel-transport``:
+
+- ``json``, the default
+- ``msgpack``, a compact binary encoding that is considerably cheaper to encode and decode
+
+With ``--parallel-batch``, slaves hold back the events that only need to be acknowledged
+(test starts and test reports), and send them to the master in a single ``batch`` event
+when the next test starts, so the master handles one message per test instead of four.
+
+"""
+import json
+
+import zmq
+
+#: Events a slave may hold back and send in a batch, the master only acknowledges them
+BATCHABLE_EVENTS = ('runtest_logstart', 'runtest_logreport')
+
+
+class JSONCodec(object):
+    name = 'json'
+
+    def dumps(self, data):
+        return json.dumps(data)
+
+    def loads(self, data):
+        return json.loads(data)
+
+
+class MsgpackCodec(object):
+    name = 'msgpack'
+
+    def __init__(self):
+        # only imported when the msgpack transport is requested
+        import msgpack
+        self.msgpack = msgpack
+
+    def dumps(self, data):
+        return self.msgpack.packb(data, use_bin_type=False)
+
+    def loads(self, data):
+        # decode strings to unicode, the same way the json codec does
+        return self.msgpack.unpackb(data, encoding='utf-8')
+
+
+codecs = {codec.name: codec for codec in (JSONCodec, MsgpackCodec)}
+
+
+def get_codec(name):
+    """Get a codec instance by its transport name"""
+    return codecs[name]()
+
+
+def recv_frames(sock, timeout):
+    """Wait for messages on a ROUTER socket, then yield all messages queued up on it
+
+    The wait blocks in zmq until a message arrives or ``timeout`` passes, so the caller is only
+    woken up when there is something to do, or to do its periodic housekeeping.
+
+    Args:
+        sock: The zmq ROUTER socket
+        timeout: How long to wait for the first message, in milliseconds
+
+    Yields:
+        ``(identity, payload)`` tuples
+
+    """
+    if not sock.poll(timeout):
+        return
+    while True:
+        try:
+            identity, _, payload = sock.recv_multipart(flags=zmq.NOBLOCK)
+        except zmq.Again:
+            return
+        yield identity, payload
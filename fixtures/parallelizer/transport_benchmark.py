@@ -0,0 +1,145 @@
+"""parallelizer transport benchmark
+
+Measures how fast the parallelizer master can take in test events from its slaves with each
+transport setting.
+
+The test events are the real ones: :py:mod:`parallelizer_tester` is run once in-process to capture
+the logstart and serialized logreport events a slave would send for it. A number of fake slave
+processes then replay those events over zmq, the same way :py:class:`remote.SlaveManager` sends
+them, while the master side decodes every event and rebuilds the test reports.
+
+Like the tester, this file is named specially to prevent being picked up by py.test's default
+collector. Run it directly::
+
+    python fixtures/parallelizer/transport_benchmark.py --slaves 16
+
+"""
+import argparse
+import os
+import shutil
+import tempfile
+from multiprocessing import Process
+from time import time
+
+import pytest
+import zmq
+from _pytest.runner import TestReport
+
+from remote import serialize_report
+from transport import BATCHABLE_EVENTS, get_codec, recv_frames
+
+here = os.path.dirname(os.path.abspath(__file__))
+
+#: (transport, batch) combinations to compare
+settings = [
+    ('json', False),
+    ('json', True),
+    ('msgpack', False),
+    ('msgpack', True),
+]
+
+
+class EventCollector(object):
+    """pytest plugin keeping the events a slave would send to the master"""
+    def __init__(self):
+        self.events = []
+
+    def pytest_runtest_logstart(self, nodeid, location):
+        self.events.append(
+            {'_event_name': 'runtest_logstart', 'nodeid': nodeid, 'location': location})
+
+    def pytest_runtest_logreport(self, report):
+        self.events.append(
+            {'_event_name': 'runtest_logreport', 'report': serialize_report(report)})
+
+
+def collect_events():
+    collector = EventCollector()
+    pytest.main([os.path.join(here, 'parallelizer_tester.py'), '-q', '--noconftest',
+        '-p', 'no:cacheprovider'], plugins=[collector])
+    return collector.events
+
+
+def fake_slave(endpoint, slaveid, transport, batch, events):
+    codec = get_codec(transport)
+    sock = zmq.Context.instance().socket(zmq.REQ)
+    sock.setsockopt(zmq.IDENTITY, slaveid)
+    sock.connect(endpoint)
+
+    def send(event):
+        sock.send(codec.dumps(event))
+        sock.recv()
+
+    held = []
+    for event in events + [{'_event_name': 'shutdown'}]:
+        if batch and event['_event_name'] in BATCHABLE_EVENTS:
+            held.append(event)
+            if event['_event_name'] != 'runtest_logstart':
+                continue
+            event = {'_event_name': 'batch', 'events': held}
+            held = []
+        elif held:
+            send({'_event_name': 'batch', 'events': held})
+            held = []
+        send(event)
+
+
+def run(endpoint, slaves, transport, batch, events):
+    """Replay ``events`` from ``slaves`` fake slaves, return (seconds, events handled)"""
+    codec = get_codec(transport)
+    sock = zmq.Context.instance().socket(zmq.ROUTER)
+    sock.bind(endpoint)
+    processes = [
+        Process(target=fake_slave, args=(endpoint, 'slave{:02d}'.format(i), transport, batch,
+            events))
+        for i in range(slaves)]
+    start = time()
+    for process in processes:
+        process.start()
+
+    handled = 0
+    running = slaves
+    while running:
+        for slaveid, payload in recv_frames(sock, 1000):
+            event = codec.loads(payload)
+            if event['_event_name'] == 'batch':
+                batch_events = event['events']
+            else:
+                batch_events = [event]
+            for event in batch_events:
+                if event['_event_name'] == 'runtest_logreport':
+                    TestReport(**event['report'])
+                elif event['_event_name'] == 'shutdown':
+                    running -= 1
+                handled += 1
+            sock.send_multipart([slaveid, '', codec.dumps('ack')])
+    elapsed = time() - start
+
+    for process in processes:
+        process.join()
+    sock.close()
+    return elapsed, handled
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--slaves', type=int, default=16, help='number of fake slaves')
+    parser.add_argument('--copies', type=int, default=1,
+        help='how many times each slave replays the tester events')
+    args = parser.parse_args()
+
+    events = collect_events() * args.copies
+    workdir = tempfile.mkdtemp()
+    try:
+        print('{} slaves sending {} events each'.format(args.slaves, len(events)))
+        for i, (transport, batch) in enumerate(settings):
+            endpoint = 'ipc://{}'.format(os.path.join(workdir, str(i)))
+            elapsed, handled = run(endpoint, args.slaves, transport, batch, events)
+            print('{:8} batch={!s:5} {:8.2f}s {:10.0f} events/s'.format(
+                transport, batch, elapsed, handled / elapsed))
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    main()
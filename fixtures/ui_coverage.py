@@ -178,8 +178,10 @@ class CoverageManager(object):
 
         # bundle install for old downstream and upstream builds
         def _bundle_install():
-            self.ipapp.ssh_client.run_command('yum -y install git')
-            self.ipapp.ssh_client.run_command('cd {}; bundle'.format(rails_root))
+            self.ipapp.ssh_client.run_batch([
+                'yum -y install git',
+                'cd {}; bundle'.format(rails_root),
+            ], fail_fast=False)
         version.pick({
             version.LOWEST: _bundle_install,
             '5.4': _gem_install,
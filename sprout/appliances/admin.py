@@ -10,7 +10,7 @@ from django_object_actions import DjangoObjectActions
 # Register your models here.
 from appliances.models import (
     Provider, Template, Appliance, Group, AppliancePool, DelayedProvisionTask,
-    MismatchVersionMailer, UserApplianceQuota, User, BugQuery, GroupShepherd)
+    MismatchVersionMailer, UserApplianceQuota, User, BugQuery, GroupShepherd, MetadataEntry)
 from appliances import tasks
 from sprout.log import create_logger
 
@@ -214,3 +214,9 @@ class CustomUserAdmin(UserAdmin):
 @register_for(BugQuery)
 class BugQueryAdmin(Admin):
     pass
+
+
+@register_for(MetadataEntry)
+class MetadataEntryAdmin(Admin):
+    list_display = ["content_type", "object_id", "key", "value"]
+    list_filter = ["content_type", "key"]
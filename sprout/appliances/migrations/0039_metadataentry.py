@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import json
+from collections import defaultdict
+
+import yaml
+from django.db import migrations, models
+import django.db.models.deletion
+
+METADATA_MODELS = [
+    'DelayedProvisionTask', 'Provider', 'Group', 'GroupShepherd', 'Template', 'Appliance',
+    'AppliancePool']
+
+
+def yaml_to_entries(apps, schema_editor):
+    ContentType = apps.get_model('contenttypes', 'ContentType')
+    MetadataEntry = apps.get_model('appliances', 'MetadataEntry')
+    entries = []
+    for model_name in METADATA_MODELS:
+        model = apps.get_model('appliances', model_name)
+        content_type, _ = ContentType.objects.get_or_create(
+            app_label='appliances', model=model_name.lower())
+        for pk, object_meta_data in model.objects.values_list('pk', 'object_meta_data'):
+            for key, value in (yaml.load(object_meta_data) or {}).iteritems():
+                entries.append(MetadataEntry(
+                    content_type=content_type, object_id=str(pk), key=key,
+                    # anything YAML had that JSON doesn't (dates) is kept as its string
+                    value=json.dumps(value, sort_keys=True, default=str)))
+    MetadataEntry.objects.bulk_create(entries, batch_size=500)
+
+
+def entries_to_yaml(apps, schema_editor):
+    ContentType = apps.get_model('contenttypes', 'ContentType')
+    MetadataEntry = apps.get_model('appliances', 'MetadataEntry')
+    for model_name in METADATA_MODELS:
+        model = apps.get_model('appliances', model_name)
+        try:
+            content_type = ContentType.objects.get(
+                app_label='appliances', model=model_name.lower())
+        except ContentType.DoesNotExist:
+            continue
+        metadata = defaultdict(dict)
+        entries = MetadataEntry.objects.filter(content_type=content_type).values_list(
+            'object_id', 'key', 'value')
+        for object_id, key, value in entries:
+            metadata[object_id][key] = json.loads(value)
+        for obj in model.objects.all():
+            obj.object_meta_data = yaml.dump(metadata.get(str(obj.pk), {}))
+            obj.save(update_fields=['object_meta_data'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contenttypes', '0002_remove_content_type_name'),
+        ('appliances', '0038_auto_20170201_1218'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MetadataEntry',
+            fields=[
+                ('id', models.AutoField(
+                    auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('object_id', models.CharField(max_length=32)),
+                ('key', models.CharField(max_length=64)),
+                ('value', models.TextField()),
+                ('content_type', models.ForeignKey(
+                    on_delete=django.db.models.deletion.CASCADE,
+                    to='contenttypes.ContentType')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='metadataentry',
+            unique_together=set([('content_type', 'object_id', 'key')]),
+        ),
+        migrations.RunPython(yaml_to_entries, entries_to_yaml),
+    ] + [
+        migrations.RemoveField(model_name=model_name.lower(), name='object_meta_data')
+        for model_name in METADATA_MODELS
+    ]
@@ -1,7 +1,7 @@
 # -*- coding: utf-8 -*-
 import base64
+import json
 import re
-import yaml
 
 try:
     import cPickle as pickle
@@ -15,10 +15,11 @@ from celery import chain
 from contextlib import contextmanager
 from datetime import timedelta, date
 from django.contrib.auth.models import User, Group as DjangoGroup
+from django.contrib.contenttypes.models import ContentType
 from django.core.exceptions import ObjectDoesNotExist
-from django.db import models, transaction
-from django.db.models import Q
-from django.db.models.signals import pre_save
+from django.db import IntegrityError, models, transaction
+from django.db.models import Case, Count, Q, Sum, When
+from django.db.models.signals import post_delete, pre_save
 from django.dispatch import receiver
 from django.utils import timezone
 
@@ -57,10 +58,30 @@ def apply_if_not_none(o, meth, *args, **kwargs):
     return getattr(o, meth)(*args, **kwargs)
 
 
+def dump_metadata_value(value):
+    return json.dumps(value, sort_keys=True)
+
+
+class MetadataEntry(models.Model):
+    """One key of an object's metadata, the value stored as JSON.
+
+    Every key is its own row, so a single key can be read or written without touching the rest.
+    """
+    content_type = models.ForeignKey(ContentType, on_delete=models.CASCADE)
+    object_id = models.CharField(max_length=32)
+    key = models.CharField(max_length=64)
+    value = models.TextField()
+
+    class Meta:
+        unique_together = (("content_type", "object_id", "key"), )
+
+    def __unicode__(self):
+        return u"{}[{}].{}".format(self.content_type.model, self.object_id, self.key)
+
+
 class MetadataMixin(models.Model):
     class Meta:
         abstract = True
-    object_meta_data = models.TextField(default=yaml.dump({}))
 
     def reload(self):
         new_self = type(self).objects.get(pk=self.pk)
@@ -72,27 +93,70 @@ class MetadataMixin(models.Model):
         with critical_section("metadata-({})[{}]".format(type(self).__name__, str(self.pk))):
             yield
 
+    @property
+    def metadata_owner(self):
+        """Filter of the :py:class:`MetadataEntry` rows of this object"""
+        return dict(
+            content_type=ContentType.objects.get_for_model(type(self)), object_id=str(self.pk))
+
+    @property
+    def metadata_entries(self):
+        return MetadataEntry.objects.filter(**self.metadata_owner)
+
     @property
     def metadata(self):
-        return yaml.load(self.object_meta_data)
+        return {
+            key: json.loads(value)
+            for key, value in self.metadata_entries.values_list("key", "value")}
 
     @metadata.setter
     def metadata(self, value):
         if not isinstance(value, dict):
             raise TypeError("You can store only dict in metadata!")
-        self.object_meta_data = yaml.dump(value)
+        with transaction.atomic():
+            self.metadata_entries.exclude(key__in=value.keys()).delete()
+            for key, item in value.iteritems():
+                self.set_metadata(key, item)
+
+    def get_metadata(self, key, default=None):
+        """Read one key of the metadata, only that key is loaded and parsed."""
+        try:
+            value = self.metadata_entries.values_list("value", flat=True).get(key=key)
+        except MetadataEntry.DoesNotExist:
+            return default
+        return json.loads(value)
+
+    def set_metadata(self, key, value):
+        """Write one key of the metadata, atomically and without locking the other keys."""
+        value = dump_metadata_value(value)
+        entries = self.metadata_entries.filter(key=key)
+        with transaction.atomic():
+            if entries.update(value=value):
+                return
+            try:
+                with transaction.atomic():
+                    MetadataEntry.objects.create(key=key, value=value, **self.metadata_owner)
+            except IntegrityError:
+                # Someone else created the key in the meantime
+                entries.update(value=value)
+
+    def delete_metadata(self, key):
+        self.metadata_entries.filter(key=key).delete()
 
     @property
     @contextmanager
     def edit_metadata(self):
+        """Edit several keys of the metadata at once, only the changed keys are written."""
         with transaction.atomic():
             with self.metadata_lock:
-                o = type(self).objects.get(pk=self.pk)
-                metadata = o.metadata
+                stored = dict(self.metadata_entries.values_list("key", "value"))
+                metadata = {key: json.loads(value) for key, value in stored.iteritems()}
                 yield metadata
-                o.metadata = metadata
-                o.save()
-        self.reload()
+                for key in set(stored) - set(metadata):
+                    self.delete_metadata(key)
+                for key, value in metadata.iteritems():
+                    if dump_metadata_value(value) != stored.get(key):
+                        self.set_metadata(key, value)
 
     @property
     def logger(self):
@@ -147,6 +211,11 @@ class Provider(MetadataMixin):
     custom_memory_limit = models.IntegerField(null=True, blank=True)
     custom_cpu_limit = models.IntegerField(null=True, blank=True)
 
+    #: Appliances that count as being provisioned
+    PROVISIONING_APPLIANCES = Q(ready=False, marked_for_deletion=False, ip_address=None)
+    #: :py:class:`ProviderLoad` the counters are read from, they are queried when ``None``
+    load_snapshot = None
+
     def perf_sync(self):
         try:
             stats = self.api.usage_and_quota()
@@ -176,13 +245,16 @@ class Provider(MetadataMixin):
 
     @property
     def num_currently_provisioning(self):
-        return len(
-            Appliance.objects.filter(
-                ready=False, marked_for_deletion=False, template__provider=self, ip_address=None))
+        if self.load_snapshot is not None:
+            return self.load_snapshot.provisioning.get(self.id, 0)
+        return Appliance.objects.filter(
+            self.PROVISIONING_APPLIANCES, template__provider=self).count()
 
     @property
     def num_templates_preparing(self):
-        return len(Template.objects.filter(provider=self, ready=False))
+        if self.load_snapshot is not None:
+            return self.load_snapshot.templates_preparing.get(self.id, 0)
+        return Template.objects.filter(provider=self, ready=False).count()
 
     @property
     def remaining_configuring_slots(self):
@@ -202,7 +274,9 @@ class Provider(MetadataMixin):
 
     @property
     def num_currently_managing(self):
-        return len(Appliance.objects.filter(template__provider=self))
+        if self.load_snapshot is not None:
+            return self.load_snapshot.managing.get(self.id, 0)
+        return Appliance.objects.filter(template__provider=self).count()
 
     @property
     def currently_managed_appliances(self):
@@ -260,30 +334,27 @@ class Provider(MetadataMixin):
 
     @property
     def templates(self):
-        return self.metadata.get("templates", [])
+        return self.get_metadata("templates", [])
 
     @templates.setter
     def templates(self, value):
-        with self.edit_metadata as metadata:
-            metadata["templates"] = value
+        self.set_metadata("templates", value)
 
     @property
     def template_name_length(self):
-        return self.metadata.get("template_name_length", None)
+        return self.get_metadata("template_name_length")
 
     @template_name_length.setter
     def template_name_length(self, value):
-        with self.edit_metadata as metadata:
-            metadata["template_name_length"] = value
+        self.set_metadata("template_name_length", value)
 
     @property
     def appliances_manage_this_provider(self):
-        return self.metadata.get("appliances_manage_this_provider", [])
+        return self.get_metadata("appliances_manage_this_provider", [])
 
     @appliances_manage_this_provider.setter
     def appliances_manage_this_provider(self, value):
-        with self.edit_metadata as metadata:
-            metadata["appliances_manage_this_provider"] = value
+        self.set_metadata("appliances_manage_this_provider", value)
 
     @property
     def g_appliances_manage_this_provider(self):
@@ -364,6 +435,42 @@ class Provider(MetadataMixin):
         return "{} {}".format(type(self).__name__, self.id)
 
 
+class ProviderLoad(object):
+    """Appliance and template counters of all providers, as they were at one moment.
+
+    A scheduling pass asks for the counters of the same providers over and over, for every
+    template it considers. The snapshot gets the counters of all providers in two grouped
+    queries and the providers :py:meth:`attach`-ed to it read their counters from it, so the
+    usual :py:class:`Provider` properties (``free``, ``load``, ...) don't query anything. The
+    appliances the scheduler creates during the pass are counted in with
+    :py:meth:`add_appliance`.
+    """
+    def __init__(self):
+        self.managing = {}
+        self.provisioning = {}
+        appliances = Appliance.objects.values("template__provider").annotate(
+            managing=Count("id"),
+            provisioning=Sum(Case(
+                When(Provider.PROVISIONING_APPLIANCES, then=1),
+                default=0, output_field=models.IntegerField())))
+        for row in appliances:
+            self.managing[row["template__provider"]] = row["managing"]
+            self.provisioning[row["template__provider"]] = row["provisioning"]
+        self.templates_preparing = dict(
+            Template.objects.filter(ready=False).values("provider").annotate(
+                preparing=Count("id")).values_list("provider", "preparing"))
+
+    def attach(self, provider):
+        """Make the provider read its counters from this snapshot, returns the provider"""
+        provider.load_snapshot = self
+        return provider
+
+    def add_appliance(self, provider_id):
+        """Count in an appliance that started provisioning on the provider"""
+        self.managing[provider_id] = self.managing.get(provider_id, 0) + 1
+        self.provisioning[provider_id] = self.provisioning.get(provider_id, 0) + 1
+
+
 @receiver(pre_save, sender=Provider)
 def disable_if_hidden(sender, instance, **kwargs):
     if instance.hidden:
@@ -566,18 +673,15 @@ class Template(MetadataMixin):
 
     @property
     def temporary_name(self):
-        return self.metadata.get("temporary_name", None)
+        return self.get_metadata("temporary_name")
 
     @temporary_name.setter
     def temporary_name(self, name):
-        with self.edit_metadata as metadata:
-            metadata["temporary_name"] = name
+        self.set_metadata("temporary_name", name)
 
     @temporary_name.deleter
     def temporary_name(self):
-        with self.edit_metadata as metadata:
-            if "temporary_name" in metadata:
-                del metadata["temporary_name"]
+        self.delete_metadata("temporary_name")
 
     @classmethod
     def get_versions(cls, *filters, **kwfilters):
@@ -989,12 +1093,11 @@ class Appliance(MetadataMixin):
 
     @property
     def managed_providers(self):
-        return self.metadata.get("managed_providers", [])
+        return self.get_metadata("managed_providers", [])
 
     @managed_providers.setter
     def managed_providers(self, value):
-        with self.edit_metadata as metadata:
-            metadata["managed_providers"] = value
+        self.set_metadata("managed_providers", value)
 
     @property
     def vnc_link(self):
@@ -1154,8 +1257,18 @@ class AppliancePool(MetadataMixin):
 
     @property
     def possible_provisioning_templates(self):
+        return self.provisioning_templates(ProviderLoad())
+
+    def provisioning_templates(self, load):
+        """Possible templates on free providers, best match first.
+
+        Args:
+            load: :py:class:`ProviderLoad` to read the provider counters from
+        """
         return sorted(
-            filter(lambda tpl: tpl.provider.free, self.possible_templates),
+            filter(
+                lambda tpl: load.attach(tpl.provider).free,
+                self.possible_templates.select_related("provider")),
             # Sort by date and load to pick the best match (least loaded provider)
             key=lambda tpl: (tpl.date, 1.0 - tpl.provider.appliance_load), reverse=True)
 
@@ -1302,9 +1415,10 @@ class AppliancePool(MetadataMixin):
 
     @property
     def num_possible_appliance_slots(self):
+        load = ProviderLoad()
         providers = set([])
-        for template in self.possible_templates:
-            providers.add(template.provider)
+        for template in self.possible_templates.select_related("provider"):
+            providers.add(load.attach(template.provider))
         slots = 0
         for provider in providers:
             slots += provider.remaining_appliance_slots
@@ -1326,6 +1440,16 @@ class AppliancePool(MetadataMixin):
             self.id, self.group.id, self.total_count)
 
 
+def delete_metadata_entries(sender, instance, **kwargs):
+    instance.metadata_entries.delete()
+
+
+# Only for the models with metadata, a receiver for all models would disable fast deletes
+for metadata_model in [
+        DelayedProvisionTask, Provider, Group, GroupShepherd, Template, Appliance, AppliancePool]:
+    post_delete.connect(delete_metadata_entries, sender=metadata_model)
+
+
 class MismatchVersionMailer(models.Model):
     provider = models.ForeignKey(Provider, on_delete=models.CASCADE)
     template_name = models.CharField(max_length=64)
@@ -9,8 +9,8 @@ import random
 import re
 import command
 import yaml
+from collections import defaultdict
 from contextlib import closing
-from django.core.cache import cache
 from django.core.exceptions import ObjectDoesNotExist
 from django.core.mail import send_mail
 from django.db import transaction
@@ -21,6 +21,7 @@ from celery.exceptions import MaxRetriesExceededError
 from datetime import datetime, timedelta
 from functools import wraps
 from lxml import etree
+from time import time
 from novaclient.exceptions import OverLimit as OSOverLimit
 from paramiko import SSHException
 from urllib2 import urlopen, HTTPError
@@ -28,9 +29,10 @@ import socket
 
 from appliances.models import (
     Provider, Group, Template, Appliance, AppliancePool, DelayedProvisionTask,
-    MismatchVersionMailer, User, GroupShepherd)
+    MismatchVersionMailer, User, GroupShepherd, ProviderLoad)
 from sprout import settings, redis
 from sprout.irc_bot import send_message
+from sprout.locks import Lock
 from sprout.log import create_logger
 
 from utils import conf
@@ -43,7 +45,6 @@ from utils.version import Version
 from utils.wait import wait_for
 
 
-LOCK_EXPIRE = 60 * 15  # 15 minutes
 VERSION_REGEXPS = [
     r"^cfme-(\d)(\d)(\d)(\d)(\d{2})",  # 1.2.3.4.11
     # newer format
@@ -122,9 +123,12 @@ def singleton_task(*args, **kwargs):
             keys = sorted(kwargs.keys())
             digest_base += "//" + "/".join("{}={}".format(key, kwargs[key]) for key in keys)
             digest = hashlib.sha256(digest_base).hexdigest()
-            lock_id = '{0}-lock-{1}'.format(self.name, digest)
+            lock_id = '{0}[{1}]'.format(self.name, digest)
 
-            if cache.add(lock_id, 'true', LOCK_EXPIRE):
+            # The lock is leased and kept extended while the task runs, so a killed worker
+            # only blocks the task until the lease runs out
+            lock = Lock(redis.client, lock_id, timeout=0)
+            if lock.acquire():
                 try:
                     return task(self, *args, **kwargs)
                 except Exception as e:
@@ -134,7 +138,7 @@ def singleton_task(*args, **kwargs):
                     self.logger.exception(e)
                     raise
                 finally:
-                    cache.delete(lock_id)
+                    lock.release()
             elif wait:
                 self.logger.info("Waiting for another instance of the task to end.")
                 self.retry(args=args, countdown=wait_countdown, max_retries=wait_retries)
@@ -583,11 +587,13 @@ def request_appliance_pool(self, appliance_pool_id, time_minutes):
         "Appliance pool {} requested for {} minutes.".format(appliance_pool_id, time_minutes))
     pool = AppliancePool.objects.get(id=appliance_pool_id)
     n = Appliance.give_to_pool(pool)
+    load = ProviderLoad()
     for i in range(pool.total_count - n):
-        tpls = pool.possible_provisioning_templates
+        tpls = pool.provisioning_templates(load)
         if tpls:
             template_id = tpls[0].id
             clone_template_to_pool(template_id, pool.id, time_minutes)
+            load.add_appliance(tpls[0].provider_id)
         else:
             with transaction.atomic():
                 task = DelayedProvisionTask(pool=pool, lease_time=time_minutes)
@@ -630,6 +636,7 @@ def process_delayed_provision_tasks(self):
     Goes one task by one and when some of them can be provisioned, it starts the provisioning and
     then deletes the task.
     """
+    load = ProviderLoad()
     for task in DelayedProvisionTask.objects.order_by("id"):
         if task.pool.not_needed_anymore:
             task.delete()
@@ -638,7 +645,7 @@ def process_delayed_provision_tasks(self):
         appliances_given = Appliance.give_to_pool(task.pool, 1)
         if appliances_given == 0:
             # No free appliance in shepherd, so do it on our own
-            tpls = task.pool.possible_provisioning_templates
+            tpls = task.pool.provisioning_templates(load)
             if task.provider_to_avoid is not None:
                 filtered_tpls = filter(lambda tpl: tpl.provider != task.provider_to_avoid, tpls)
                 if filtered_tpls:
@@ -648,6 +655,7 @@ def process_delayed_provision_tasks(self):
                 # This will cause additional rejects until the provider quota is met
             if tpls:
                 clone_template_to_pool(tpls[0].id, task.pool.id, task.lease_time)
+                load.add_appliance(tpls[0].provider_id)
                 task.delete()
             else:
                 # Try freeing up some space in provider
@@ -1030,46 +1038,91 @@ def refresh_appliances(self):
         refresh_appliances_provider.delay(provider.id)
 
 
+def bulk_update(model, changes):
+    """Write the changed fields of many rows, with one UPDATE per distinct set of changes.
+
+    Args:
+        model: Model class of the rows
+        changes: dict of primary key -> dict of field name -> new value
+
+    Returns:
+        Number of rows updated
+    """
+    grouped = defaultdict(list)
+    for pk, fields in changes.iteritems():
+        if fields:
+            grouped[tuple(sorted(fields.iteritems()))].append(pk)
+    updated = 0
+    with transaction.atomic():
+        for fields, pks in grouped.iteritems():
+            # Keep under the query parameter limit of sqlite
+            for i in range(0, len(pks), 500):
+                updated += model.objects.filter(pk__in=pks[i:i + 500]).update(**dict(fields))
+    return updated
+
+
 @singleton_task(soft_time_limit=180)
 def refresh_appliances_provider(self, provider_id):
     """Downloads the list of VMs from the provider, then matches them by name or UUID with
     appliances stored in database.
+
+    Only the fields that changed are written, for all appliances at once.
     """
     self.logger.info("Refreshing appliances in {}".format(provider_id))
     provider = Provider.objects.get(id=provider_id)
     if not hasattr(provider.api, "all_vms"):
         # Ignore this provider
         return
+    start = time()
     vms = provider.api.all_vms()
+    listed = time()
     dict_vms = {}
     uuid_vms = {}
     for vm in vms:
         dict_vms[vm.name] = vm
         if vm.uuid:
             uuid_vms[vm.uuid] = vm
-    for appliance in Appliance.objects.filter(template__provider=provider):
-        if appliance.uuid is not None and appliance.uuid in uuid_vms:
-            vm = uuid_vms[appliance.uuid]
+    now = timezone.now()
+    changes = {}
+    appliances = Appliance.objects.filter(template__provider=provider).values_list(
+        "id", "name", "uuid", "ip_address", "power_state", "swap", "ssh_failed")
+    for appliance_id, name, uuid, ip_address, power_state, swap, ssh_failed in appliances:
+        new = {}
+        if uuid is not None and uuid in uuid_vms:
+            vm = uuid_vms[uuid]
             # Using the UUID and change the name if it changed
-            appliance.name = vm.name
-            appliance.ip_address = vm.ip
-            appliance.set_power_state(Appliance.POWER_STATES_MAPPING.get(
-                vm.power_state, Appliance.Power.UNKNOWN))
-            appliance.save()
-        elif appliance.name in dict_vms:
-            vm = dict_vms[appliance.name]
+            new.update(name=vm.name, ip_address=vm.ip)
+            new_power_state = Appliance.POWER_STATES_MAPPING.get(
+                vm.power_state, Appliance.Power.UNKNOWN)
+        elif name in dict_vms:
+            vm = dict_vms[name]
             # Using the name, and then retrieve uuid
-            appliance.uuid = vm.uuid
-            appliance.ip_address = vm.ip
-            appliance.set_power_state(Appliance.POWER_STATES_MAPPING.get(
-                vm.power_state, Appliance.Power.UNKNOWN))
-            appliance.save()
-            self.logger.info("Retrieved UUID for appliance {}/{}: {}".format(
-                appliance.id, appliance.name, appliance.uuid))
+            new.update(uuid=vm.uuid, ip_address=vm.ip)
+            if vm.uuid != uuid:
+                Appliance.class_logger(appliance_id).info(
+                    "Retrieved UUID for appliance {}/{}: {}".format(appliance_id, name, vm.uuid))
+            new_power_state = Appliance.POWER_STATES_MAPPING.get(
+                vm.power_state, Appliance.Power.UNKNOWN)
         else:
             # Orphaned :(
-            appliance.set_power_state(Appliance.Power.ORPHANED)
-            appliance.save()
+            new_power_state = Appliance.Power.ORPHANED
+        # What Appliance.set_power_state does
+        if new_power_state != power_state:
+            Appliance.class_logger(appliance_id).info(
+                "Changed power state to {}".format(new_power_state))
+            new.update(power_state=new_power_state, power_state_changed=now)
+            if new_power_state in Appliance.RESET_SWAP_STATES:
+                new.update(swap=0, ssh_failed=False)
+        current = dict(
+            name=name, uuid=uuid, ip_address=ip_address, power_state=power_state, swap=swap,
+            ssh_failed=ssh_failed, power_state_changed=None)
+        changes[appliance_id] = {
+            field: value for field, value in new.iteritems() if value != current[field]}
+    updated = bulk_update(Appliance, changes)
+    self.logger.info(
+        "Refreshed appliances in {}: {} VMs, {} appliances, {} updated; "
+        "listing took {:.2f}s, updating {:.2f}s".format(
+            provider_id, len(vms), len(changes), updated, listed - start, time() - listed))
 
 
 @singleton_task()
@@ -1083,34 +1136,34 @@ def check_templates(self):
 def check_templates_in_provider(self, provider_id):
     self.logger.info("Initiated a periodic template check for {}".format(provider_id))
     provider = Provider.objects.get(id=provider_id)
+    start = time()
     # Get templates and update metadata
     try:
         templates = map(str, provider.api.list_template())
     except:
-        provider.working = False
-        provider.save()
+        working = False
     else:
-        provider.working = True
-        provider.save()
-        with provider.edit_metadata as metadata:
-            metadata["templates"] = templates
-    if not provider.working:
+        working = True
+        if templates != provider.templates:
+            provider.templates = templates
+    if working != provider.working:
+        provider.working = working
+        provider.save(update_fields=["working"])
+    if not working:
         return
-    # Check Sprout template existence
-    # expiration_time = (timezone.now() - timedelta(**settings.BROKEN_APPLIANCE_GRACE_TIME))
-    for template in Template.objects.filter(provider=provider):
-        with transaction.atomic():
-            tpl = Template.objects.get(pk=template.pk)
-            exists = tpl.name in templates
-            tpl.exists = exists
-            tpl.save()
-        # if not exists:
-        #     if len(Appliance.objects.filter(template=template).all()) == 0\
-        #             and template.status_changed < expiration_time:
-        #         # No other appliance is made from this template so no need to keep it
-        #         with transaction.atomic():
-        #             tpl = Template.objects.get(pk=template.pk)
-        #             tpl.delete()
+    listed = time()
+    # Check Sprout template existence, only the templates whose existence changed are written
+    templates = set(templates)
+    rows = Template.objects.filter(provider=provider).values_list("id", "name", "exists")
+    changes = {
+        template_id: {"exists": name in templates}
+        for template_id, name, exists in rows
+        if exists != (name in templates)}
+    updated = bulk_update(Template, changes)
+    self.logger.info(
+        "Checked templates in {}: {} on provider, {} in Sprout, {} updated; "
+        "listing took {:.2f}s, updating {:.2f}s".format(
+            provider_id, len(templates), len(rows), updated, listed - start, time() - listed))
 
 
 @singleton_task()
@@ -1118,7 +1171,7 @@ def delete_nonexistent_appliances(self):
     """Goes through orphaned appliances' objects and deletes them from the database."""
     expiration_time = (timezone.now() - timedelta(**settings.ORPHANED_APPLIANCE_GRACE_TIME))
     for appliance in Appliance.objects.filter(ready=True).all():
-        if appliance.name in redis.renaming_appliances:
+        if redis.is_renaming(appliance.name):
             continue
         if appliance.power_state == Appliance.Power.ORPHANED:
             if appliance.power_state_changed > expiration_time:
@@ -1161,6 +1214,7 @@ def generic_shepherd(self, preconfigured):
     appliances. For each template group, it keeps the last template's appliances spinned up in
     required quantity. If new template comes out of the door, it automatically kills the older
     running template's appliances and spins up new ones. Sorts the groups by the fulfillment."""
+    load = ProviderLoad()
     for gs in sorted(
             GroupShepherd.objects.all(), key=lambda g: g.get_fulfillment_percentage(preconfigured)):
         prov_filter = {'provider__user_groups': gs.user_group}
@@ -1204,7 +1258,7 @@ def generic_shepherd(self, preconfigured):
         possible_templates = list(
             Template.objects.filter(
                 usable=True, ready=True, template_group=gs.template_group,
-                preconfigured=preconfigured, **filter_keep).all())
+                preconfigured=preconfigured, **filter_keep).select_related("provider").all())
         # If it can be deployed, it must exist
         possible_templates_for_provision = filter(lambda tpl: tpl.exists, possible_templates)
         appliances = []
@@ -1227,13 +1281,14 @@ def generic_shepherd(self, preconfigured):
             with transaction.atomic():
                 # Now look for templates that are on non-busy providers
                 tpl_free = filter(
-                    lambda t: t.provider.free,
+                    lambda t: load.attach(t.provider).free,
                     possible_templates_for_provision)
                 if tpl_free:
                     appliance = Appliance(
                         template=sorted(tpl_free, key=lambda t: t.provider.appliance_load)[0],
                         name=new_appliance_name)
                     appliance.save()
+                    load.add_appliance(appliance.template.provider_id)
             if tpl_free:
                 self.logger.info(
                     "Adding an appliance to shepherd: {}/{}".format(appliance.id, appliance.name))
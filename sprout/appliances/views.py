@@ -18,7 +18,7 @@ from django.shortcuts import render, redirect
 from appliances.api import json_response
 from appliances.models import (
     Provider, AppliancePool, Appliance, Group, Template, MismatchVersionMailer, User, BugQuery,
-    GroupShepherd)
+    GroupShepherd, ProviderLoad)
 from appliances.tasks import (appliance_power_on, appliance_power_off, appliance_suspend,
     anyvm_power_on, anyvm_power_off, anyvm_suspend, anyvm_delete, delete_template_from_provider,
     appliance_rename, wait_appliance_ready, mark_appliance_ready, appliance_reboot)
@@ -314,7 +314,10 @@ def providers_for_date_group_and_version(request):
             providers = Template.objects.filter(
                 container_q, **filters).values("provider").distinct()
             providers = sorted([p.values()[0] for p in providers])
-            providers = [Provider.objects.get(id=provider) for provider in providers]
+            load = ProviderLoad()
+            providers = [
+                load.attach(provider)
+                for provider in Provider.objects.filter(id__in=providers).order_by("id")]
             for provider in providers:
                 appl_filter = dict(
                     appliance_pool=None, ready=True, template__provider=provider,
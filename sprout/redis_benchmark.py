@@ -0,0 +1,130 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+"""Sprout Redis state contention benchmark
+
+Measures how many state operations Sprout's workers get through when many of them hit Redis at
+once, with the per-key :py:class:`sprout.RedisWrapper` and with the single global lock it used
+to take around every operation.
+
+Every worker process runs the operations of the tasks that touch the state the most:
+
+- ``delete_nonexistent_appliances`` checks every appliance against the renamed appliances
+- ``appliance_rename`` marks two appliances as being renamed while it renames them
+- the ``sprout-needs-update`` flag and the bug query cache are read and written
+
+The global lock is emulated in Redis, polled every 0.3 s like the old cache lock was, so only
+a local Redis is needed. Run it from the sprout directory::
+
+    python redis_benchmark.py --workers 16 --seconds 10
+
+"""
+import argparse
+import random
+from contextlib import contextmanager
+from multiprocessing import Process, Queue
+from time import sleep, time
+
+from redis import StrictRedis
+
+from sprout import RedisWrapper
+
+
+class GlobalLockRedisWrapper(RedisWrapper):
+    """The wrapper as it was, serializing every operation on one polled lock"""
+    @contextmanager
+    def atomic(self):
+        while not self.client.set("benchmark-redis-atomic", "true", nx=True, ex=self.LOCK_EXPIRE):
+            sleep(0.3)
+        try:
+            yield self
+        finally:
+            self.client.delete("benchmark-redis-atomic")
+
+    def set(self, key, value, *args, **kwargs):
+        with self.atomic():
+            return self._set(key, value, *args, **kwargs)
+
+    def get(self, key, *args, **kwargs):
+        with self.atomic():
+            return self._get(key, *args, **kwargs)
+
+    @contextmanager
+    def appliances_ignored_when_renaming(self, *appliances):
+        with self.atomic() as client:
+            ignored_appliances = client._get("benchmark-renaming-appliances") or set()
+            ignored_appliances.update(appliances)
+            client._set("benchmark-renaming-appliances", ignored_appliances)
+        yield
+        with self.atomic() as client:
+            ignored_appliances = client._get("benchmark-renaming-appliances") or set()
+            ignored_appliances.difference_update(appliances)
+            client._set("benchmark-renaming-appliances", ignored_appliances)
+
+    def is_renaming(self, appliance):
+        return appliance in (self.get("benchmark-renaming-appliances") or set())
+
+
+wrappers = {
+    'global-lock': GlobalLockRedisWrapper,
+    'per-key': RedisWrapper,
+}
+
+
+def worker(wrapper_name, redis_kwargs, appliances, seconds, results):
+    redis = wrappers[wrapper_name](StrictRedis(**redis_kwargs))
+    operations = 0
+    end = time() + seconds
+    while time() < end:
+        choice = random.random()
+        if choice < 0.5:
+            # delete_nonexistent_appliances
+            for appliance in appliances:
+                redis.is_renaming(appliance)
+            operations += len(appliances)
+        elif choice < 0.7:
+            # appliance_rename
+            old, new = random.sample(appliances, 2)
+            with redis.appliances_ignored_when_renaming(old, new):
+                operations += 2
+        else:
+            redis.set("benchmark-needs-update", random.random() < 0.5)
+            redis.get("benchmark-needs-update")
+            operations += 2
+    results.put(operations)
+
+
+def run(wrapper_name, redis_kwargs, workers, appliances, seconds):
+    """Run ``workers`` processes for ``seconds``, return the operations done per second"""
+    results = Queue()
+    processes = [
+        Process(target=worker, args=(wrapper_name, redis_kwargs, appliances, seconds, results))
+        for _ in range(workers)]
+    start = time()
+    for process in processes:
+        process.start()
+    operations = sum(results.get() for _ in processes)
+    for process in processes:
+        process.join()
+    return operations / (time() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--workers', type=int, default=16, help='number of worker processes')
+    parser.add_argument('--appliances', type=int, default=200, help='number of appliances')
+    parser.add_argument('--seconds', type=float, default=10, help='how long to run each setting')
+    parser.add_argument('--host', default='127.0.0.1', help='Redis host')
+    parser.add_argument('--port', type=int, default=6379, help='Redis port')
+    parser.add_argument('--db', type=int, default=15, help='Redis database to use')
+    args = parser.parse_args()
+
+    redis_kwargs = dict(host=args.host, port=args.port, db=args.db)
+    appliances = ['appliance-{}'.format(i) for i in range(args.appliances)]
+    print('{} workers, {} appliances'.format(args.workers, args.appliances))
+    for wrapper_name in sorted(wrappers):
+        ops = run(wrapper_name, redis_kwargs, args.workers, appliances, args.seconds)
+        print('{:12} {:12.0f} operations/s'.format(wrapper_name, ops))
+
+
+if __name__ == '__main__':
+    main()
@@ -8,11 +8,10 @@ except ImportError:
 from .celery import app as celery_app
 assert celery_app
 
-from django.core.cache import cache
 from sprout import settings
+from sprout.locks import Lock
 from redis import StrictRedis
 from utils.path import project_path
-from utils.wait import wait_for
 
 redis_client = StrictRedis(**settings.GENERAL_REDIS)
 
@@ -22,21 +21,40 @@ CRITICAL_SECTION_LOCK_TIME = 60
 
 @contextmanager
 def critical_section(name):
-    wait_for(
-        cache.add,
-        ["lock-{}".format(name), 'true', CRITICAL_SECTION_LOCK_TIME],
-        delay=0.3, num_sec=2 * CRITICAL_SECTION_LOCK_TIME)
-    try:
+    """Run the block holding the lock ``name``, see :py:class:`sprout.locks.Lock`
+
+    Waiters get the lock in the order they asked for it; one that doesn't get it in
+    twice :py:data:`CRITICAL_SECTION_LOCK_TIME` raises :py:class:`utils.wait.TimedOutError`.
+    """
+    with Lock(redis_client, name, timeout=2 * CRITICAL_SECTION_LOCK_TIME):
         yield
-    finally:
-        cache.delete("lock-{}".format(name))
 
 
 class RedisWrapper(object):
+    """Sprout's state in Redis
+
+    Values are pickled and stored under their keys; reading, writing or deleting one value is a
+    single Redis command, so it needs no locking. State that several workers change at once is
+    kept in native Redis types and changed with single commands or Lua scripts, so workers only
+    ever wait for each other on the same key.
+    """
     LOCK_EXPIRE = 60
+    #: Hash of appliance name -> number of renames the appliance takes part in
+    RENAMING_APPLIANCES = "renaming-appliances"
+
+    # KEYS[1]: hash, ARGV: names to stop counting as renamed
+    FORGET_RENAMING = """
+        for i, name in ipairs(ARGV) do
+            if redis.call("hincrby", KEYS[1], name, -1) <= 0 then
+                redis.call("hdel", KEYS[1], name)
+            end
+        end
+        return 1
+    """
 
     def __init__(self, client):
         self.client = client
+        self._forget_renaming = client.register_script(self.FORGET_RENAMING)
 
     def _set(self, key, value, *args, **kwargs):
         return self.client.set(str(key), pickle.dumps(value), *args, **kwargs)
@@ -48,54 +66,58 @@ class RedisWrapper(object):
             return default
         return pickle.loads(result)
 
+    @contextmanager
+    def lock(self, name, expire=None, timeout=None):
+        """Hold a lock in Redis, see :py:class:`sprout.locks.Lock`
+
+        Args:
+            name: Name of the lock
+            expire: Seconds the lock is leased for at a time, defaults to :py:attr:`LOCK_EXPIRE`
+            timeout: Seconds to wait for the lock, defaults to twice the lease
+
+        Raises:
+            :py:class:`utils.wait.TimedOutError` when the lock wasn't acquired in time
+        """
+        expire = expire or self.LOCK_EXPIRE
+        with Lock(self.client, name, timeout=timeout or 2 * expire, lease=expire):
+            yield
+
     @contextmanager
     def atomic(self):
-        wait_for(
-            cache.add,
-            ["redis-atomic", 'true', self.LOCK_EXPIRE],
-            delay=0.3, num_sec=2 * self.LOCK_EXPIRE)
-        try:
+        """Hold the global lock, only needed to make several operations atomic together"""
+        with self.lock("redis-atomic", self.LOCK_EXPIRE):
             yield self
-        finally:
-            cache.delete("redis-atomic")
 
     def set(self, key, value, *args, **kwargs):
-        with self.atomic():
-            return self._set(key, value, *args, **kwargs)
+        return self._set(key, value, *args, **kwargs)
 
     def get(self, key, *args, **kwargs):
-        with self.atomic():
-            return self._get(key, *args, **kwargs)
+        return self._get(key, *args, **kwargs)
 
     def delete(self, key, *args, **kwargs):
-        with self.atomic():
-            return self.client.delete(key, *args, **kwargs)
+        return self.client.delete(key, *args, **kwargs)
 
     @contextmanager
     def appliances_ignored_when_renaming(self, *appliances):
-        with self.atomic() as client:
-            ignored_appliances = client._get("renaming_appliances")
-            if ignored_appliances is None:
-                ignored_appliances = set([])
-            for appliance in appliances:
-                ignored_appliances.add(appliance)
-            client._set("renaming_appliances", ignored_appliances)
-        yield
-        with self.atomic() as client:
-            ignored_appliances = client._get("renaming_appliances")
-            if ignored_appliances is None:
-                ignored_appliances = set([])
+        if not appliances:
+            yield
+            return
+        with self.client.pipeline() as pipe:
             for appliance in appliances:
-                try:
-                    ignored_appliances.remove(appliance)
-                except KeyError:
-                    # Something worng happened, ignore
-                    pass
-            client._set("renaming_appliances", ignored_appliances)
+                pipe.hincrby(self.RENAMING_APPLIANCES, appliance, 1)
+            pipe.execute()
+        try:
+            yield
+        finally:
+            self._forget_renaming(keys=[self.RENAMING_APPLIANCES], args=list(appliances))
+
+    def is_renaming(self, appliance):
+        """Whether the appliance of this name takes part in a rename"""
+        return self.client.hexists(self.RENAMING_APPLIANCES, appliance)
 
     @property
     def renaming_appliances(self):
-        return self.get("renaming_appliances") or set([])
+        return set(self.client.hkeys(self.RENAMING_APPLIANCES))
 
 
 redis = RedisWrapper(redis_client)
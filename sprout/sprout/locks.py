@@ -0,0 +1,245 @@
+# -*- coding: utf-8 -*-
+"""Distributed locks in Redis
+
+A :py:class:`Lock` is held under a random owner token, so only its owner can extend or release
+it. The lock is leased for a short time and a thread of the holder keeps extending the lease
+while the holder runs, so a lock is never lost by an owner that's still inside, and is freed
+soon after an owner that died.
+
+Waiters queue up in a Redis list and the lock goes to them in order. A waiter that times out
+leaves the queue; one that dies stops refreshing its presence key and is dropped from the queue
+by the next waiter trying to acquire the lock. Waiters sleep on a pub/sub channel the holder
+publishes to when it releases the lock.
+
+How long locks are waited for and held is summed up in the ``lock-stats`` Redis hash, see
+:py:func:`lock_statistics`. Locks on single objects are counted together under the name without
+the object's id, e.g. ``kill-(Appliance)`` for ``kill-(Appliance)[123]``.
+"""
+from __future__ import absolute_import
+
+import re
+from collections import defaultdict
+from threading import Event, Thread
+from time import time
+from uuid import uuid4
+
+from sprout.log import create_logger
+from utils.wait import TimedOutError
+
+#: Seconds a lock is leased for, the holder extends the lease every third of it
+LOCK_LEASE = 30
+#: Seconds a waiter stays in the queue without refreshing its presence
+WAITER_LEASE = 10
+#: Hash with the statistics of all locks
+LOCK_STATS = "lock-stats"
+
+# KEYS[1]: lock, KEYS[2]: queue, ARGV[1]: token, ARGV[2]: lease in ms, ARGV[3]: waiter prefix
+ACQUIRE = """
+while true do
+    local head = redis.call("lindex", KEYS[2], 0)
+    if not head or head == ARGV[1] or redis.call("exists", ARGV[3] .. head) == 1 then
+        break
+    end
+    -- the waiter is gone
+    redis.call("lpop", KEYS[2])
+end
+local head = redis.call("lindex", KEYS[2], 0)
+if head and head ~= ARGV[1] then
+    return 0
+end
+if not redis.call("set", KEYS[1], ARGV[1], "NX", "PX", ARGV[2]) then
+    return 0
+end
+if head then
+    redis.call("lpop", KEYS[2])
+end
+return 1
+"""
+
+# KEYS[1]: lock, ARGV[1]: token, ARGV[2]: lease in ms
+EXTEND = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("pexpire", KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+# KEYS[1]: lock, ARGV[1]: token, ARGV[2]: channel
+RELEASE = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    redis.call("del", KEYS[1])
+    redis.call("publish", ARGV[2], ARGV[1])
+    return 1
+end
+return 0
+"""
+
+# KEYS[1]: stats hash, ARGV[1]: lock name, ARGV[2]: field, ARGV[3]: value
+RECORD_MAX = """
+local field = ARGV[1] .. ":" .. ARGV[2]
+local current = tonumber(redis.call("hget", KEYS[1], field))
+if not current or current < tonumber(ARGV[3]) then
+    redis.call("hset", KEYS[1], field, ARGV[3])
+end
+return 1
+"""
+
+_object_id = re.compile(r'\[[^\]]*\]$')
+
+
+def stats_name(name):
+    """Name a lock is counted under in the statistics"""
+    return _object_id.sub('', name)
+
+
+class Lock(object):
+    """A lock in Redis, see the module docs
+
+    Usable as a context manager, or through :py:meth:`acquire` and :py:meth:`release`.
+
+    Args:
+        client: :py:class:`redis.StrictRedis` client
+        name: Name of the lock
+        timeout: Seconds to wait for the lock; ``0`` only tries once and doesn't queue up
+        lease: Seconds the lock is leased for at a time
+    """
+    def __init__(self, client, name, timeout=None, lease=LOCK_LEASE):
+        self.client = client
+        self.name = name
+        self.timeout = timeout
+        self.lease = lease
+        self.key = "lock-{}".format(name)
+        self.queue = "lock-queue-{}".format(name)
+        self.channel = "lock-released-{}".format(name)
+        self.token = None
+        self.acquired_at = None
+        self._stop_extending = Event()
+        self._extender = None
+
+    @property
+    def logger(self):
+        return create_logger(self)
+
+    def _script(self, source):
+        # register_script only hashes the source, the script is loaded on its first use
+        return self.client.register_script(source)
+
+    def acquire(self):
+        """Acquire the lock
+
+        Returns: ``True`` when acquired, ``False`` when it couldn't be acquired at once with
+            ``timeout`` of ``0``
+
+        Raises:
+            :py:class:`utils.wait.TimedOutError` when the lock wasn't acquired in ``timeout``
+        """
+        token = uuid4().hex
+        acquire = self._script(ACQUIRE)
+        lease_ms = int(self.lease * 1000)
+        waiter_prefix = "lock-waiter-{}-".format(self.name)
+        start = time()
+        if self.timeout == 0:
+            if not acquire(keys=[self.key, self.queue], args=[token, lease_ms, waiter_prefix]):
+                return False
+        else:
+            self._wait(token, acquire, lease_ms, waiter_prefix, start)
+        self.token = token
+        self.acquired_at = time()
+        self._record(wait=self.acquired_at - start)
+        self._stop_extending.clear()
+        self._extender = Thread(target=self._extend, name="lock-{}".format(self.name))
+        self._extender.daemon = True
+        self._extender.start()
+        return True
+
+    def _wait(self, token, acquire, lease_ms, waiter_prefix, start):
+        waiter = waiter_prefix + token
+        pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+        # subscribe first, so no release goes unnoticed
+        pubsub.subscribe(self.channel)
+        try:
+            self.client.set(waiter, 1, ex=WAITER_LEASE)
+            self.client.rpush(self.queue, token)
+            while not acquire(keys=[self.key, self.queue], args=[token, lease_ms, waiter_prefix]):
+                remaining = None if self.timeout is None else start + self.timeout - time()
+                if remaining is not None and remaining <= 0:
+                    self.client.lrem(self.queue, 0, token)
+                    # let the next one in the queue have a go
+                    self.client.publish(self.channel, token)
+                    raise TimedOutError(
+                        "Could not acquire lock {} in {}s".format(self.name, self.timeout))
+                # wake up in time to stay in the queue, or to give up
+                wait = WAITER_LEASE / 3.0
+                if remaining is not None:
+                    wait = min(wait, remaining)
+                pubsub.get_message(timeout=wait)
+                self.client.set(waiter, 1, ex=WAITER_LEASE)
+        finally:
+            self.client.delete(waiter)
+            pubsub.close()
+
+    def _extend(self):
+        extend = self._script(EXTEND)
+        lease_ms = int(self.lease * 1000)
+        while not self._stop_extending.wait(self.lease / 3.0):
+            try:
+                extended = extend(keys=[self.key], args=[self.token, lease_ms])
+            except Exception as e:
+                self.logger.warning("Could not extend lock %s: %s", self.name, e)
+                continue
+            if not extended:
+                self.logger.error("Lock %s was lost while held", self.name)
+                self.client.hincrby(LOCK_STATS, "{}:lost".format(stats_name(self.name)), 1)
+                return
+
+    def release(self):
+        """Release the lock, if it is still held"""
+        if self.token is None:
+            return
+        self._stop_extending.set()
+        if self._extender is not None:
+            self._extender.join()
+            self._extender = None
+        try:
+            self._script(RELEASE)(keys=[self.key], args=[self.token, self.channel])
+        finally:
+            self._record(hold=time() - self.acquired_at)
+            self.token = None
+            self.acquired_at = None
+
+    def _record(self, wait=None, hold=None):
+        """Add one wait or hold time of the lock to the statistics"""
+        name = stats_name(self.name)
+        kind, seconds = ("wait", wait) if wait is not None else ("hold", hold)
+        try:
+            with self.client.pipeline(transaction=False) as pipe:
+                pipe.hincrby(LOCK_STATS, "{}:{}_count".format(name, kind), 1)
+                pipe.hincrbyfloat(LOCK_STATS, "{}:{}_total".format(name, kind), seconds)
+                pipe.execute()
+            self._script(RECORD_MAX)(
+                keys=[LOCK_STATS], args=[name, "{}_max".format(kind), seconds])
+        except Exception as e:
+            # statistics are not worth failing the locked work for
+            self.logger.warning("Could not record lock statistics of %s: %s", self.name, e)
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+
+def lock_statistics(client):
+    """Statistics of the locks
+
+    Returns:
+        dict of lock name -> dict of ``wait_count``, ``wait_total``, ``wait_max``,
+        ``hold_count``, ``hold_total``, ``hold_max`` and ``lost`` (leases lost while held),
+        times in seconds
+    """
+    stats = defaultdict(dict)
+    for field, value in client.hgetall(LOCK_STATS).iteritems():
+        name, stat = field.rsplit(":", 1)
+        stats[name][stat] = float(value) if "." in value else int(value)
+    return dict(stats)
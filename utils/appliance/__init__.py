@@ -1816,7 +1816,7 @@ class IPAppliance(object):
     @cached_property
     def db(self):
         # slightly crappy: anything that changes self.db_address should also del(self.db)
-        return db.Db(self.db_address)
+        return db.Db(self.db_address, appliance_version=self.version)
 
     @property
     def is_db_enabled(self):
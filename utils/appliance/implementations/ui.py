@@ -1,11 +1,13 @@
 # -*- coding: utf-8 -*-
 import json
 import time
+from collections import OrderedDict
+from uuid import uuid4
 from jsmin import jsmin
 
 from utils.log import logger, create_sublogger
 from cfme import exceptions
-from cfme.fixtures.pytest_selenium import get_rails_error
+from cfme.fixtures.pytest_selenium import get_rails_error, wait_for_quiet_page
 from time import sleep
 
 from navmazing import Navigate, NavigateStep
@@ -21,35 +23,10 @@ from cached_property import cached_property
 from widgetastic.browser import Browser, DefaultPlugin
 from widgetastic.utils import VersionPick
 from utils.version import Version
-from utils.wait import wait_for
 VersionPick.VERSION_CLASS = Version
 
 
 class MiqBrowserPlugin(DefaultPlugin):
-    ENSURE_PAGE_SAFE = jsmin('''\
-        function isHidden(el) {if(el === null) return true; return el.offsetParent === null;}
-
-        try {
-            angular.element('error-modal').hide();
-        } catch(err) {
-        }
-
-        try {
-            return ! ManageIQ.qe.anythingInFlight();
-        } catch(err) {
-            return (
-                ((typeof $ === "undefined") ? true : $.active < 1) &&
-                (
-                    !((!isHidden(document.getElementById("spinner_div"))) &&
-                    isHidden(document.getElementById("lightbox_div")))) &&
-                document.readyState == "complete" &&
-                ((typeof checkMiqQE === "undefined") ? true : checkMiqQE('autofocus') < 1) &&
-                ((typeof checkMiqQE === "undefined") ? true : checkMiqQE('debounce') < 1) &&
-                ((typeof checkAllMiqQE === "undefined") ? true : checkAllMiqQE() < 1)
-            );
-        }
-        ''')
-
     OBSERVED_FIELD_MARKERS = (
         'data-miq_observe',
         'data-miq_observe_date',
@@ -57,15 +34,21 @@ class MiqBrowserPlugin(DefaultPlugin):
     )
     DEFAULT_WAIT = .8
 
-    def ensure_page_safe(self, timeout='10s'):
+    def ensure_page_safe(self, timeout=10):
         # THIS ONE SHOULD ALWAYS USE JAVASCRIPT ONLY, NO OTHER SELENIUM INTERACTION
-
-        def _check():
-            result = self.browser.execute_script(self.ENSURE_PAGE_SAFE, silent=True)
-            # TODO: Logging
-            return bool(result)
-
-        wait_for(_check, timeout=timeout, delay=0.2, silent_failure=True, very_quiet=True)
+        # The waiting happens in the browser, see wait_for_quiet_page
+        try:
+            result = wait_for_quiet_page(self.browser.selenium, timeout)
+        except UnexpectedAlertPresentException:
+            raise
+        except WebDriverException as e:
+            # e.g. the page was reloaded while waiting, the new one is checked the next time
+            self.logger.debug('could not wait for a quiet page: %s', e)
+            return
+        if result.get('error'):
+            self.logger.debug('could not check the page: %s', result['error'])
+        elif not result.get('quiet'):
+            self.logger.debug('page still not quiet after %ss', timeout)
 
     def after_keyboard_input(self, element, keyboard_input):
         observed_field_attr = None
@@ -120,6 +103,103 @@ class MiqBrowser(Browser):
         return self.appliance.version
 
 
+class NavigationPlanner(object):
+    """Keeps track of where the browser was left by navigation, and of the URLs of destinations
+
+    The location of the browser is a destination (the name of a navigation step and the object
+    it was navigated for) and a token stored in the page. The page forgets the token on any
+    click, key press, change or form submission, and on any page load, so while the token is
+    still there and the URL hasn't changed, the browser is known to be where the last navigation
+    left it, without probing the page with :py:meth:`CFMENavigateStep.am_i_here`.
+
+    The URLs the destinations were reached at are kept as well, so later navigations to the same
+    destination can try loading the URL instead of clicking their way through all of the
+    prerequisite steps, if the step allows it with :py:attr:`CFMENavigateStep.URL_JUMP`. A URL
+    that didn't lead to the destination isn't tried again.
+
+    Objects are told apart by identity, not equality, as equal objects may still be different
+    things in the UI (e.g. objects of the same name under different parents).
+
+    Args:
+        size: How many destination URLs to remember
+    """
+    MARK_LOCATION = jsmin('''\
+        window.cfmeNavLocation = arguments[0];
+        if(!window.cfmeNavLocationHooked) {
+            window.cfmeNavLocationHooked = true;
+            ["click", "keydown", "change", "submit"].forEach(function(type) {
+                document.addEventListener(type, function() {
+                    window.cfmeNavLocation = null;
+                }, true);
+            });
+        }
+        return window.location.href;
+        ''')
+
+    CHECK_LOCATION = jsmin('''\
+        return window.cfmeNavLocation === arguments[0] && window.location.href === arguments[1];
+        ''')
+
+    def __init__(self, size=256):
+        self.size = size
+        # (step name, obj, token, url) of the last navigation in the current browser
+        self.location = None
+        # (step name, id(obj)) -> (obj, url)
+        self.urls = OrderedDict()
+        self.bad_urls = set()
+
+    def reset(self):
+        """Forget the location, when the browser goes away"""
+        self.location = None
+
+    def is_at(self, step):
+        """Whether the browser is still where the last navigation to ``step``'s destination left it
+        """
+        if self.location is None:
+            return False
+        name, obj, token, url = self.location
+        if name != step._name or obj is not step.obj:
+            return False
+        try:
+            return bool(step.appliance.browser.widgetastic.execute_script(
+                self.CHECK_LOCATION, token, url, silent=True))
+        except Exception:  # Diaper OK, any failure means the page has to be checked
+            return False
+
+    def arrived(self, step):
+        """Record the browser being at ``step``'s destination, and the destination's URL"""
+        token = '{}:{}'.format(step._name, uuid4())
+        try:
+            url = step.appliance.browser.widgetastic.execute_script(
+                self.MARK_LOCATION, token, silent=True)
+        except Exception:  # Diaper OK, the location just stays unknown
+            self.location = None
+            return
+        self.location = (step._name, step.obj, token, url)
+        key = (step._name, id(step.obj))
+        if (key, url) in self.bad_urls:
+            return
+        self.urls.pop(key, None)
+        self.urls[key] = (step.obj, url)
+        while len(self.urls) > self.size:
+            self.urls.popitem(last=False)
+
+    def known_url(self, step):
+        """The URL ``step``'s destination was last reached at, ``None`` if it isn't known"""
+        key = (step._name, id(step.obj))
+        obj, url = self.urls.get(key, (None, None))
+        if obj is not step.obj:
+            # id of a collected object reused
+            return None
+        return url
+
+    def forget_url(self, step, url):
+        """Stop trying ``url`` for ``step``'s destination"""
+        key = (step._name, id(step.obj))
+        self.urls.pop(key, None)
+        self.bad_urls.add((key, url))
+
+
 def can_skip_badness_test(fn):
     """Decorator for setting a noop"""
     fn._can_skip_badness_test = True
@@ -128,6 +208,10 @@ def can_skip_badness_test(fn):
 
 class CFMENavigateStep(NavigateStep):
     VIEW = None
+    #: Whether the destination may be reached by loading the URL it was reached at before,
+    #: see :py:class:`NavigationPlanner`. Only turn it on for destinations whose URL identifies
+    #: them, many explorer pages keep the same URL whatever is selected in the tree.
+    URL_JUMP = False
 
     @cached_property
     def view(self):
@@ -357,8 +441,34 @@ class CFMENavigateStep(NavigateStep):
         str_msg = "[UI-NAV/{}/{}]: {}".format(self.obj.__class__.__name__, self._name, msg)
         getattr(logger, level)(str_msg)
 
-    def construst_message(self, here, resetter, view, duration):
-        str_here = "Already Here" if here else "Needed Navigation"
+    def jump(self, planner, _tries, nav_args, *args, **kwargs):
+        """Try to reach the destination by loading its known URL
+
+        Returns: whether the destination was reached
+        """
+        url = planner.known_url(self)
+        if url is None or not self.URL_JUMP or self.VIEW is None:
+            return False
+        self.log_message("Jumping to {}".format(url))
+        try:
+            browser = self.appliance.browser.widgetastic
+            browser.selenium.get(url)
+            browser.plugin.ensure_page_safe()
+            here = self.check_for_badness(self.am_i_here, _tries, nav_args, *args, **kwargs)
+        except Exception as e:
+            self.log_message(
+                "Exception raised [{}] whilst jumping to {}".format(e, url), level="error")
+            here = False
+        if not here:
+            self.log_message("Jump to {} did not reach the destination".format(url))
+            planner.forget_url(self, url)
+        return here
+
+    def construst_message(self, here, resetter, view, duration, jumped=False):
+        if jumped:
+            str_here = "Jumped By URL"
+        else:
+            str_here = "Already Here" if here else "Needed Navigation"
         str_resetter = "Resetter Used" if resetter else "No Resetter"
         str_view = "View Returned" if view else "No View Available"
         return "{}/{}/{} (elapsed {}ms)".format(str_here, str_resetter, str_view, duration)
@@ -378,13 +488,23 @@ class CFMENavigateStep(NavigateStep):
             if arg in kwargs:
                 nav_args[arg] = kwargs.pop(arg)
         self.check_for_badness(self.pre_navigate, _tries, nav_args, *args, **kwargs)
+        # destinations are only tracked when they only depend on the object
+        planner = None if args or kwargs else self.appliance.browser.planner
         here = False
+        jumped = False
         resetter_used = False
-        try:
-            here = self.check_for_badness(self.am_i_here, _tries, nav_args, *args, **kwargs)
-        except Exception as e:
-            self.log_message(
-                "Exception raised [{}] whilst checking if already here".format(e), level="error")
+        if planner is not None and planner.is_at(self):
+            here = True
+            self.log_message("Still here since the last navigation")
+        else:
+            try:
+                here = self.check_for_badness(self.am_i_here, _tries, nav_args, *args, **kwargs)
+            except Exception as e:
+                self.log_message(
+                    "Exception raised [{}] whilst checking if already here".format(e),
+                    level="error")
+        if not here and planner is not None:
+            jumped = here = self.jump(planner, _tries, nav_args, *args, **kwargs)
         if not here:
             self.log_message("Prerequiesite Needed")
             self.prerequisite_view = self.prerequisite()
@@ -393,9 +513,12 @@ class CFMENavigateStep(NavigateStep):
             resetter_used = True
             self.check_for_badness(self.resetter, _tries, nav_args, *args, **kwargs)
         self.check_for_badness(self.post_navigate, _tries, nav_args, *args, **kwargs)
+        if planner is not None:
+            planner.arrived(self)
         view = self.view if self.VIEW is not None else None
         duration = int((time.time() - start_time) * 1000)
-        self.log_message(self.construst_message(here, resetter_used, view, duration), level="info")
+        self.log_message(
+            self.construst_message(here, resetter_used, view, duration, jumped), level="info")
         return view
 
 
@@ -411,6 +534,7 @@ class ViaUI(object):
     # ** little. It's more an organizational level thing.
     def __init__(self, owner):
         self.owner = owner
+        self.planner = NavigationPlanner()
 
     @property
     def appliance(self):
@@ -429,9 +553,11 @@ class ViaUI(object):
         return manager.ensure_open(url_key=None)
 
     def quit_browser(self):
+        self.planner.reset()
         manager.quit()
 
     def _reset_cache(self):
+        self.planner.reset()
         try:
             del self.widgetastic
         except AttributeError:
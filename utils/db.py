@@ -1,34 +1,63 @@
+import cPickle as pickle
+import os
+import re
 from collections import Mapping
 from contextlib import contextmanager
 from itertools import izip
+from tempfile import NamedTemporaryFile
 
+import sqlalchemy
 from cached_property import cached_property
-from sqlalchemy import MetaData, create_engine, event, inspect
-from sqlalchemy.exc import ArgumentError, DisconnectionError, InvalidRequestError
+from sqlalchemy import MetaData, create_engine, event, select
+from sqlalchemy.exc import ArgumentError, DBAPIError, InvalidRequestError
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
-from sqlalchemy.pool import Pool
+from sqlalchemy.orm import scoped_session, sessionmaker
 
 from fixtures.pytest_store import store
 from utils import conf, ports
 from utils.log import logger
+from utils.path import project_path
 
+#: Where reflected schemas are stored, by appliance version and schema migration version
+SCHEMA_CACHE_DIR = project_path.join('.cache', 'db_schema')
 
-@event.listens_for(Pool, "checkout")
-def ping_connection(dbapi_connection, connection_record, connection_proxy):
-    """ping_connection event hook, used to reconnect db sessions that time out
+#: Connections kept open in the pool of each engine
+POOL_SIZE = 5
+#: Connections opened beyond :py:data:`POOL_SIZE` when all pooled ones are checked out
+POOL_MAX_OVERFLOW = 10
+#: Seconds to wait for a connection when the pool is exhausted
+POOL_TIMEOUT = 30
+#: Seconds after which pooled connections are replaced, before the appliance drops them
+POOL_RECYCLE = 1800
+
+
+def ping_connection(connection, branch):
+    """engine_connect event hook, used to reconnect db sessions that time out
+
+    Every connection checked out of an engine's pool is pinged first. When the ping fails
+    because the connection was dropped, the whole pool is invalidated and the ping is retried
+    on a fresh connection.
 
     Note:
 
-        See also: :ref:`Connection Invalidation <sqlalchemy:pool_connection_invalidation>`
+        See also: :ref:`Disconnect Handling <sqlalchemy:pool_disconnects_pessimistic>`
 
     """
-    cursor = dbapi_connection.cursor()
+    if branch:
+        # sub-connections share the parent's connection, which was already pinged
+        return
+    # don't let the ping run inside a transaction under autocommit sessions
+    save_should_close_with_result = connection.should_close_with_result
+    connection.should_close_with_result = False
     try:
-        cursor.execute("SELECT 1")
-    except StandardError:
-        raise DisconnectionError
-    cursor.close()
+        connection.scalar(select([1]))
+    except DBAPIError as e:
+        if not e.connection_invalidated:
+            raise
+        # the pool was invalidated, the connection reconnects on the next statement
+        connection.scalar(select([1]))
+    finally:
+        connection.should_close_with_result = save_should_close_with_result
 
 
 class Db(Mapping):
@@ -38,6 +67,8 @@ class Db(Mapping):
         hostname: base url to be used (default is from current_appliance)
         credentials: name of credentials to use from :py:attr:`utils.conf.credentials`
             (default ``database``)
+        appliance_version: version of the appliance the database belongs to, part of the
+            schema cache key (default is from current_appliance if hostname isn't given)
 
     Provides convient attributes to common sqlalchemy objects related to this DB,
     as well as a Mapping interface to access and reflect database tables. Where possible,
@@ -63,20 +94,31 @@ class Db(Mapping):
 
     Note:
 
-        Creating a table object requires a call to the database so that SQLAlchemy can do
-        reflection to determine the table's structure (columns, keys, indices, etc). On
-        a latent connection, this can be extremely slow, which will affect methods that return
-        tables, like the mapping interface or :py:meth:`values`.
+        Connections are pooled per instance, see :py:data:`POOL_SIZE` and friends. The
+        :py:attr:`session` is shared by the whole process; threads running in the background
+        should use their own :py:attr:`thread_session`, and hot read-only paths can skip
+        the ORM with :py:meth:`read`.
+
+    Note:
+
+        The whole schema is reflected at once, the first time any table is needed, and stored
+        in :py:data:`SCHEMA_CACHE_DIR` under the appliance version and the latest schema
+        migration. Other processes and later runs against the same schema load it from there
+        instead of reflecting it again, which only costs the query for the migration version.
+        Table classes are still created lazily, per instance.
 
     """
-    def __init__(self, hostname=None, credentials=None):
+    def __init__(self, hostname=None, credentials=None, appliance_version=None):
         self._table_cache = {}
         if hostname is None:
             self.hostname = store.current_appliance.db_address
+            if appliance_version is None:
+                appliance_version = store.current_appliance.version
         else:
             self.hostname = hostname
 
         self.credentials = credentials or conf.credentials['database']
+        self.appliance_version = appliance_version
 
     def __getitem__(self, table_name):
         """Access tables as items contained in this db
@@ -135,7 +177,7 @@ class Db(Mapping):
 
     def copy(self):
         """Copy this database instance, keeping the same credentials and hostname"""
-        return type(self)(self.hostname, self.credentials)
+        return type(self)(self.hostname, self.credentials, self.appliance_version)
 
     def __eq__(self, other):
         """Check if this db is equal to another db"""
@@ -153,10 +195,13 @@ class Db(Mapping):
         """The :py:class:`Engine <sqlalchemy:sqlalchemy.engine.Engine>` for this database
 
         It uses pessimistic disconnection handling, checking that the database is still
-        connected before executing commands.
+        connected before executing commands, see :py:func:`ping_connection`.
 
         """
-        return create_engine(self.db_url, echo_pool=True)
+        engine = create_engine(self.db_url, pool_size=POOL_SIZE, max_overflow=POOL_MAX_OVERFLOW,
+            pool_timeout=POOL_TIMEOUT, pool_recycle=POOL_RECYCLE)
+        event.listen(engine, 'engine_connect', ping_connection)
+        return engine
 
     @cached_property
     def sessionmaker(self):
@@ -182,13 +227,65 @@ class Db(Mapping):
 
         This can be used for introspection of reflected items.
 
+        All the tables are reflected, or loaded from the :py:attr:`schema_cache_file`, when
+        the metadata is first used.
+
         Note:
 
-            Tables that haven't been reflected won't show up in metadata. To reflect a table,
-            use :py:meth:`reflect_table`.
+            Tables created after the metadata was reflected won't show up in metadata. To
+            reflect a table, use :py:meth:`reflect_table`.
+
+        """
+        metadata = self._load_schema()
+        if metadata is None:
+            metadata = MetaData()
+            metadata.reflect(bind=self.engine)
+            self._store_schema(metadata)
+        metadata.bind = self.engine
+        return metadata
+
+    @cached_property
+    def schema_version(self):
+        """The version of the latest schema migration applied to this database"""
+        return self.engine.scalar('SELECT max(version) FROM schema_migrations')
+
+    @cached_property
+    def schema_cache_file(self):
+        """:py:class:`py.path.local` of the reflected schema in :py:data:`SCHEMA_CACHE_DIR`
+
+        SQLAlchemy's version is part of the name as well, its pickled objects are only
+        guaranteed to load with the same version.
+
+        """
+        key = '{}-{}-{}'.format(self.appliance_version, self.schema_version, sqlalchemy.__version__)
+        return SCHEMA_CACHE_DIR.join('{}.pickle'.format(re.sub(r'[^\w.-]', '_', key)))
+
+    def _load_schema(self):
+        """Unpickle the cached schema, ``None`` if it isn't cached or doesn't load"""
+        if not self.schema_cache_file.check(file=1):
+            return None
+        try:
+            with self.schema_cache_file.open('rb') as cache_file:
+                return pickle.load(cache_file)
+        except Exception as e:
+            logger.warning('[DB] Unable to load schema cache %s: %s', self.schema_cache_file, e)
+            return None
+
+    def _store_schema(self, metadata):
+        """Pickle a reflected schema to the schema cache
+
+        The schema is written to a temporary file which is then renamed, so processes
+        reflecting the same schema at the same time never read a partial file.
 
         """
-        return MetaData(bind=self.engine)
+        try:
+            SCHEMA_CACHE_DIR.ensure(dir=True)
+            with NamedTemporaryFile(
+                    dir=str(SCHEMA_CACHE_DIR), suffix='.tmp', delete=False) as cache_file:
+                pickle.dump(metadata, cache_file, pickle.HIGHEST_PROTOCOL)
+            os.rename(cache_file.name, str(self.schema_cache_file))
+        except Exception as e:
+            logger.warning('[DB] Unable to store schema cache %s: %s', self.schema_cache_file, e)
 
     @cached_property
     def db_url(self):
@@ -202,7 +299,7 @@ class Db(Mapping):
     def table_names(self):
         """A sorted list of table names available in this database."""
         # rails table names follow similar rules as pep8 identifiers; expose them as such
-        return sorted(inspect(self.engine).get_table_names())
+        return sorted(self.metadata.tables)
 
     @cached_property
     def session(self):
@@ -219,6 +316,47 @@ class Db(Mapping):
         """
         return self.sessionmaker(autocommit=True)
 
+    @cached_property
+    def _thread_sessions(self):
+        return scoped_session(self.sessionmaker(autocommit=True))
+
+    @property
+    def thread_session(self):
+        """Returns the :py:class:`Session <sqlalchemy:sqlalchemy.orm.session.Session>` of the
+        current thread
+
+        Each thread gets a session of its own, so background threads don't share the state
+        of :py:attr:`session`. A thread should call :py:meth:`remove_thread_session` when it
+        is done with the database.
+
+        """
+        return self._thread_sessions()
+
+    def remove_thread_session(self):
+        """Close the current thread's :py:attr:`thread_session`, if it has one"""
+        self._thread_sessions.remove()
+
+    def read(self, statement, **params):
+        """Run a read-only query without the ORM
+
+        The statement is executed on a connection from the pool, which is returned right after
+        the rows are fetched.
+
+        Args:
+            statement: A SQLAlchemy Core selectable, e.g. ``select([db['vms'].__table__.c.name])``
+            **params: Bind parameters for the statement
+
+        Returns: a list of tuples, one per row
+
+        Usage:
+
+            table = db['event_streams'].__table__
+            db.read(select([table.c.id, table.c.event_type]).where(table.c.id > 100))
+
+        """
+        with self.engine.connect() as connection:
+            return [tuple(row) for row in connection.execute(statement, **params)]
+
     @property
     @contextmanager
     def transaction(self):
@@ -247,6 +385,8 @@ class Db(Mapping):
         Args:
             table_name: The name of a table to reflect
 
+        Tables that are already in :py:attr:`metadata` aren't reflected again.
+
         """
         self.metadata.reflect(only=[table_name])
 
@@ -258,7 +398,8 @@ class Db(Mapping):
         try:
             return self._table_cache[table_name]
         except KeyError:
-            self.reflect_table(table_name)
+            if table_name not in self.metadata.tables:
+                self.reflect_table(table_name)
             table = self.metadata.tables[table_name]
             table_dict = {
                 '__table__': table,
@@ -4,12 +4,14 @@
 
 """
 
+import select
 from cached_property import cached_property
 from contextlib import contextmanager
 from collections import Iterable
 from datetime import datetime
 from numbers import Number
-from sqlalchemy.sql.expression import func
+from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
+from sqlalchemy.sql.expression import func, select as sa_select
 from time import sleep
 from threading import Thread, Event as ThreadEvent
 
@@ -17,6 +19,13 @@ from utils.log import create_sublogger
 
 logger = create_sublogger('events')
 
+#: Channel the database notifies of new ``event_streams`` rows on, see
+#: :py:meth:`EventTool.install_notify_trigger`
+NOTIFY_CHANNEL = 'cfme_tests_event_streams'
+#: Function notifying :py:const:`NOTIFY_CHANNEL`, shared by the triggers of all listeners. The
+#: triggers are named after it and the backend pid of their listener's connection.
+NOTIFY_FUNCTION = 'cfme_tests_notify_event_streams'
+
 
 class EventTool(object):
     """EventTool serves as a wrapper to getting the events from the database.
@@ -46,14 +55,15 @@ class EventTool(object):
     @cached_property
     def event_streams_attributes(self):
         """``event_streams`` columns and python's column types"""
-        self.appliance.db._table('event_streams')
-        event_table = [tbl for tbl in self.appliance.db.metadata.sorted_tables
-                       if tbl.name == 'event_streams'][-1]
+        event_table = self.appliance.db.metadata.tables['event_streams']
         return [(cl.name, cl.type.python_type) for cl in event_table.c.values()]
 
     def query(self, *args, **kwargs):
-        """Wrapper for the SQLAlchemy query method."""
-        return self.appliance.db.session.query(*args, **kwargs)
+        """Wrapper for the SQLAlchemy query method.
+
+        Queries run in the calling thread's own session, see :py:attr:`utils.db.Db.thread_session`.
+        """
+        return self.appliance.db.thread_session.query(*args, **kwargs)
 
     @cached_property
     def all_event_types(self):
@@ -87,7 +97,7 @@ class EventTool(object):
         table = self.appliance.db[table_name]
         name_column = getattr(table, name_column)
         id_column = getattr(table, id_column)
-        o = self.appliance.db.session.query(id_column).filter(name_column == target_name).first()
+        o = self.query(id_column).filter(name_column == target_name).first()
         if not o:
             raise ValueError('{} with name {} not found.'.format(target_type, target_name))
         return o[0]
@@ -103,34 +113,92 @@ class EventTool(object):
                 kinds of events exist too.
             since: Since when you want to check it. UTC
             until: Until what time you want to check it.
+
+        The events are read with :py:meth:`utils.db.Db.read`, without building ORM objects.
         """
         until = until or datetime.utcnow()
-        query = self.query(self.event_streams).filter(self.event_streams.type == 'MiqEvent')
+        table = self.event_streams.__table__
+        columns = ['id', 'timestamp', 'message', 'target_type', 'target_id', 'event_type']
+        query = sa_select([table.c[column] for column in columns]).where(table.c.type == 'MiqEvent')
         if target_type:
-            query = query.filter(self.event_streams.target_type == target_type)
+            query = query.where(table.c.target_type == target_type)
         if target_id:
             if not target_type:
                 raise TypeError('When specifying target_id you also must specify target_type')
             target_id = self.process_id(target_type, target_id)
-            query = query.filter(self.event_streams.target_id == target_id)
+            query = query.where(table.c.target_id == target_id)
         if event_type:
-            query = query.filter(self.event_streams.event_type == event_type)
+            query = query.where(table.c.event_type == event_type)
         if since:
-            query = query.filter(self.event_streams.timestamp >= since)
+            query = query.where(table.c.timestamp >= since)
         if until:
-            query = query.filter(self.event_streams.timestamp <= until)
+            query = query.where(table.c.timestamp <= until)
         if from_id:
-            query = query.filter(self.event_streams.id > from_id)
-        results = []
-        for event in query:
-            results.append({
-                'id': event.id,
-                'timestamp': event.timestamp,
-                'message': event.message,
-                'target_type': event.target_type,
-                'target_id': event.target_id,
-                'event_type': event.event_type})
-        return results
+            query = query.where(table.c.id > from_id)
+        return [dict(zip(columns, row)) for row in self.appliance.db.read(query)]
+
+    def install_notify_trigger(self, trigger):
+        """Makes the database send a notification on :py:const:`NOTIFY_CHANNEL` for every new
+        ``event_streams`` row, with the id of the row as payload.
+
+        Every listener installs a trigger of its own, so that removing it doesn't stop the
+        notifications of the other listeners. Notifications of the same row from several
+        triggers are sent only once, as they are sent in the same transaction.
+
+        Args:
+            trigger: Name of the trigger, :py:const:`NOTIFY_FUNCTION` and the backend pid of the
+                listening connection joined with ``_``, see :py:meth:`remove_stale_notify_triggers`
+        """
+        self.appliance.db.engine.execute("""
+            CREATE OR REPLACE FUNCTION {function}() RETURNS trigger AS $$
+            BEGIN
+                PERFORM pg_notify('{channel}', NEW.id::text);
+                RETURN NEW;
+            END;
+            $$ LANGUAGE plpgsql;
+            DROP TRIGGER IF EXISTS {trigger} ON event_streams;
+            CREATE TRIGGER {trigger} AFTER INSERT ON event_streams
+                FOR EACH ROW EXECUTE PROCEDURE {function}();
+        """.format(function=NOTIFY_FUNCTION, trigger=trigger, channel=NOTIFY_CHANNEL))
+
+    def remove_notify_trigger(self, trigger):
+        """Removes a trigger installed by :py:meth:`install_notify_trigger`
+
+        The notifying function is left in place for the triggers of other listeners.
+        """
+        self.appliance.db.engine.execute(
+            "DROP TRIGGER IF EXISTS {trigger} ON event_streams;".format(trigger=trigger))
+
+    def remove_stale_notify_triggers(self):
+        """Removes the notify triggers whose listening connection is gone
+
+        Listeners that crashed or lost their connection can't remove their triggers, which would
+        go on notifying of every new ``event_streams`` row for good.
+        """
+        stale = self.appliance.db.engine.execute("""
+            SELECT t.tgname FROM pg_trigger t
+            WHERE t.tgrelid = 'event_streams'::regclass AND t.tgname LIKE '{function}_%'
+                AND NOT EXISTS (
+                    SELECT 1 FROM pg_stat_activity a WHERE t.tgname = '{function}_' || a.pid)
+        """.format(function=NOTIFY_FUNCTION)).fetchall()
+        for trigger, in stale:
+            logger.info('Removing the stale db notification trigger {}'.format(trigger))
+            self.remove_notify_trigger(trigger)
+
+    def notify_connection(self):
+        """Returns a DBAPI connection listening on :py:const:`NOTIFY_CHANNEL`
+
+        The connection is taken out of the connection pool, close it when done.
+        """
+        connection = self.appliance.db.engine.raw_connection()
+        connection.detach()
+        dbapi_connection = connection.connection
+        # notifications are only delivered outside of transactions
+        dbapi_connection.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
+        cursor = dbapi_connection.cursor()
+        cursor.execute('LISTEN {}'.format(NOTIFY_CHANNEL))
+        cursor.close()
+        return dbapi_connection
 
     @contextmanager
     def ensure_event_happens(self, target_type, target_id, event_type):
@@ -171,19 +239,40 @@ class EventAttr(object):
         """
         if not isinstance(attr, EventAttr) or self.name != attr.name:
             raise ValueError('Incorrect attribute is passed')
+        return self.match_value(attr.value)
 
-        if not attr.value or not self.value:
-            return attr.value is None and self.value is None
+    def match_value(self, value):
+        """
+        compares current attribute with a bare value of the same attribute
+        """
+        if not value or not self.value:
+            return value is None and self.value is None
         elif self.cmp_func:
-            return self.cmp_func(self.value, attr.value)
+            return self.cmp_func(self.value, value)
         else:
-            return self.value == attr.value
+            return self.value == value
 
     def __repr__(self):
         return "{name}({type})={val}, cmp_func {cmp}".format(name=self.name, type=self.type,
                                                              val=self.value, cmp=self.cmp_func)
 
 
+def raw_event_value(evt, attr, default_type):
+    """
+    value of an attribute of a raw event from event_streams, converted to the column's python type
+    """
+    evt_value = getattr(evt, attr)
+    evt_type = type(evt_value)
+    # weird thing happens here. getattr sometimes takes value not equal to python_type
+    # so, force type conversion has to be done
+    if evt_value and evt_type is not default_type:
+        if evt_type is unicode:
+            evt_value = evt_value.encode('utf8')
+        else:
+            evt_value = default_type(evt_value)
+    return evt_value
+
+
 # fixme: would it be better to create event prototype and just clone it ?
 class Event(object):
     """
@@ -215,17 +304,7 @@ class Event(object):
 
     def _parse_raw_event(self, evt):
         for attr in self._default_attrs:
-            default_type = self._default_attrs[attr].type
-            evt_value = getattr(evt, attr)
-            evt_type = type(evt_value)
-            # weird thing happens here. getattr sometimes takes value not equal to python_type
-            # so, force type conversion has to be done
-            if evt_value and evt_type is not default_type:
-                if evt_type is unicode:
-                    evt_value = evt_value.encode('utf8')
-                else:
-                    evt_value = default_type(evt_value)
-
+            evt_value = raw_event_value(evt, attr, self._default_attrs[attr].type)
             self.add_attrs(EventAttr(**{attr: evt_value}))
 
     def _is_raw_event(self, evt):
@@ -286,17 +365,127 @@ class Event(object):
         return self
 
 
+class ExpectationMatcher(object):
+    """
+    matches raw events from event_streams against expected events.
+
+    expected events are compiled into hash indexes by the attributes they need to be equal to,
+    out of :py:attr:`index_attrs`, and the rest of their attributes, which are checked one by one.
+    so every raw event is only looked up once per combination of indexed attributes in use, and
+    an :py:class:`Event` is only built for the raw events which match an expected event.
+
+    expected events which name their target (target_name) can't match anything until the target
+    shows up in the db. they are indexed by target_id once :py:meth:`resolve` finds it.
+    """
+    index_attrs = ('event_type', 'target_type', 'target_id')
+
+    def __init__(self, event_tool):
+        self._tool = event_tool
+        self.clear()
+
+    def clear(self):
+        # {indexed attrs in use: {their values: [(expected event, other attrs)]}}
+        self._indexes = {}
+        self._unresolved = []
+
+    @cached_property
+    def _types(self):
+        return dict(self._tool.event_streams_attributes)
+
+    def add(self, exp_event):
+        """
+        adds one entry of :py:attr:`EventListener.got_events` to the matcher
+        """
+        event_attrs = exp_event['event'].event_attrs
+        if 'target_name' in event_attrs and 'target_id' not in event_attrs:
+            self._unresolved.append(exp_event)
+            return
+        key_attrs, key, residual = [], [], []
+        for name, attr in event_attrs.items():
+            if name == 'target_name':
+                # only used to resolve target_id
+                continue
+            # only plain equality can be looked up, EventAttr.match treats empty values specially
+            if name in self.index_attrs and attr.value and not attr.cmp_func:
+                key_attrs.append(name)
+            else:
+                residual.append(attr)
+        key_attrs.sort(key=self.index_attrs.index)
+        key = tuple(event_attrs[name].value for name in key_attrs)
+        self._indexes.setdefault(tuple(key_attrs), {}).setdefault(key, []).append(
+            (exp_event, residual))
+
+    def resolve(self):
+        """
+        tries to find the target_id of the expected events which only know their target's name
+        """
+        unresolved, self._unresolved = self._unresolved, []
+        for exp_event in unresolved:
+            event_attrs = exp_event['event'].event_attrs
+            try:
+                target_id = self._tool.process_id(event_attrs['target_type'].value,
+                                                  event_attrs['target_name'].value)
+            except ValueError:
+                # vm or host name isn't added to db yet. need to wait
+                self._unresolved.append(exp_event)
+                continue
+            event_attrs['target_id'] = EventAttr(**{'target_id': target_id})
+            self.add(exp_event)
+
+    def _value(self, raw_event, values, name):
+        if name not in values:
+            values[name] = raw_event_value(raw_event, name, self._types[name])
+        return values[name]
+
+    def match(self, raw_event):
+        """
+        returns the expected events the raw event matches
+        """
+        values = {}
+        matched = []
+        for key_attrs, index in self._indexes.items():
+            key = tuple(self._value(raw_event, values, name) for name in key_attrs)
+            for exp_event, residual in index.get(key, ()):
+                if exp_event['first_event'] and exp_event['matched_events']:
+                    continue
+                if all(attr.match_value(self._value(raw_event, values, attr.name))
+                       for attr in residual):
+                    matched.append(exp_event)
+        return matched
+
+
 class EventListener(Thread):
     """
      accepts "expected" events, listens to db events and compares showed up events with expected
      events. Runs callback function if expected events have it.
+
+     In the ``notify`` mode, the default, a trigger on ``event_streams`` notifies the listener of
+     new rows, and the table is only queried when there are new rows. If the trigger or the
+     listening connection can't be set up, or in the ``poll`` mode, the table is queried every
+     :py:attr:`poll_interval` seconds.
+
+     New events are matched against the expected events by an :py:class:`ExpectationMatcher`.
     """
-    def __init__(self, appliance):
+    #: Seconds between queries in the poll mode
+    poll_interval = 0.2
+    #: Seconds to wait for a notification before checking whether the listener was stopped
+    notify_timeout = 1.0
+    #: Number of notification waits without any notification after which the table is queried
+    #: anyway, in case a notification was lost
+    notify_safety_waits = 10
+
+    def __init__(self, appliance, mode='notify'):
         super(EventListener, self).__init__()
+        if mode not in ('notify', 'poll'):
+            raise ValueError('mode has to be either notify or poll, not {}'.format(mode))
         self._appliance = appliance
         self._tool = EventTool(self._appliance)
+        self.mode = mode
+        self._notify_connection = None
+        self._notify_trigger = None
 
         self._events_to_listen = []
+        self._matcher = ExpectationMatcher(self._tool)
         # last_id is used to ignore already arrived messages the database
         # When database is "cleared" the id of the last event is placed here. That is then used
         # in queries to prevent events of this id and earlier to get in.
@@ -363,17 +552,68 @@ class EventListener(Thread):
             for evt in evts:
                 if isinstance(evt, Event):
                     logger.info("event {} is added to listening queue".format(evt))
-                    self._events_to_listen.append({'event': evt,
-                                                   'callback': callback,
-                                                   'matched_events': [],
-                                                   'first_event': first_event})
+                    exp_event = {'event': evt,
+                                 'callback': callback,
+                                 'matched_events': [],
+                                 'first_event': first_event}
+                    self._events_to_listen.append(exp_event)
+                    self._matcher.add(exp_event)
                 else:
                     raise ValueError("one of events doesn't belong to Event class")
         else:
             raise ValueError('incorrect is passed')
 
+    def _start_notifications(self):
+        try:
+            self._tool.remove_stale_notify_triggers()
+        except Exception as e:
+            logger.warning('Unable to remove stale db notification triggers: {}'.format(e))
+        try:
+            self._notify_connection = self._tool.notify_connection()
+            trigger = '{}_{}'.format(NOTIFY_FUNCTION, self._notify_connection.get_backend_pid())
+            # tracked apart from the connection, so it is removed even if the connection is lost
+            self._notify_trigger = trigger
+            self._tool.install_notify_trigger(trigger)
+        except Exception as e:
+            logger.warning('Unable to listen to db notifications, polling instead: {}'.format(e))
+            self._stop_notifications()
+
+    def _stop_notifications(self):
+        connection, self._notify_connection = self._notify_connection, None
+        trigger, self._notify_trigger = self._notify_trigger, None
+        if connection is not None:
+            try:
+                connection.close()
+            except Exception as e:
+                logger.warning('Unable to close the db notification connection: {}'.format(e))
+        if trigger is not None:
+            try:
+                self._tool.remove_notify_trigger(trigger)
+            except Exception as e:
+                logger.warning('Unable to remove the db notification trigger: {}'.format(e))
+
+    def _wait_for_events(self):
+        """Waits until there may be new events, or until it is time to check for stop"""
+        connection = self._notify_connection
+        if connection is None:
+            sleep(self.poll_interval)
+            return True
+        try:
+            if select.select([connection], [], [], self.notify_timeout) == ([], [], []):
+                return False
+            connection.poll()
+        except Exception as e:
+            logger.warning('Lost the db notification connection, polling instead: {}'.format(e))
+            self._stop_notifications()
+            return True
+        del connection.notifies[:]
+        return True
+
     def start(self):
         logger.info('Event Listener has been started')
+        if self.mode == 'notify':
+            # notifications have to be set up before the last record is taken, not to miss any
+            self._start_notifications()
         self.set_last_record()
         self._stop_event.clear()
         super(EventListener, self).start()
@@ -394,23 +634,34 @@ class EventListener(Thread):
         processes all new db events and compares them with expected events.
         processed events are ignored next time
         """
+        try:
+            self._process_events()
+        finally:
+            self._stop_notifications()
+            self._appliance.db.remove_thread_session()
+
+    def _process_events(self):
+        events = []
+        empty_waits = 0
         while not self._stop_event.is_set():
+            if not events and not self._wait_for_events():
+                empty_waits += 1
+                if empty_waits < self.notify_safety_waits:
+                    continue
+            empty_waits = 0
             events = self.get_next_portion()
-            if len(events) == 0:
-                sleep(0.2)
-                continue
-            for got_event in events:
-                logger.debug("processing event id {}".format(got_event.id))
-                got_event = Event(event_tool=self._tool).build_from_raw_event(got_event)
-                for exp_event in self._events_to_listen:
-                    if exp_event['first_event'] and len(exp_event['matched_events']) > 0:
-                        continue
-
-                    if exp_event['event'].matches(got_event):
-                        if exp_event['callback']:
-                            exp_event['callback'](exp_event=exp_event['event'], got_event=got_event)
-                        exp_event['matched_events'].append(got_event)
-                self.set_last_record(got_event)
+            if events:
+                self._matcher.resolve()
+            for raw_event in events:
+                logger.debug("processing event id {}".format(raw_event.id))
+                matched = self._matcher.match(raw_event)
+                if matched:
+                    got_event = Event(event_tool=self._tool).build_from_raw_event(raw_event)
+                for exp_event in matched:
+                    if exp_event['callback']:
+                        exp_event['callback'](exp_event=exp_event['event'], got_event=got_event)
+                    exp_event['matched_events'].append(got_event)
+                self._last_processed_id = raw_event.id
 
                 if self._stop_event.is_set():
                     break
@@ -430,6 +681,7 @@ class EventListener(Thread):
 
     def reset_events(self):
         self._events_to_listen = []
+        self._matcher.clear()
 
     def get_next_portion(self):
         logger.debug("obtaining next portion of events")
@@ -28,6 +28,9 @@ class LogValidator(object):
         failure_patterns: array of failure regex patterns
         matched_patterns: array of expected regex patterns to be matched
 
+    The log is followed from :py:meth:`fix_before_start` on by the shared tail service of the
+    appliance (:py:func:`utils.ssh.tail_service`), so checks don't need connections of their own.
+
     Usage:
         .. code-block:: python
           evm_tail = LogValidator('/var/www/miq/vmdb/log/evm.log',
@@ -55,6 +58,9 @@ class LogValidator(object):
                 continue
             self._check_fail_logs(line)
             self._check_match_logs(line)
+        if self._remote_file_tail.dropped_lines:
+            logger.warning('{} lines of the log were dropped before they could be validated'.format(
+                self._remote_file_tail.dropped_lines))
         self._verify_match_logs()
 
     def _check_skip_logs(self, line):
@@ -2,44 +2,198 @@
 from fixtures.pytest_store import store
 from utils.ssh import SSHClient, SSHTail
 from utils.log import logger
+import base64
+import json
 import numpy
+import os
+import re
 import time
+from uuid import uuid4
 
 
-def collect_log(ssh_client, log_prefix, local_file_name, strip_whitespace=False):
-    """Collects all of the logs associated with a single log prefix (ex. evm or top_output) and
-    combines to single gzip log file.  The log file is then scp-ed back to the host.
+class LogCollector(object):
+    """Streaming, incremental collector of an appliance log and its rotated copies
+
+    All of the log data is piped through a single ``gzip`` on the appliance and straight down the
+    SSH channel into the local file, so nothing is copied, decompressed or recompressed on the
+    appliance disk.
+
+    The collector remembers the inode of every file it collected and how much of the live log it
+    got, so collecting again only transfers what was logged since. Each collection after the
+    first appends a gzip member to the local file, and concatenated gzip members decompress as
+    one stream. When the live log was rotated in between, the rotated copy with the same inode,
+    or else the oldest new rotated copy, is taken to be its continuation, and the live log is
+    read from its start. The appliance's logrotate uses ``copytruncate``, which keeps the inode of
+    the live log, so a new rotated copy alone also means the live log was rotated.
+
+    Args:
+        ssh_client: :py:class:`utils.ssh.SSHClient` connected to the appliance
+        log_prefix: The log to collect, e.g. ``evm`` or ``top_output``
+        strip_whitespace: Strip leading and trailing whitespace and drop empty lines
+        state_file: Optional path of a JSON file to keep the collection state in between runs
     """
     log_dir = '/var/www/miq/vmdb/log/'
+    strip_command = 'sed \'s/^ *//; s/ *$//; /^$/d; /^\s*$/d\''
+
+    def __init__(self, ssh_client, log_prefix, strip_whitespace=False, state_file=None):
+        self.ssh_client = ssh_client
+        self.log_file = '{}{}.log'.format(self.log_dir, log_prefix)
+        self.strip_whitespace = strip_whitespace
+        self.state_file = state_file
+        #: inodes and names (without .gz) of the rotated logs that were collected
+        self.seen_inodes = set()
+        self.seen_names = set()
+        #: inode of the live log, and how many of its bytes were collected
+        self.live_inode = None
+        self.live_offset = 0
+        if state_file is not None and os.path.exists(state_file):
+            with open(state_file) as f:
+                state = json.load(f)
+            self.seen_inodes = set(state['seen_inodes'])
+            self.seen_names = set(state['seen_names'])
+            self.live_inode = state['live_inode']
+            self.live_offset = state['live_offset']
+
+    @property
+    def collected_before(self):
+        return self.live_inode is not None
 
-    log_file = '{}{}.log'.format(log_dir, log_prefix)
-    dest_file = '{}{}.perf.log'.format(log_dir, log_prefix)
-    dest_file_gz = '{}{}.perf.log.gz'.format(log_dir, log_prefix)
+    def _stat_logs(self):
+        # name, inode and size of the rotated logs and the live log in one round trip
+        result = self.ssh_client.run_command(
+            'stat -c "%n %i %s" {0}-* {0} 2>/dev/null'.format(self.log_file))
+        rotated, live = [], None
+        for line in (result.output or '').splitlines():
+            try:
+                name, inode, size = line.strip().rsplit(' ', 2)
+                inode, size = int(inode), int(size)
+            except ValueError:
+                continue
+            if name == self.log_file:
+                live = (inode, size)
+            else:
+                rotated.append((name, inode))
+        return sorted(rotated), live
 
-    ssh_client.run_command('rm -f {}'.format(dest_file_gz))
+    def _read_commands(self):
+        """Shell commands printing the new log data, and the state to keep once they ran"""
+        rotated, live = self._stat_logs()
+        commands = []
+        seen_inodes, seen_names = set(self.seen_inodes), set(self.seen_names)
+        new_rotated = [
+            (name, inode) for name, inode in rotated
+            if inode not in seen_inodes and re.sub(r'\.gz$', '', name) not in seen_names]
+        continued = None
+        if self.collected_before and (
+                live is None or live[0] != self.live_inode or new_rotated):
+            # the live log was rotated since the last collection, either moved away, or copied
+            # and truncated in place (copytruncate), when a new rotated copy is all that shows it
+            continued = next(
+                (name for name, inode in new_rotated if inode == self.live_inode),
+                new_rotated[0][0] if new_rotated else None)
+        for name, inode in new_rotated:
+            skip = self.live_offset if name == continued else 0
+            # zcat -f also reads rotated logs that aren't compressed (yet)
+            commands.append('zcat -f {} | tail -c +{}'.format(name, skip + 1))
+            seen_inodes.add(inode)
+            seen_names.add(re.sub(r'\.gz$', '', name))
+        if live is None:
+            live_inode, live_offset = None, 0
+        else:
+            live_inode, size = live
+            if continued is None and live_inode == self.live_inode and size >= self.live_offset:
+                start = self.live_offset
+            else:
+                # new, truncated or rotated live log, whatever followed the offset was rotated
+                start = 0
+            # stop at the size we saw, so the offset stays exact while the log grows; head reads
+            # the file itself, so nothing is cut off by SIGPIPE and fails the pipeline
+            commands.append('head -c {} {} | tail -c +{}'.format(size, self.log_file, start + 1))
+            live_offset = size
+        return commands, (seen_inodes, seen_names, live_inode, live_offset)
 
-    status, out = ssh_client.run_command('ls -1 {}-*'.format(log_file))
-    if status == 0:
-        files = out.strip().split('\n')
-        for lfile in sorted(files):
-            ssh_client.run_command('cp {} {}-2.gz'.format(lfile, lfile))
-            ssh_client.run_command('gunzip {}-2.gz'.format(lfile))
-            if strip_whitespace:
-                ssh_client.run_command('sed -i  \'s/^ *//; s/ *$//; /^$/d; /^\s*$/d\' '
-                    '{}-2'.format(lfile))
-            ssh_client.run_command('cat {}-2 >> {}'.format(lfile, dest_file))
-            ssh_client.run_command('rm {}-2'.format(lfile))
+    @staticmethod
+    def _truncate(local_file_name, size):
+        if os.path.exists(local_file_name):
+            with open(local_file_name, 'r+b') as local_file:
+                local_file.truncate(size)
 
-    ssh_client.run_command('cp {} {}-2'.format(log_file, log_file))
-    if strip_whitespace:
-        ssh_client.run_command('sed -i  \'s/^ *//; s/ *$//; /^$/d; /^\s*$/d\' '
-            '{}-2'.format(log_file))
-    ssh_client.run_command('cat {}-2 >> {}'.format(log_file, dest_file))
-    ssh_client.run_command('rm {}-2'.format(log_file))
-    ssh_client.run_command('gzip {}{}.perf.log'.format(log_dir, log_prefix))
+    def collect(self, local_file_name):
+        """Transfer the log data that's new since the last collection into ``local_file_name``
 
-    ssh_client.get_file(dest_file_gz, local_file_name)
-    ssh_client.run_command('rm -f {}'.format(dest_file_gz))
+        Returns:
+            The number of compressed bytes transferred
+        """
+        commands, state = self._read_commands()
+        if not commands:
+            logger.info('Nothing to collect of {}'.format(self.log_file))
+            return 0
+        pipeline = '{{ {}; }}'.format(' && '.join(commands))
+        if self.strip_whitespace:
+            pipeline += ' | {}'.format(self.strip_command)
+        pipeline += ' | gzip -c'
+        encoded = self.ssh_client.username != 'root'
+        if encoded:
+            # sudo runs with a pseudo-tty, which would mangle binary output
+            pipeline += ' | base64'
+        # the pseudo-tty also merges stderr into stdout, so errors go to a file of their own;
+        # with pipefail and the reads chained with &&, any failing part fails the collection
+        error_file = '/tmp/cfme_tests_collect_{}.err'.format(uuid4().hex)
+        pipeline = 'set -o pipefail; {{ {}; }} 2>{}'.format(pipeline, error_file)
+        mode = 'ab' if self.collected_before else 'wb'
+        # what a failed collection appended is cut off again, the next one transfers it again
+        size_before = 0
+        if mode == 'ab' and os.path.exists(local_file_name):
+            size_before = os.path.getsize(local_file_name)
+        transferred = 0
+        try:
+            stream = self.ssh_client.stream_command(pipeline)
+            with open(local_file_name, mode) as local_file:
+                leftover = ''
+                for is_stderr, data in stream.chunks():
+                    if is_stderr:
+                        continue
+                    if encoded:
+                        data = leftover + re.sub(r'\s', '', data)
+                        usable = len(data) // 4 * 4
+                        data, leftover = base64.b64decode(data[:usable]), data[usable:]
+                    local_file.write(data)
+                    transferred += len(data)
+        except Exception:
+            self._truncate(local_file_name, size_before)
+            raise
+        errors = self.ssh_client.run_command('cat {0}; rm -f {0}'.format(error_file)).output
+        errors = (errors or '').strip()
+        if errors:
+            logger.warning('Collecting {} printed errors: {}'.format(self.log_file, errors))
+        if stream.rc != 0:
+            # keep the old state, so the next collection transfers the same data again
+            self._truncate(local_file_name, size_before)
+            logger.warning(
+                'Collecting {} exited with {}, it will be collected again next time'.format(
+                    self.log_file, stream.rc))
+            return 0
+        self.seen_inodes, self.seen_names, self.live_inode, self.live_offset = state
+        if self.state_file is not None:
+            with open(self.state_file, 'w') as f:
+                json.dump({
+                    'seen_inodes': sorted(self.seen_inodes),
+                    'seen_names': sorted(self.seen_names),
+                    'live_inode': self.live_inode,
+                    'live_offset': self.live_offset,
+                }, f)
+        logger.info('Collected {} compressed bytes of {} into {}'.format(
+            transferred, self.log_file, local_file_name))
+        return transferred
+
+
+def collect_log(ssh_client, log_prefix, local_file_name, strip_whitespace=False):
+    """Collects all of the logs associated with a single log prefix (ex. evm or top_output) and
+    combines them into a single gzip log file, streamed straight back to the host.
+
+    See :py:class:`LogCollector` for repeated, incremental collections.
+    """
+    LogCollector(ssh_client, log_prefix, strip_whitespace).collect(local_file_name)
 
 
 def convert_top_mem_to_mib(top_mem):
@@ -56,23 +210,125 @@ def convert_top_mem_to_mib(top_mem):
 def generate_statistics(the_list, decimals=2):
     """Returns comma seperated statistics over a list of numbers.
 
+    The numbers can also be given as a numpy array, or as a :py:class:`PercentileSketch`, in which
+    case the median and the percentiles are estimates.
+
     Returns:  list of samples(runs), minimum, average, median, maximum,
               stddev, 90th(percentile),
               99th(percentile)
     """
-    if len(the_list) == 0:
+    if isinstance(the_list, PercentileSketch):
+        return the_list.statistics(decimals)
+    numpy_arr = numpy.asarray(the_list, dtype=float)
+    if len(numpy_arr) == 0:
         return [0, 0, 0, 0, 0, 0, 0, 0]
-    else:
-        numpy_arr = numpy.array(the_list)
-        minimum = round(numpy.amin(numpy_arr), decimals)
-        average = round(numpy.average(numpy_arr), decimals)
-        median = round(numpy.median(numpy_arr), decimals)
-        maximum = round(numpy.amax(numpy_arr), decimals)
-        stddev = round(numpy.std(numpy_arr), decimals)
-        percentile90 = round(numpy.percentile(numpy_arr, 90), decimals)
-        percentile99 = round(numpy.percentile(numpy_arr, 99), decimals)
-        return [len(the_list), minimum, average, median, maximum, stddev, percentile90,
-            percentile99]
+    median, percentile90, percentile99 = numpy.percentile(numpy_arr, [50, 90, 99])
+    return [len(numpy_arr)] + [round(value, decimals) for value in (numpy.amin(numpy_arr),
+        numpy.average(numpy_arr), median, numpy.amax(numpy_arr), numpy.std(numpy_arr),
+        percentile90, percentile99)]
+
+
+class PercentileSketch(object):
+    """Streaming percentile estimates in bounded memory, a merging t-digest
+
+    Values are buffered and then merged into at most about ``compression`` weighted centroids,
+    which are small near the extremes and large around the median, so the tail percentiles stay
+    accurate. The count, minimum, maximum, average and standard deviation are exact.
+
+    Usage:
+
+        sketch = PercentileSketch()
+        for timings in batches:
+            sketch.add(timings)
+        sketch.percentile(90)
+    """
+    buffer_size = 10000
+
+    def __init__(self, compression=100):
+        self.compression = compression
+        self.means = numpy.empty(0)
+        self.weights = numpy.empty(0)
+        self.count = 0
+        self.minimum = numpy.inf
+        self.maximum = -numpy.inf
+        self._sum = 0.0
+        self._sum_squares = 0.0
+        self._buffer = []
+        self._buffered = 0
+
+    def add(self, values):
+        """Adds a number or an array of numbers"""
+        values = numpy.atleast_1d(numpy.asarray(values, dtype=float))
+        if not len(values):
+            return
+        self.count += len(values)
+        self.minimum = min(self.minimum, values.min())
+        self.maximum = max(self.maximum, values.max())
+        self._sum += values.sum()
+        self._sum_squares += numpy.square(values).sum()
+        self._buffer.append(values)
+        self._buffered += len(values)
+        if self._buffered >= self.buffer_size:
+            self._compress()
+
+    def merge(self, other):
+        """Adds everything added to another sketch"""
+        other._compress()
+        self._compress()
+        self.count += other.count
+        self.minimum = min(self.minimum, other.minimum)
+        self.maximum = max(self.maximum, other.maximum)
+        self._sum += other._sum
+        self._sum_squares += other._sum_squares
+        self._compress(other.means, other.weights)
+
+    def _scale(self, quantiles):
+        # the t-digest k1 scale function, centroids may span 1 on this scale
+        return self.compression / (2 * numpy.pi) * numpy.arcsin(2 * quantiles - 1)
+
+    def _compress(self, means=None, weights=None):
+        parts_means = [self.means] + self._buffer
+        parts_weights = [self.weights] + [numpy.ones(len(values)) for values in self._buffer]
+        if means is not None:
+            parts_means.append(means)
+            parts_weights.append(weights)
+        self._buffer = []
+        self._buffered = 0
+        means = numpy.concatenate(parts_means)
+        weights = numpy.concatenate(parts_weights)
+        if not len(means):
+            return
+        order = numpy.argsort(means, kind='mergesort')
+        means, weights = means[order], weights[order]
+        total = weights.sum()
+        middles = (numpy.cumsum(weights) - weights / 2) / total
+        groups = numpy.floor(self._scale(middles) - self._scale(0.0)).astype(int)
+        groups -= groups[0]
+        merged_weights = numpy.bincount(groups, weights=weights)
+        present = merged_weights > 0
+        self.means = numpy.bincount(groups, weights=means * weights)[present] / \
+            merged_weights[present]
+        self.weights = merged_weights[present]
+
+    def percentile(self, percent):
+        """Estimates the given percentile, like ``numpy.percentile``"""
+        self._compress()
+        if not self.count:
+            return 0.0
+        middles = (numpy.cumsum(self.weights) - self.weights / 2) / self.count
+        return float(numpy.interp(percent / 100.0,
+            numpy.concatenate(([0.0], middles, [1.0])),
+            numpy.concatenate(([self.minimum], self.means, [self.maximum]))))
+
+    def statistics(self, decimals=2):
+        """The same statistics :py:func:`generate_statistics` returns"""
+        if not self.count:
+            return [0, 0, 0, 0, 0, 0, 0, 0]
+        average = self._sum / self.count
+        stddev = numpy.sqrt(max(self._sum_squares / self.count - average ** 2, 0.0))
+        return [self.count] + [round(value, decimals) for value in (self.minimum, average,
+            self.percentile(50), self.maximum, stddev, self.percentile(90),
+            self.percentile(99))]
 
 
 def get_worker_pid(worker_type):
@@ -6,15 +6,16 @@ from utils.log import logger
 from utils.path import log_path
 from utils.perf import convert_top_mem_to_mib
 from utils.perf import generate_statistics
+from utils.perf import PercentileSketch
 from datetime import datetime
 import dateutil.parser as du_parser
 from datetime import timedelta
+from multiprocessing import Pool
 from time import time
 import csv
 import numpy
 import os
 import pygal
-import subprocess
 import re
 
 # Regular Expressions to capture relevant information from each log line:
@@ -28,12 +29,23 @@ miqmsg_cmd = re.compile(r'Command:\s\[([a-zA-Z0-9\._\:]*)\]')
 # Message id: [ * ]
 miqmsg_id = re.compile(r'Message\sid:\s\[([0-9]*)\]')
 # Args: [ *]
-miqmsg_args = re.compile(
-    r'Args:\s\[([A-Za-z0-9\{\}\(\)\[\]\s\\\-\:\"\'\,\=\<\>\_\/\.\@\?\%\&\#]*)\]')
+miqmsg_args_chars = r'[A-Za-z0-9\{\}\(\)\[\]\s\\\-\:\"\'\,\=\<\>\_\/\.\@\?\%\&\#]'
+miqmsg_args = re.compile(r'Args:\s\[(' + miqmsg_args_chars + r'*)\]')
 # Dequeued in: [ * ] seconds
 miqmsg_deq = re.compile(r'Dequeued\sin:\s\[([0-9\.]*)\]\sseconds')
 # Delivered in [ * ] seconds
 miqmsg_del = re.compile(r'Delivered\sin\s\[([0-9\.]*)\]\sseconds')
+# All of the above for a message put on, taken off, or delivered from the queue, in one search:
+# (1) date, (2) time, (3) pid, then one of
+# (4) put, (5) message id, (6) command, (7) args
+# (8) get_via_drb, (9) message id, (10) dequeued in
+# (11) delivered, (12) message id, (13) delivered in
+miqmsg_queue = re.compile(
+    r'\[----\]\s[IWE],\s\[([0-9\-]+)T([0-9\:\.]+)\s#([0-9]+):[0-9a-z]+\].*?MIQ\(MiqQueue\.(?:'
+    r'(put)\).*?Message\sid:\s\[([0-9]*)\](?:.*?Command:\s\[([a-zA-Z0-9\._\:]*)\])?'
+    r'(?:.*?Args:\s\[(' + miqmsg_args_chars + r'*)\])?'
+    r'|(get_via_drb)\).*?Message\sid:\s\[([0-9]*)\](?:.*?Dequeued\sin:\s\[([0-9\.]*)\]\sseconds)?'
+    r'|(delivered)\).*?Message\sid:\s\[([0-9]*)\](?:.*?Delivered\sin\s\[([0-9\.]*)\]\sseconds)?)')
 
 # Worker related regular expressions:
 # MIQ(PriorityWorker) ID [15], PID [6461]
@@ -42,6 +54,17 @@ miqwkr = re.compile(r'MIQ\(([A-Za-z]*)\)\sID\s\[([0-9]*)\],\sPID\s\[([0-9]*)\]')
 miqwkr_id = re.compile(r'with\sID:\s\[([0-9]*)\]')
 # For use with workers exiting, such as authentication failures:
 miqwkr_id_2 = re.compile(r'ID\s\[([0-9]*)\]')
+# Any line about workers starting or terminating
+miqwkr_line = re.compile(r'Interrupt|MIQ\([A-Za-z]*\)\sID|"evm_worker_uptime_exceeded|'
+    r'"evm_worker_memory_exceeded|"evm_worker_stop|Worker\sexiting\.')
+# Reasons for workers to terminate, in the order they are looked for, and what they're called
+miqwkr_terminations = [
+    ('evm_worker_uptime_exceeded', 'evm_worker_uptime_exceeded'),
+    ('evm_worker_memory_exceeded', 'evm_worker_memory_exceeded'),
+    ('evm_worker_stop', 'evm_worker_stop'),
+    ('Interrupt', 'Interrupted'),
+    ('Worker exiting.', 'Worker Exited'),
+]
 
 # top regular expressions
 # Cpu(s): 13.7%us,  1.2%sy,  2.1%ni, 80.0%id,  1.7%wa,  0.0%hi,  0.1%si,  1.3%st
@@ -59,182 +82,291 @@ miq_top = re.compile(r'([0-9]+)\s+[0-9]+\s+[A-Za-z0-9]+\s+[0-9]+\s+[0-9\-]+\s+([
     r'([0-9\.mg]+)\s+([0-9\.mg]+)\s+[SRDZ]\s+([0-9\.]+)\s+([0-9\.]+)')
 
 
-def evm_to_messages(evm_file, filters):
-    test_start = ''
-    test_end = ''
+# evm.log is split into chunks of this many bytes, parsed in parallel
+evm_chunk_size = 64 * 1024 * 1024
+# Lines from different chunks are ordered by (chunk index << evm_chunk_shift) + line number
+evm_chunk_shift = 40
+
+
+def _seconds(value):
+    return float(value) if value else 0.0
+
+
+def worker_event(evm_log_line):
+    """Parses a line about a worker starting or terminating
+
+    Returns:
+        tuple of the timestamp, the event (``start`` or what the termination is called), the
+        worker id, and for starts, the worker type and pid; or ``None`` for any other line
+    """
+    if not miqwkr_line.search(evm_log_line):
+        return None
+    ts, pid = get_msg_timestamp_pid(evm_log_line)
+    miqwkr_result = miqwkr.search(evm_log_line)
+    if miqwkr_result:
+        return (ts, 'start', int(miqwkr_result.group(2)), miqwkr_result.group(1),
+            miqwkr_result.group(3))
+    for reason, terminated in miqwkr_terminations:
+        if reason in evm_log_line:
+            if terminated == 'Interrupted':
+                # interrupts terminate all the workers
+                return ts, terminated, None, None, None
+            if terminated == 'Worker Exited':
+                miqwkr_id_result = miqwkr_id_2.search(evm_log_line)
+            else:
+                miqwkr_id_result = miqwkr_id.search(evm_log_line)
+            if not miqwkr_id_result:
+                return None
+            return ts, terminated, int(miqwkr_id_result.group(1)), None, None
+    return None
+
+
+def events_to_workers(worker_events):
+    """Replays the :py:func:`worker_event` events of evm.log, in order
+
+    Returns:
+        tuple of the dict of :py:class:`MiqWorker` by worker id, the counts of workers that
+        exceeded their memory, exceeded their uptime, were stopped, were interrupted and exited,
+        and the count of events
+    """
+    workers = {}
+    terminations = dict((terminated, 0) for reason, terminated in miqwkr_terminations)
+    for ts, event, workerid, worker_type, pid in worker_events:
+        if not ts:
+            continue
+        ts = datetime.strptime(ts, '%Y-%m-%d %H:%M:%S.%f')
+        if event == 'start':
+            if workerid not in workers:
+                workers[workerid] = MiqWorker(workerid, worker_type, pid, ts)
+        elif event == 'Interrupted':
+            for worker in workers.itervalues():
+                if not worker.end_ts:
+                    terminations[event] += 1
+                    worker.terminated = event
+                    worker.end_ts = ts
+        elif workerid in workers and not workers[workerid].terminated:
+            terminations[event] += 1
+            workers[workerid].terminated = event
+            workers[workerid].end_ts = ts
+    return (workers, terminations['evm_worker_memory_exceeded'],
+        terminations['evm_worker_uptime_exceeded'], terminations['evm_worker_stop'],
+        terminations['Interrupted'], terminations['Worker Exited'], len(worker_events))
+
+
+def parse_evm_chunk(chunk):
+    """Parses the queue messages and worker events of the lines starting in a byte range of evm.log
+
+    Run in a worker process by :py:func:`parse_evm_log`, so it takes a single tuple of
+    (evm_file, chunk index, start offset, end offset, filters).
+
+    Returns:
+        dict of numpy arrays of the puts, gets and deliveries in the chunk, in line order, the list
+        of :py:func:`worker_event` events, the first and last timestamps, the line count and the
+        count of lines without a message id
+    """
+    evm_file, index, start, end, filters = chunk
+    worker_events = []
+    puts = ([], [], [], [], [], [])
+    gets = ([], [], [], [], [])
+    dels = ([], [], [], [])
+    first_ts = None
+    last_ts = None
     line_count = 0
-    messages = {}
-    msg_cmds = {}
+    no_id = 0
+    with open(evm_file, 'rb') as evmlogfile:
+        if start:
+            # a line belongs to the chunk it starts in, skip the rest of the previous chunk's line
+            evmlogfile.seek(start - 1)
+            offset = start - 1 + len(evmlogfile.readline())
+        else:
+            offset = 0
+        for evm_log_line in evmlogfile:
+            if offset >= end:
+                break
+            offset += len(evm_log_line)
+            line_count += 1
+            if ('Interrupt' in evm_log_line or ') ID' in evm_log_line or
+                    '"evm_worker_' in evm_log_line or 'Worker exiting.' in evm_log_line):
+                event = worker_event(evm_log_line)
+                if event:
+                    worker_events.append(event)
+            if 'MIQ(' not in evm_log_line:
+                continue
+            if first_ts is None:
+                first_ts, pid = get_msg_timestamp_pid(evm_log_line)
+            if 'MiqQueue.' not in evm_log_line:
+                continue
+            result = miqmsg_queue.search(evm_log_line)
+            if not result:
+                continue
+            (date, tod, pid, put, put_id, cmd, args, get, get_id, deq, delivered, del_id,
+                del_time) = result.groups()
+            ts = '{} {}'.format(date, tod)
+            position = (index << evm_chunk_shift) + line_count
+            msg_id = put_id or get_id or del_id
+            if not msg_id:
+                no_id += 1
+                continue
+            last_ts = ts
+            if put:
+                cmd = cmd or ''
+                args = args or ''
+                # Determine if the pattern matches and append to the command if it does
+                for p_filter in filters:
+                    if filters[p_filter].search(args.strip()):
+                        cmd = '{}{}'.format(cmd, p_filter)
+                        break
+                for column, value in zip(puts, (msg_id, position, ts, pid, intern(str(cmd)),
+                        args)):
+                    column.append(value)
+            elif get:
+                for column, value in zip(gets, (msg_id, position, ts, pid, _seconds(deq))):
+                    column.append(value)
+            else:
+                for column, value in zip(dels, (msg_id, position, ts, _seconds(del_time))):
+                    column.append(value)
+    return {
+        'puts': _columns(puts, (numpy.int64, numpy.int64, 'datetime64[us]', numpy.int32, object,
+            object)),
+        'gets': _columns(gets, (numpy.int64, numpy.int64, 'datetime64[us]', numpy.int32,
+            numpy.float64)),
+        'dels': _columns(dels, (numpy.int64, numpy.int64, 'datetime64[us]', numpy.float64)),
+        'worker_events': worker_events,
+        'first_ts': first_ts or None,
+        'last_ts': last_ts,
+        'line_count': line_count,
+        'no_id': no_id,
+    }
+
+
+def _columns(lists, dtypes):
+    columns = []
+    for values, dtype in zip(lists, dtypes):
+        column = numpy.empty(len(values), dtype=dtype)
+        column[:] = values
+        columns.append(column)
+    return columns
+
+
+def _last_by_id(msg_ids):
+    """Sorted distinct message ids, and the index of the last occurrence of each one"""
+    distinct, reverse_index = numpy.unique(msg_ids[::-1], return_index=True)
+    return distinct, len(msg_ids) - 1 - reverse_index
+
+
+def _join_by_id(table_ids, table_positions, msg_ids, positions):
+    """Matches the last event of every message id to the message put on the queue before it
+
+    Returns:
+        indexes into the table, indexes into the events, and the count of unmatched ids
+    """
+    distinct, last = _last_by_id(msg_ids)
+    if not len(table_ids):
+        return numpy.array([], dtype=int), numpy.array([], dtype=int), len(distinct)
+    where = numpy.searchsorted(table_ids, distinct).clip(max=len(table_ids) - 1)
+    found = (table_ids[where] == distinct) & (table_positions[where] < positions[last])
+    return where[found], last[found], int(len(distinct) - found.sum())
+
+
+def parse_evm_log(evm_file, filters, processes=None):
+    """Parses all the queue messages in evm.log into a :py:class:`MiqMsgTable`, and the workers
+
+    The file is split into chunks of :py:data:`evm_chunk_size` bytes, which are parsed by a pool
+    of ``processes`` worker processes (one per cpu by default). The puts, gets and deliveries found
+    in every chunk are then joined on the message id, so a message can be put on the queue in one
+    chunk and delivered in another. When a message id shows up more than once, its last put, and
+    the last get and delivery after it, count.
+
+    Args:
+        evm_file: Path to evm.log
+        filters: dict of suffix: regular expression; the suffix of the first expression that
+            matches the args of a message is appended to its command
+        processes: Number of worker processes
+
+    The worker events are replayed in order by :py:func:`events_to_workers` once all the chunks are
+    parsed, so the file is only read once.
+
+    Returns:
+        tuple of the :py:class:`MiqMsgTable`, the :py:func:`events_to_workers` tuple, the first
+        and last timestamps, and the line count
+    """
+    size = os.path.getsize(evm_file)
+    chunks = [(evm_file, index, start, min(start + evm_chunk_size, size), filters)
+        for index, start in enumerate(range(0, size, evm_chunk_size))] or [
+        (evm_file, 0, 0, 0, filters)]
 
     runningtime = time()
-    evmlogfile = open(evm_file, 'r')
-    evm_log_line = evmlogfile.readline()
-    while evm_log_line:
-        line_count += 1
-        evm_log_line = evm_log_line.strip()
-
-        miqmsg_result = miqmsg.search(evm_log_line)
-        if miqmsg_result:
-
-            # Obtains the first timestamp in the log file
-            if test_start == '':
-                ts, pid = get_msg_timestamp_pid(evm_log_line)
-                test_start = ts
-
-            # A message was first put on the queue, this starts its queuing time
-            if (miqmsg_result.group(1) == 'MiqQueue.put'):
-
-                msg_cmd = get_msg_cmd(evm_log_line)
-                msg_id = get_msg_id(evm_log_line)
-                if msg_id:
-                    ts, pid = get_msg_timestamp_pid(evm_log_line)
-                    test_end = ts
-                    messages[msg_id] = MiqMsgStat()
-                    messages[msg_id].msg_id = msg_id
-                    messages[msg_id].msg_id = '\'' + msg_id + '\''
-                    messages[msg_id].msg_cmd = msg_cmd
-                    messages[msg_id].pid_put = pid
-                    messages[msg_id].puttime = ts
-                    msg_args = get_msg_args(evm_log_line)
-                    if msg_args is False:
-                        logger.debug('Could not obtain message args line #: %s', line_count)
-                    else:
-                        messages[msg_id].msg_args = msg_args
-                else:
-                    logger.error('Could not obtain message id, line #: %s', line_count)
-
-            elif (miqmsg_result.group(1) == 'MiqQueue.get_via_drb'):
-                msg_id = get_msg_id(evm_log_line)
-                if msg_id:
-                    if msg_id in messages:
-                        ts, pid = get_msg_timestamp_pid(evm_log_line)
-                        test_end = ts
-                        messages[msg_id].pid_get = pid
-                        messages[msg_id].gettime = ts
-                        messages[msg_id].deq_time = get_msg_deq(evm_log_line)
-                    else:
-                        logger.error('Message ID not in dictionary: %s', msg_id)
-                else:
-                    logger.error('Could not obtain message id, line #: %s', line_count)
-
-            elif (miqmsg_result.group(1) == 'MiqQueue.delivered'):
-                msg_id = get_msg_id(evm_log_line)
-                if msg_id:
-                    ts, pid = get_msg_timestamp_pid(evm_log_line)
-                    test_end = ts
-                    if msg_id in messages:
-                        messages[msg_id].del_time = get_msg_del(evm_log_line)
-                        messages[msg_id].total_time = messages[msg_id].deq_time + \
-                            messages[msg_id].del_time
-                    else:
-                        logger.error('Message ID not in dictionary: %s', msg_id)
-                else:
-                    logger.error('Could not obtain message id, line #: %s', line_count)
-
-        if (line_count % 100000) == 0:
-            timediff = time() - runningtime
-            runningtime = time()
-            logger.info('Count {} : Parsed 100000 lines in %s', line_count, timediff)
-
-        evm_log_line = evmlogfile.readline()
-
-    # I tried to avoid two loops but this reduced the complexity of filtering on messages.
-    # By filtering over messages, we can better display what is occuring under the covers, as a
-    # daily rollup is picked up off the queue different than a hourly rollup, etc
-    for msg in sorted(messages.keys()):
-        msg_args = messages[msg].msg_args
-        # Determine if the pattern matches and append to the command if it does
-        for p_filter in filters:
-            results = filters[p_filter].search(msg_args.strip())
-            if results:
-                messages[msg].msg_cmd = '{}{}'.format(messages[msg].msg_cmd, p_filter)
-                break
-        msg_cmd = messages[msg].msg_cmd
-        if msg_cmd not in msg_cmds:
-            msg_cmds[msg_cmd] = {}
-            msg_cmds[msg_cmd]['total'] = []
-            msg_cmds[msg_cmd]['queue'] = []
-            msg_cmds[msg_cmd]['execute'] = []
-        if messages[msg].total_time != 0:
-            msg_cmds[msg_cmd]['total'].append(round(messages[msg].total_time, 2))
-            msg_cmds[msg_cmd]['queue'].append(round(messages[msg].deq_time, 2))
-            msg_cmds[msg_cmd]['execute'].append(round(messages[msg].del_time, 2))
+    if len(chunks) == 1:
+        parsed = [parse_evm_chunk(chunks[0])]
+    else:
+        pool = Pool(processes)
+        try:
+            parsed = []
+            for result in pool.imap(parse_evm_chunk, chunks):
+                parsed.append(result)
+                logger.info('Parsed chunk %s of %s of %s, %s lines', len(parsed), len(chunks),
+                    evm_file, result['line_count'])
+        finally:
+            pool.close()
+            pool.join()
+    logger.info('Parsed %s in %s', evm_file, time() - runningtime)
+
+    puts, gets, dels = [[numpy.concatenate(column) for column in zip(*[p[kind] for p in parsed])]
+        for kind in ('puts', 'gets', 'dels')]
+    line_count = sum(p['line_count'] for p in parsed)
+    no_id = sum(p['no_id'] for p in parsed)
+    if no_id:
+        logger.error('Could not obtain message id from %s lines', no_id)
+    first_stamps = [p['first_ts'] for p in parsed if p['first_ts']]
+    last_stamps = [p['last_ts'] for p in parsed if p['last_ts']]
+    test_start = first_stamps[0] if first_stamps else ''
+    test_end = last_stamps[-1] if last_stamps else ''
+
+    msg_ids, last = _last_by_id(puts[0])
+    put_positions = puts[1][last]
+    table = MiqMsgTable(
+        msg_id=msg_ids, puttime=puts[2][last], pid_put=puts[3][last], msg_cmd=puts[4][last],
+        msg_args=puts[5][last])
+
+    rows, events, missing = _join_by_id(msg_ids, put_positions, gets[0], gets[1])
+    table.gettime[rows] = gets[2][events]
+    table.pid_get[rows] = gets[3][events]
+    table.deq_time[rows] = gets[4][events]
+    if missing:
+        logger.error('%s dequeued message ids were never put on the queue', missing)
+
+    rows, events, missing = _join_by_id(msg_ids, put_positions, dels[0], dels[1])
+    table.del_time[rows] = dels[3][events]
+    table.total_time[rows] = table.deq_time[rows] + table.del_time[rows]
+    if missing:
+        logger.error('%s delivered message ids were never put on the queue', missing)
+
+    workers = events_to_workers([event for p in parsed for event in p['worker_events']])
+    return table, workers, test_start, test_end, line_count
+
+
+def evm_to_message_table(evm_file, filters, processes=None):
+    """Parses all the queue messages in evm.log, see :py:func:`parse_evm_log`
+
+    Returns:
+        tuple of the :py:class:`MiqMsgTable`, first and last timestamps, and the line count
+    """
+    table, workers, test_start, test_end, line_count = parse_evm_log(evm_file, filters, processes)
+    return table, test_start, test_end, line_count
 
-    return messages, msg_cmds, test_start, test_end, line_count
 
+def evm_to_messages(evm_file, filters):
+    """Parses evm.log into a dict of :py:class:`MiqMsgStat` by message id
 
-def evm_to_workers(evm_file):
-    # Use grep to reduce # of lines to sort through
-    p = subprocess.Popen(['grep', 'Interrupt\\|MIQ([A-Za-z]*) ID\\|"evm_worker_uptime_exceeded\\|'
-            '"evm_worker_memory_exceeded\\|"evm_worker_stop\\|Worker exiting.', evm_file],
-            stdout=subprocess.PIPE)
-    greppedevmlog, err = p.communicate()
-    greppedevmlog = greppedevmlog.strip()
+    Kept for compatibility, :py:func:`evm_to_message_table` holds the same data in far less memory.
+    """
+    table, test_start, test_end, line_count = evm_to_message_table(evm_file, filters)
+    return table.to_messages(), table.to_msg_cmds(), test_start, test_end, line_count
 
-    evmlines = greppedevmlog.split('\n')
 
-    workers = {}
-    wkr_upt_exc = 0
-    wkr_mem_exc = 0
-    wkr_stp = 0
-    wkr_int = 0
-    wkr_ext = 0
-    for evm_log_line in evmlines:
-        ts, pid = get_msg_timestamp_pid(evm_log_line)
-
-        miqwkr_result = miqwkr.search(evm_log_line)
-        if miqwkr_result:
-            workerid = int(miqwkr_result.group(2))
-            if workerid not in workers:
-                workers[workerid] = MiqWorker()
-                workers[workerid].worker_type = miqwkr_result.group(1)
-                workers[workerid].pid = miqwkr_result.group(3)
-                workers[workerid].worker_id = int(workerid)
-                workers[workerid].start_ts = datetime.strptime(ts, '%Y-%m-%d %H:%M:%S.%f')
-        elif 'evm_worker_uptime_exceeded' in evm_log_line:
-            miqwkr_id_result = miqwkr_id.search(evm_log_line)
-            if miqwkr_id_result:
-                workerid = int(miqwkr_id_result.group(1))
-                if workerid in workers:
-                    if not workers[workerid].terminated:
-                        wkr_upt_exc += 1
-                        workers[workerid].terminated = 'evm_worker_uptime_exceeded'
-                        workers[workerid].end_ts = datetime.strptime(ts, '%Y-%m-%d %H:%M:%S.%f')
-        elif 'evm_worker_memory_exceeded' in evm_log_line:
-            miqwkr_id_result = miqwkr_id.search(evm_log_line)
-            if miqwkr_id_result:
-                workerid = int(miqwkr_id_result.group(1))
-                if workerid in workers:
-                    if not workers[workerid].terminated:
-                        wkr_mem_exc += 1
-                        workers[workerid].terminated = 'evm_worker_memory_exceeded'
-                        workers[workerid].end_ts = datetime.strptime(ts, '%Y-%m-%d %H:%M:%S.%f')
-        elif 'evm_worker_stop' in evm_log_line:
-            miqwkr_id_result = miqwkr_id.search(evm_log_line)
-            if miqwkr_id_result:
-                workerid = int(miqwkr_id_result.group(1))
-                if workerid in workers:
-                    if not workers[workerid].terminated:
-                        wkr_stp += 1
-                        workers[workerid].terminated = 'evm_worker_stop'
-                        workers[workerid].end_ts = datetime.strptime(ts, '%Y-%m-%d %H:%M:%S.%f')
-        elif 'Interrupt' in evm_log_line:
-            for workerid in workers:
-                if not workers[workerid].end_ts:
-                    wkr_int += 1
-                    workers[workerid].terminated = 'Interrupted'
-                    workers[workerid].end_ts = datetime.strptime(ts, '%Y-%m-%d %H:%M:%S.%f')
-        elif 'Worker exiting.' in evm_log_line:
-            miqwkr_id_2_result = miqwkr_id_2.search(evm_log_line)
-            if miqwkr_id_2_result:
-                workerid = int(miqwkr_id_2_result.group(1))
-                if workerid in workers:
-                    if not workers[workerid].terminated:
-                        wkr_ext += 1
-                        workers[workerid].terminated = 'Worker Exited'
-                        workers[workerid].end_ts = datetime.strptime(ts, '%Y-%m-%d %H:%M:%S.%f')
-
-    return workers, wkr_mem_exc, wkr_upt_exc, wkr_stp, wkr_int, wkr_ext, len(evmlines)
+def evm_to_workers(evm_file):
+    """Parses the workers out of evm.log, see :py:func:`parse_evm_log`"""
+    return parse_evm_log(evm_file, {})[1]
 
 
 def split_appliance_charts(top_appliance, charts_dir):
@@ -353,12 +485,18 @@ def generate_hourly_charts_and_csvs(hourly_buckets, charts_dir):
 def generate_raw_data_csv(rawdata_dict, csv_file_name):
     csv_rawdata_path = log_path.join('csv_output', csv_file_name)
     output_file = csv_rawdata_path.open('w', ensure=True)
-    csvwriter = csv.DictWriter(output_file, fieldnames=rawdata_dict[rawdata_dict.keys()[0]].headers,
+    if isinstance(rawdata_dict, MiqMsgTable):
+        headers = rawdata_dict.headers
+        rows = rawdata_dict.rows()
+    else:
+        headers = rawdata_dict[rawdata_dict.keys()[0]].headers
+        rows = (dict(rawdata_dict[key]) for key in sorted(rawdata_dict.keys()))
+    csvwriter = csv.DictWriter(output_file, fieldnames=headers,
         delimiter=',', quotechar='\'', quoting=csv.QUOTE_MINIMAL)
     csvwriter.writeheader()
-    sorted_rd_keys = sorted(rawdata_dict.keys())
-    for key in sorted_rd_keys:
-        csvwriter.writerow(dict(rawdata_dict[key]))
+    for row in rows:
+        csvwriter.writerow(row)
+    output_file.close()
 
 
 def generate_total_time_charts(msg_cmds, charts_dir):
@@ -393,12 +531,20 @@ def generate_worker_charts(workers, top_workers, charts_dir):
 
 
 def get_first_miqtop(top_log_file):
-    # Find first miqtop log line
-    p = subprocess.Popen(['grep', '-m', '1', '^miqtop\:', top_log_file], stdout=subprocess.PIPE)
-    greppedtop, err = p.communicate()
-    str_start = greppedtop.index('is->')
-    miqtop_time = du_parser.parse(greppedtop[str_start:], fuzzy=True, ignoretz=True)
-    timezone_offset = int(greppedtop[str_start + 34:str_start + 37])
+    # Find first miqtop log line, only reading the file up to it
+    with open(top_log_file) as top_log:
+        for top_line in top_log:
+            if top_line.startswith('miqtop:'):
+                return parse_miqtop(top_line)
+    raise ValueError('No miqtop line in {}'.format(top_log_file))
+
+
+def parse_miqtop(top_line):
+    # miqtop: .* is-> Mon Jan 26 08:57:39 EST 2015 -0500
+    str_start = top_line.index('is->')
+    miqtop_time = du_parser.parse(top_line[str_start:], fuzzy=True, ignoretz=True)
+    # Time logged in top is the system's time which is ahead/behind by the timezone offset
+    timezone_offset = int(top_line[str_start + 34:str_start + 37])
     miqtop_time = miqtop_time - timedelta(hours=timezone_offset)
     return miqtop_time, timezone_offset
 
@@ -478,75 +624,149 @@ def line_chart_render(title, xtitle, ytitle, x_labels, lines, fname, stacked=Fal
     line_chart.render_to_file(str(fname))
 
 
-def messages_to_hourly_buckets(messages, test_start, test_end):
-    hr_bkt = {}
-    # Hour buckets look like: hr_bkt[msg_cmd][msg_date][msg_hour] = MiqMsgBucket()
-    for msg in messages:
-        # put on queue, deals with queuing:
-        msg_cmd = messages[msg].msg_cmd
-        putdate = messages[msg].puttime[:10]
-        puthour = messages[msg].puttime[11:13]
-        if msg_cmd not in hr_bkt:
-            hr_bkt[msg_cmd] = provision_hour_buckets(test_start, test_end)
-
-        hr_bkt[msg_cmd][putdate][puthour].total_put += 1
-        hr_bkt[msg_cmd][putdate][puthour].sum_deq += messages[msg].deq_time
-        if (hr_bkt[msg_cmd][putdate][puthour].min_deq == 0 or
-                hr_bkt[msg_cmd][putdate][puthour].min_deq > messages[msg].deq_time):
-            hr_bkt[msg_cmd][putdate][puthour].min_deq = messages[msg].deq_time
-        if (hr_bkt[msg_cmd][putdate][puthour].max_deq == 0 or
-                hr_bkt[msg_cmd][putdate][puthour].max_deq < messages[msg].deq_time):
-            hr_bkt[msg_cmd][putdate][puthour].max_deq = messages[msg].deq_time
-        hr_bkt[msg_cmd][putdate][puthour].avg_deq = \
-            hr_bkt[msg_cmd][putdate][puthour].sum_deq / hr_bkt[msg_cmd][putdate][puthour].total_put
-
-        # Get time is when the message is delivered
-        getdate = messages[msg].gettime[:10]
-        gethour = messages[msg].gettime[11:13]
-
-        hr_bkt[msg_cmd][getdate][gethour].total_get += 1
-        hr_bkt[msg_cmd][getdate][gethour].sum_del += messages[msg].del_time
-        if (hr_bkt[msg_cmd][getdate][gethour].min_del == 0 or
-                hr_bkt[msg_cmd][getdate][gethour].min_del > messages[msg].del_time):
-            hr_bkt[msg_cmd][getdate][gethour].min_del = messages[msg].del_time
-        if (hr_bkt[msg_cmd][getdate][gethour].max_del == 0 or
-                hr_bkt[msg_cmd][getdate][gethour].max_del < messages[msg].del_time):
-            hr_bkt[msg_cmd][getdate][gethour].max_del = messages[msg].del_time
-
-        hr_bkt[msg_cmd][getdate][gethour].avg_del = \
-            hr_bkt[msg_cmd][getdate][gethour].sum_del / hr_bkt[msg_cmd][getdate][gethour].total_get
+def _group_indexes(codes, size):
+    """Indexes of the rows of every group, by the group number of each row"""
+    order = numpy.argsort(codes, kind='mergesort')
+    return numpy.split(order, numpy.cumsum(numpy.bincount(codes, minlength=size))[:-1])
+
+
+def _grouped_aggregates(groups, values, size):
+    """Count, sum, minimum and maximum of the values of every group, by the group of each value"""
+    counts = numpy.bincount(groups, minlength=size)
+    sums = numpy.bincount(groups, weights=values, minlength=size)
+    minimums = numpy.zeros(size)
+    maximums = numpy.zeros(size)
+    present = counts > 0
+    if present.any():
+        # reduce the runs of the values sorted by group
+        sorted_values = values[numpy.argsort(groups, kind='mergesort')]
+        starts = numpy.concatenate(([0], numpy.cumsum(counts[present])[:-1]))
+        minimums[present] = numpy.minimum.reduceat(sorted_values, starts)
+        maximums[present] = numpy.maximum.reduceat(sorted_values, starts)
+    return counts, sums, minimums, maximums
+
+
+def _hour_keys(timestamps):
+    """Distinct (date, hour) strings of datetime64 timestamps, NaT as ('', ''), and the index of
+    the hour of every timestamp
+    """
+    hours, inverse = numpy.unique(timestamps.astype('datetime64[h]'), return_inverse=True)
+    keys = []
+    for hour in numpy.datetime_as_string(hours):
+        keys.append(('', '') if hour == 'NaT' else (hour[:10], hour[11:13]))
+    return keys, inverse
+
+
+def messages_to_hourly_buckets(msg_table, test_start, test_end):
+    """Hourly put and get counts, dequeue and deliver timings of every command
+
+    Messages count in the hour they were put on the queue for the dequeue timings, and in the hour
+    they were taken off it for the deliver timings, or in the '' bucket if they never were.
+
+    Args:
+        msg_table: :py:class:`MiqMsgTable` of the messages
+
+    Returns:
+        ``hr_bkt[msg_cmd][msg_date][msg_hour] = MiqMsgBucket()``
+    """
+    commands, cmd_codes = numpy.unique(msg_table.msg_cmd, return_inverse=True)
+    hr_bkt = {cmd: provision_hour_buckets(test_start, test_end) for cmd in commands}
+    for timestamps, timings, queued in ((msg_table.puttime, msg_table.deq_time, True),
+            (msg_table.gettime, msg_table.del_time, False)):
+        hour_keys, hour_codes = _hour_keys(timestamps)
+        # one group for every command and hour
+        counts, sums, minimums, maximums = _grouped_aggregates(
+            cmd_codes * len(hour_keys) + hour_codes, timings, len(commands) * len(hour_keys))
+        for group in numpy.flatnonzero(counts):
+            date, hour = hour_keys[group % len(hour_keys)]
+            bucket = hr_bkt[commands[group // len(hour_keys)]].setdefault(date, {}).setdefault(
+                hour, MiqMsgBucket())
+            count = int(counts[group])
+            if queued:
+                bucket.total_put = count
+                bucket.sum_deq = sums[group]
+                bucket.min_deq = minimums[group]
+                bucket.max_deq = maximums[group]
+                bucket.avg_deq = sums[group] / count
+            else:
+                bucket.total_get = count
+                bucket.sum_del = sums[group]
+                bucket.min_del = minimums[group]
+                bucket.max_del = maximums[group]
+                bucket.avg_del = sums[group] / count
     return hr_bkt
 
 
-def messages_to_statistics_csv(messages, statistics_file_name):
-    all_statistics = []
-    for msg_id in messages:
-        msg = messages[msg_id]
-
-        added = False
-        if len(all_statistics) > 0:
-            for msg_statistics in all_statistics:
-                if msg_statistics.cmd == msg.msg_cmd:
-
-                    if msg.del_time > 0:
-                        msg_statistics.delivertimes.append(float(msg.del_time))
-                        msg_statistics.gets += 1
-                    msg_statistics.dequeuetimes.append(float(msg.deq_time))
-                    msg_statistics.totaltimes.append(float(msg.total_time))
-                    msg_statistics.puts += 1
-                    added = True
-                    break
-
-        if not added:
-            msg_statistics = MiqMsgLists()
-            msg_statistics.cmd = msg.msg_cmd
-            if msg.del_time > 0:
-                msg_statistics.delivertimes.append(float(msg.del_time))
-                msg_statistics.gets = 1
-            msg_statistics.dequeuetimes.append(float(msg.deq_time))
-            msg_statistics.totaltimes.append(float(msg.total_time))
-            msg_statistics.puts = 1
-            all_statistics.append(msg_statistics)
+class MiqMsgStatistics(object):
+    """Dequeue, deliver and total time statistics of the messages of every command
+
+    Messages are added in batches of columns. The timings are kept in numpy arrays by default.
+    With ``sketches=True`` they are added to :py:class:`utils.perf.PercentileSketch` instances
+    instead, so the memory used stays bounded however many messages are added, and the median and
+    percentiles are estimates.
+    """
+    measurements = ('deq_time', 'del_time', 'total_time')
+
+    def __init__(self, sketches=False):
+        self.sketches = sketches
+        self.puts = {}
+        self.gets = {}
+        self._timings = {}
+
+    def add(self, msg_cmd, deq_time, del_time, total_time):
+        """Adds a batch of messages, given as numpy arrays of their commands and timings"""
+        commands, cmd_codes = numpy.unique(msg_cmd, return_inverse=True)
+        for cmd, rows in zip(commands, _group_indexes(cmd_codes, len(commands))):
+            delivered = del_time[rows] > 0
+            self.puts[cmd] = self.puts.get(cmd, 0) + len(rows)
+            self.gets[cmd] = self.gets.get(cmd, 0) + int(delivered.sum())
+            # only delivered messages have a deliver time
+            batch = (deq_time[rows], del_time[rows][delivered], total_time[rows])
+            if cmd not in self._timings:
+                if self.sketches:
+                    self._timings[cmd] = [PercentileSketch() for _ in self.measurements]
+                else:
+                    self._timings[cmd] = [[] for _ in self.measurements]
+            for timings, values in zip(self._timings[cmd], batch):
+                if self.sketches:
+                    timings.add(values)
+                else:
+                    timings.append(values)
+
+    def timings(self, cmd, measurement):
+        """All the timings of a command, or their sketch"""
+        timings = self._timings[cmd][self.measurements.index(measurement)]
+        if self.sketches:
+            return timings
+        timings[:] = [numpy.concatenate(timings)]
+        return timings[0]
+
+    @property
+    def commands(self):
+        return sorted(self._timings)
+
+    def row(self, cmd, decimals=3):
+        """The command, puts, gets and :py:func:`utils.perf.generate_statistics` of the timings"""
+        row = [cmd, self.puts[cmd], self.gets[cmd]]
+        for measurement in self.measurements:
+            row.extend(generate_statistics(self.timings(cmd, measurement), decimals))
+        return row
+
+
+def messages_to_statistics_csv(msg_table, statistics_file_name, sketches=False, batch_size=1000000):
+    """Writes the statistics of the messages of every command to a csv file
+
+    Args:
+        msg_table: :py:class:`MiqMsgTable` of the messages
+        statistics_file_name: Name of the csv file, in log/csv_output
+        sketches: Estimate medians and percentiles, see :py:class:`MiqMsgStatistics`
+        batch_size: How many messages to add to the statistics at once
+    """
+    statistics = MiqMsgStatistics(sketches)
+    for start in range(0, len(msg_table), batch_size):
+        batch = slice(start, start + batch_size)
+        statistics.add(msg_table.msg_cmd[batch], msg_table.deq_time[batch],
+            msg_table.del_time[batch], msg_table.total_time[batch])
 
     csvdata_path = log_path.join('csv_output', statistics_file_name)
     outputfile = csvdata_path.open('w', ensure=True)
@@ -554,27 +774,22 @@ def messages_to_statistics_csv(messages, statistics_file_name):
     try:
         csvfile = csv.writer(outputfile)
         metrics = ['samples', 'min', 'avg', 'median', 'max', 'std', '90', '99']
-        measurements = ['deq_time', 'del_time', 'total_time']
         headers = ['cmd', 'puts', 'gets']
-        for measurement in measurements:
+        for measurement in statistics.measurements:
             for metric in metrics:
                 headers.append('{}_{}'.format(measurement, metric))
 
         csvfile.writerow(headers)
 
         # Contents of CSV
-        for msg_statistics in sorted(all_statistics, key=lambda x: x.cmd):
-            if msg_statistics.gets > 1:
+        for cmd in statistics.commands:
+            stats = statistics.row(cmd)
+            if statistics.gets[cmd] > 1:
+                # samples, avg, 90th and std of the total times
+                total = stats[3 + 2 * len(metrics):]
                 logger.debug('Samples/Avg/90th/Std: %s: %s : %s : %s,Cmd: %s',
-                    str(len(msg_statistics.totaltimes)).rjust(7),
-                    str(round(numpy.average(msg_statistics.totaltimes), 3)).rjust(7),
-                    str(round(numpy.percentile(msg_statistics.totaltimes, 90), 3)).rjust(7),
-                    str(round(numpy.std(msg_statistics.totaltimes), 3)).rjust(7),
-                    msg_statistics.cmd)
-            stats = [msg_statistics.cmd, msg_statistics.puts, msg_statistics.gets]
-            stats.extend(generate_statistics(msg_statistics.dequeuetimes, 3))
-            stats.extend(generate_statistics(msg_statistics.delivertimes, 3))
-            stats.extend(generate_statistics(msg_statistics.totaltimes, 3))
+                    str(total[0]).rjust(7), str(total[2]).rjust(7), str(total[6]).rjust(7),
+                    str(total[5]).rjust(7), cmd)
             csvfile.writerow(stats)
     finally:
         outputfile.close()
@@ -613,189 +828,145 @@ def provision_hour_buckets(test_start, test_end, init=True):
     return buckets
 
 
-def top_to_appliance(top_file):
-    # Find first miqtop log line
-    miqtop_time, timezone_offset = get_first_miqtop(top_file)
+class TopColumn(object):
+    """A column of floats in a preallocated numpy array, doubled in size when full"""
+    def __init__(self, capacity=1440):
+        self.values = numpy.empty(capacity)
+        self.size = 0
 
-    runningtime = time()
-    grep_pattern = '^top\s\-\s\\|^miqtop\:\\|^Cpu(s)\:\\|^Mem\:\\|^Swap\:'
-    # Use grep to reduce # of lines to sort through
-    p = subprocess.Popen(['grep', grep_pattern, top_file], stdout=subprocess.PIPE)
-    greppedtop, err = p.communicate()
-    timediff = time() - runningtime
-    logger.info('Grepped top_output for CPU/Mem/Swap & time data in %s', timediff)
-
-    top_lines = greppedtop.strip().split('\n')
-    line_count = 0
+    def append(self, value):
+        if self.size == len(self.values):
+            self.values = numpy.resize(self.values, 2 * len(self.values))
+        self.values[self.size] = value
+        self.size += 1
 
-    top_keys = ['datetimes', 'cpuus', 'cpusy', 'cpuni', 'cpuid', 'cpuwa', 'cpuhi', 'cpusi', 'cpust',
-        'memtot', 'memuse', 'memfre', 'buffer', 'swatot', 'swause', 'swafre', 'cached']
-    top_app = dict((key, []) for key in top_keys)
+    def tolist(self):
+        return self.values[:self.size].tolist()
 
-    cur_time = None
-    miqtop_ahead = True
-    runningtime = time()
-    for top_line in top_lines:
-        line_count += 1
-        if 'top - ' in top_line:
-            # top - 11:00:43
-            cur_hour = int(top_line[6:8])
-            cur_min = int(top_line[9:11])
-            cur_sec = int(top_line[12:14])
-            if miqtop_ahead:
-                # Have not found miqtop date/time yet so we must rely on miqtop date/time "ahead"
-                if cur_hour <= miqtop_time.hour:
-                    cur_time = miqtop_time.replace(hour=cur_hour, minute=cur_min, second=cur_sec) \
-                        - timedelta(hours=timezone_offset)
-                else:
-                    # miqtop_time is ahead by date
-                    logger.info('miqtop_time is ahead by one day')
-                    cur_time = miqtop_time - timedelta(days=1)
-                    cur_time = cur_time.replace(hour=cur_hour, minute=cur_min, second=cur_sec) \
-                        - timedelta(hours=timezone_offset)
-            else:
-                cur_time = miqtop_time.replace(hour=cur_hour, minute=cur_min, second=cur_sec) \
-                    - timedelta(hours=timezone_offset)
-        elif 'miqtop: ' in top_line:
-            miqtop_ahead = False
-            # miqtop: .* is-> Mon Jan 26 08:57:39 EST 2015 -0500
-            str_start = top_line.index('is->')
-            miqtop_time = du_parser.parse(top_line[str_start:], fuzzy=True, ignoretz=True)
-            # Time logged in top is the system's time which is ahead/behind by the timezone offset
-            timezone_offset = int(top_line[str_start + 34:str_start + 37])
-            miqtop_time = miqtop_time - timedelta(hours=timezone_offset)
-        elif 'Cpu(s): ' in top_line:
-            miq_cpu_result = miq_cpu.search(top_line)
-            if miq_cpu_result:
-                top_app['datetimes'].append(str(cur_time))
-                top_app['cpuus'].append(float(miq_cpu_result.group(1).strip()))
-                top_app['cpusy'].append(float(miq_cpu_result.group(2).strip()))
-                top_app['cpuni'].append(float(miq_cpu_result.group(3).strip()))
-                top_app['cpuid'].append(float(miq_cpu_result.group(4).strip()))
-                top_app['cpuwa'].append(float(miq_cpu_result.group(5).strip()))
-                top_app['cpuhi'].append(float(miq_cpu_result.group(6).strip()))
-                top_app['cpusi'].append(float(miq_cpu_result.group(7).strip()))
-                top_app['cpust'].append(float(miq_cpu_result.group(8).strip()))
-            else:
-                logger.error('Issue with miq_cpu regex: %s', top_line)
-        elif 'Mem: ' in top_line:
-            miq_mem_result = miq_mem.search(top_line)
-            if miq_mem_result:
-                top_app['memtot'].append(round(float(miq_mem_result.group(1).strip()) / 1024, 2))
-                top_app['memuse'].append(round(float(miq_mem_result.group(2).strip()) / 1024, 2))
-                top_app['memfre'].append(round(float(miq_mem_result.group(3).strip()) / 1024, 2))
-                top_app['buffer'].append(round(float(miq_mem_result.group(4).strip()) / 1024, 2))
-            else:
-                logger.error('Issue with miq_mem regex: %s', top_line)
-        elif 'Swap: ' in top_line:
-            miq_swap_result = miq_swap.search(top_line)
-            if miq_swap_result:
-                top_app['swatot'].append(round(float(miq_swap_result.group(1).strip()) / 1024, 2))
-                top_app['swause'].append(round(float(miq_swap_result.group(2).strip()) / 1024, 2))
-                top_app['swafre'].append(round(float(miq_swap_result.group(3).strip()) / 1024, 2))
-                top_app['cached'].append(round(float(miq_swap_result.group(4).strip()) / 1024, 2))
-            else:
-                logger.error('Issue with miq_swap regex: %s', top_line)
-        else:
-            logger.error('Issue with grepping of top file:%s', top_line)
-        if (line_count % 20000) == 0:
-            timediff = time() - runningtime
-            runningtime = time()
-            logger.info('Count {} : Parsed 20000 lines in %s', line_count, timediff)
-    return top_app, len(top_lines)
 
+top_appliance_keys = ['cpuus', 'cpusy', 'cpuni', 'cpuid', 'cpuwa', 'cpuhi', 'cpusi', 'cpust',
+    'memtot', 'memuse', 'memfre', 'buffer', 'swatot', 'swause', 'swafre', 'cached']
+top_worker_keys = ['virt', 'res', 'share', 'cpu_per', 'mem_per']
 
-def top_to_workers(workers, top_file):
+
+def top_to_appliance_and_workers(top_file, workers):
+    """Parses the appliance and the worker CPU/memory usage out of top_output.log in one pass
+
+    Worker processes are looked up by their pid, among the workers with that pid the one running
+    at the time of the top sample gets it. The file is streamed, and the samples are collected in
+    :py:class:`TopColumn` arrays.
+
+    Args:
+        top_file: Path to top_output.log
+        workers: dict of :py:class:`MiqWorker` by worker id, see :py:func:`events_to_workers`
+
+    Returns:
+        tuple of the appliance time series, the dict of worker time series by worker id, and the
+        count of lines
+    """
     # Find first miqtop log line
     miqtop_time, timezone_offset = get_first_miqtop(top_file)
 
-    runningtime = time()
-    grep_pids = ''
-    for wkr in workers:
-        grep_pids = '{}^{}\s\\|'.format(grep_pids, workers[wkr].pid)
-    grep_pattern = '{}^top\s\-\s\\|^miqtop\:'.format(grep_pids)
-    # Use grep to reduce # of lines to sort through
-    p = subprocess.Popen(['grep', grep_pattern, top_file], stdout=subprocess.PIPE)
-    greppedtop, err = p.communicate()
-    timediff = time() - runningtime
-    logger.info('Grepped top_output for pids & time data in %s', timediff)
-
-    # This is very ugly because miqtop does include the date but top does not
-    # Also pids can be duplicated, so careful attention to detail on when a pid starts and ends
-    top_lines = greppedtop.strip().split('\n')
+    # pids can be duplicated, so careful attention to detail on when a pid starts and ends
+    workers_by_pid = {}
+    for worker in sorted(workers.itervalues(), key=lambda worker: worker.worker_id):
+        workers_by_pid.setdefault(worker.pid, []).append(worker)
+
+    top_app_datetimes = []
+    top_app = dict((key, TopColumn()) for key in top_appliance_keys)
+    top_wkr = {}
     line_count = 0
-    top_workers = {}
     cur_time = None
+    cur_datetime = str(cur_time)
     miqtop_ahead = True
     runningtime = time()
-    for top_line in top_lines:
-        line_count += 1
-        if 'top - ' in top_line:
-            # top - 11:00:43
-            cur_hour = int(top_line[6:8])
-            cur_min = int(top_line[9:11])
-            cur_sec = int(top_line[12:14])
-            if miqtop_ahead:
-                # Have not found miqtop time yet so we must rely on miqtop time "ahead"
-                if cur_hour <= miqtop_time.hour:
-                    cur_time = miqtop_time.replace(hour=cur_hour, minute=cur_min, second=cur_sec) \
-                        - timedelta(hours=timezone_offset)
-                else:
-                    # miqtop_time is ahead by date
+    with open(top_file) as top_log:
+        for top_line in top_log:
+            line_count += 1
+            if (line_count % 100000) == 0:
+                timediff = time() - runningtime
+                runningtime = time()
+                logger.info('Count %s : Parsed 100000 lines in %s', line_count, timediff)
+            fields = top_line.split(None, 1)
+            if fields and fields[0] in workers_by_pid:
+                top_results = miq_top.search(top_line)
+                if not top_results or cur_time is None:
+                    continue
+                for worker in workers_by_pid[fields[0]]:
+                    if cur_time > worker.start_ts and \
+                            (worker.end_ts == '' or cur_time < worker.end_ts):
+                        if worker.worker_id not in top_wkr:
+                            top_wkr[worker.worker_id] = (
+                                [], dict((key, TopColumn(256)) for key in top_worker_keys))
+                        datetimes, columns = top_wkr[worker.worker_id]
+                        datetimes.append(cur_datetime)
+                        columns['virt'].append(convert_top_mem_to_mib(top_results.group(2)))
+                        columns['res'].append(convert_top_mem_to_mib(top_results.group(3)))
+                        columns['share'].append(convert_top_mem_to_mib(top_results.group(4)))
+                        columns['cpu_per'].append(float(top_results.group(5)))
+                        columns['mem_per'].append(float(top_results.group(6)))
+                        break
+            elif top_line.startswith('top - '):
+                # top - 11:00:43
+                cur_hour = int(top_line[6:8])
+                cur_min = int(top_line[9:11])
+                cur_sec = int(top_line[12:14])
+                if miqtop_ahead and cur_hour > miqtop_time.hour:
+                    # Have not found miqtop date/time yet so we must rely on miqtop date/time
+                    # "ahead", which is ahead by date
                     logger.info('miqtop_time is ahead by one day')
                     cur_time = miqtop_time - timedelta(days=1)
-                    cur_time = cur_time.replace(hour=cur_hour, minute=cur_min, second=cur_sec) \
-                        - timedelta(hours=timezone_offset)
-            else:
-                cur_time = miqtop_time.replace(hour=cur_hour, minute=cur_min, second=cur_sec) \
+                else:
+                    cur_time = miqtop_time
+                cur_time = cur_time.replace(hour=cur_hour, minute=cur_min, second=cur_sec) \
                     - timedelta(hours=timezone_offset)
-        elif 'miqtop: ' in top_line:
-            miqtop_ahead = False
-            # miqtop: .* is-> Mon Jan 26 08:57:39 EST 2015 -0500
-            str_start = top_line.index('is->')
-            miqtop_time = du_parser.parse(top_line[str_start:], fuzzy=True, ignoretz=True)
-            # Time logged in top is the system's time which is ahead/behind by the timezone offset
-            timezone_offset = int(top_line[str_start + 34:str_start + 37])
-            miqtop_time = miqtop_time - timedelta(hours=timezone_offset)
-        else:
-            top_results = miq_top.search(top_line)
-            if top_results:
-                top_pid = top_results.group(1)
-                top_virt = convert_top_mem_to_mib(top_results.group(2))
-                top_res = convert_top_mem_to_mib(top_results.group(3))
-                top_share = convert_top_mem_to_mib(top_results.group(4))
-                top_cpu_per = float(top_results.group(5))
-                top_mem_per = float(top_results.group(6))
-                for worker in workers:
-                    if workers[worker].pid == top_pid:
-                        if cur_time > workers[worker].start_ts and \
-                                (workers[worker].end_ts == '' or cur_time < workers[worker].end_ts):
-                            w_id = workers[worker].worker_id
-                            if w_id not in top_workers:
-                                top_workers[w_id] = {}
-                                top_workers[w_id]['datetimes'] = []
-                                top_workers[w_id]['virt'] = []
-                                top_workers[w_id]['res'] = []
-                                top_workers[w_id]['share'] = []
-                                top_workers[w_id]['cpu_per'] = []
-                                top_workers[w_id]['mem_per'] = []
-                            top_workers[w_id]['datetimes'].append(str(cur_time))
-                            top_workers[w_id]['virt'].append(top_virt)
-                            top_workers[w_id]['res'].append(top_res)
-                            top_workers[w_id]['share'].append(top_share)
-                            top_workers[w_id]['cpu_per'].append(top_cpu_per)
-                            top_workers[w_id]['mem_per'].append(top_mem_per)
-                            break
-            else:
-                logger.error('Issue with miq_top regex or grepping of top file:%s', top_line)
-        if (line_count % 20000) == 0:
-            timediff = time() - runningtime
-            runningtime = time()
-            logger.info('Count %s : Parsed 20000 lines in %s', line_count, timediff)
-    return top_workers, len(top_lines)
+                cur_datetime = str(cur_time)
+            elif top_line.startswith('miqtop:'):
+                miqtop_ahead = False
+                miqtop_time, timezone_offset = parse_miqtop(top_line)
+            elif top_line.startswith('Cpu(s):'):
+                miq_cpu_result = miq_cpu.search(top_line)
+                if miq_cpu_result:
+                    top_app_datetimes.append(cur_datetime)
+                    for i, key in enumerate(top_appliance_keys[:8]):
+                        top_app[key].append(float(miq_cpu_result.group(i + 1)))
+                else:
+                    logger.error('Issue with miq_cpu regex: %s', top_line)
+            elif top_line.startswith('Mem:'):
+                miq_mem_result = miq_mem.search(top_line)
+                if miq_mem_result:
+                    for i, key in enumerate(top_appliance_keys[8:12]):
+                        top_app[key].append(round(float(miq_mem_result.group(i + 1)) / 1024, 2))
+                else:
+                    logger.error('Issue with miq_mem regex: %s', top_line)
+            elif top_line.startswith('Swap:'):
+                miq_swap_result = miq_swap.search(top_line)
+                if miq_swap_result:
+                    for i, key in enumerate(top_appliance_keys[12:]):
+                        top_app[key].append(round(float(miq_swap_result.group(i + 1)) / 1024, 2))
+                else:
+                    logger.error('Issue with miq_swap regex: %s', top_line)
+
+    top_appliance = dict((key, column.tolist()) for key, column in top_app.iteritems())
+    top_appliance['datetimes'] = top_app_datetimes
+    top_workers = {}
+    for worker_id, (datetimes, columns) in top_wkr.iteritems():
+        top_workers[worker_id] = dict((key, column.tolist()) for key, column in columns.iteritems())
+        top_workers[worker_id]['datetimes'] = datetimes
+    return top_appliance, top_workers, line_count
+
+
+def top_to_appliance(top_file):
+    top_appliance, top_workers, line_count = top_to_appliance_and_workers(top_file, {})
+    return top_appliance, line_count
+
+
+def top_to_workers(workers, top_file):
+    top_appliance, top_workers, line_count = top_to_appliance_and_workers(top_file, workers)
+    return top_workers, line_count
 
 
-def perf_process_evm(evm_file, top_file):
+def perf_process_evm(evm_file, top_file, sketches=False):
     msg_filters = {
         '-hourly': re.compile(r'\"[0-9\-]*T[0-9\:]*Z\",\s\"hourly\"'),
         '-daily': re.compile(r'\"[0-9\-]*T[0-9\:]*Z\",\s\"daily\"'),
@@ -808,22 +979,18 @@ def perf_process_evm(evm_file, top_file):
     starttime = time()
     initialtime = starttime
 
-    logger.info('----------- Parsing evm log file for messages -----------')
-    messages, msg_cmds, test_start, test_end, msg_lc = evm_to_messages(evm_file, msg_filters)
+    logger.info('----------- Parsing evm log file for messages and workers -----------')
+    msg_table, evm_workers, test_start, test_end, msg_lc = parse_evm_log(evm_file, msg_filters)
+    workers, wkr_mem_exc, wkr_upt_exc, wkr_stp, wkr_int, wkr_ext, wkr_lc = evm_workers
+    msg_cmds = msg_table.to_msg_cmds()
     timediff = time() - starttime
     logger.info('----------- Completed Parsing evm log file -----------')
-    logger.info('Parsed %s lines of evm log file for messages in %s', msg_lc, timediff)
-    logger.info('Total # of Messages: %d', len(messages))
+    logger.info('Parsed %s lines of evm log file for messages and workers in %s', msg_lc,
+        timediff)
+    logger.info('Total # of Messages: %d', len(msg_table))
     logger.info('Total # of Commands: %d', len(msg_cmds))
     logger.info('Start Time: %s', test_start)
     logger.info('End Time: %s', test_end)
-
-    logger.info('----------- Parsing evm log file for workers -----------')
-    starttime = time()
-    workers, wkr_mem_exc, wkr_upt_exc, wkr_stp, wkr_int, wkr_ext, wkr_lc = evm_to_workers(evm_file)
-    timediff = time() - starttime
-    logger.info('----------- Completed Parsing evm log for workers -----------')
-    logger.info('Parsed %s lines of evm log file for workers in %s', wkr_lc, timediff)
     logger.info('Total # of Workers: %d', len(workers))
     logger.info('# Workers Memory Exceeded: %s', wkr_mem_exc)
     logger.info('# Workers Uptime Exceeded: %s', wkr_upt_exc)
@@ -831,35 +998,28 @@ def perf_process_evm(evm_file, top_file):
     logger.info('# Workers Stopped: %s', wkr_stp)
     logger.info('# Workers Interrupted: %s', wkr_int)
 
-    logger.info('----------- Parsing top_output log file for Appliance Metrics -----------')
+    logger.info('------- Parsing top_output log file for Appliance and Worker Metrics -------')
     starttime = time()
-    top_appliance, tp_lc = top_to_appliance(top_file)
+    top_appliance, top_workers, tp_lc = top_to_appliance_and_workers(top_file, workers)
     timediff = time() - starttime
     logger.info('----------- Completed Parsing top_output log -----------')
-    logger.info('Parsed %s lines of top_output file for Appliance Metrics in %s', tp_lc,
+    logger.info('Parsed %s lines of top_output file for Appliance and Worker Metrics in %s', tp_lc,
         timediff)
 
-    logger.info('----------- Parsing top_output log file for worker CPU/Mem -----------')
-    starttime = time()
-    top_workers, tp_lc = top_to_workers(workers, top_file)
-    timediff = time() - starttime
-    logger.info('----------- Completed Parsing top_output log -----------')
-    logger.info('Parsed %s lines of top_output file for workers in %s', tp_lc, timediff)
-
     charts_dir = log_path.join('charts')
     if not os.path.exists(str(charts_dir)):
         os.mkdir(str(charts_dir))
 
     logger.info('----------- Generating Raw Data csv files -----------')
     starttime = time()
-    generate_raw_data_csv(messages, 'queue-rawdata.csv')
+    generate_raw_data_csv(msg_table, 'queue-rawdata.csv')
     generate_raw_data_csv(workers, 'workers-rawdata.csv')
     timediff = time() - starttime
     logger.info('Generated Raw Data csv files in: %s', timediff)
 
     logger.info('----------- Generating Hourly Buckets -----------')
     starttime = time()
-    hr_bkt = messages_to_hourly_buckets(messages, test_start, test_end)
+    hr_bkt = messages_to_hourly_buckets(msg_table, test_start, test_end)
     timediff = time() - starttime
     logger.info('Generated Hourly Buckets in: %s', timediff)
 
@@ -889,7 +1049,7 @@ def perf_process_evm(evm_file, top_file):
 
     logger.info('----------- Generating Message Statistics -----------')
     starttime = time()
-    messages_to_statistics_csv(messages, 'queue-statistics.csv')
+    messages_to_statistics_csv(msg_table, 'queue-statistics.csv', sketches)
     timediff = time() - starttime
     logger.info('Generated Message Statistics in: %s', timediff)
 
@@ -923,7 +1083,7 @@ def perf_process_evm(evm_file, top_file):
     html_menu.write('Parsed {} lines for messages<br>'.format(msg_lc))
     html_menu.write('Start Time: {}<br>'.format(test_start))
     html_menu.write('End Time: {}<br>'.format(test_end))
-    html_menu.write('Message Count: {}<br>'.format(len(messages)))
+    html_menu.write('Message Count: {}<br>'.format(len(msg_table)))
     html_menu.write('Command Count: {}<br>'.format(len(msg_cmds)))
 
     html_menu.write('Parsed {} lines for workers<br>'.format(wkr_lc))
@@ -975,7 +1135,7 @@ def perf_process_evm(evm_file, top_file):
     html_wkr_menu.write('Parsed {} lines for messages<br>'.format(msg_lc))
     html_wkr_menu.write('Start Time: {}<br>'.format(test_start))
     html_wkr_menu.write('End Time: {}<br>'.format(test_end))
-    html_wkr_menu.write('Message Count: {}<br>'.format(len(messages)))
+    html_wkr_menu.write('Message Count: {}<br>'.format(len(msg_table)))
     html_wkr_menu.write('Command Count: {}<br>'.format(len(msg_cmds)))
 
     html_wkr_menu.write('Parsed {} lines for workers<br>'.format(wkr_lc))
@@ -1054,15 +1214,77 @@ class MiqMsgStat(object):
             str(self.del_time) + ' : ' + str(self.total_time)
 
 
-class MiqMsgLists(object):
-
-    def __init__(self):
-        self.cmd = ''
-        self.puts = 0
-        self.gets = 0
-        self.dequeuetimes = []
-        self.delivertimes = []
-        self.totaltimes = []
+def _timestamp_strings(timestamps):
+    """Formats datetime64 timestamps the way evm.log has them, and NaT as empty strings"""
+    strings = numpy.datetime_as_string(timestamps, unit='us')
+    return [('' if ts == 'NaT' else ts.replace('T', ' ')) for ts in strings]
+
+
+class MiqMsgTable(object):
+    """Columnar store of the messages put on the queue, see :py:func:`evm_to_message_table`
+
+    There is one numpy array for each :py:class:`MiqMsgStat` attribute, all in message id order.
+    Messages not (yet) taken off the queue have a NaT gettime, a 0 pid_get and 0 timings.
+    """
+    headers = MiqMsgStat().headers
+
+    def __init__(self, msg_id, msg_cmd, msg_args, pid_put, puttime):
+        size = len(msg_id)
+        self.msg_id = msg_id
+        self.msg_cmd = msg_cmd
+        self.msg_args = msg_args
+        self.pid_put = pid_put
+        self.puttime = puttime
+        self.pid_get = numpy.zeros(size, dtype=numpy.int32)
+        self.gettime = numpy.empty(size, dtype='datetime64[us]')
+        self.gettime[:] = numpy.datetime64('NaT')
+        self.deq_time = numpy.zeros(size)
+        self.del_time = numpy.zeros(size)
+        self.total_time = numpy.zeros(size)
+
+    def __len__(self):
+        return len(self.msg_id)
+
+    def rows(self):
+        """Yields the messages as dicts, the way ``dict(MiqMsgStat)`` has them"""
+        puttimes = _timestamp_strings(self.puttime)
+        gettimes = _timestamp_strings(self.gettime)
+        for i in range(len(self)):
+            yield {
+                'msg_id': '\'{}\''.format(self.msg_id[i]),
+                'msg_cmd': self.msg_cmd[i],
+                'msg_args': self.msg_args[i],
+                'pid_put': str(self.pid_put[i]),
+                'pid_get': str(self.pid_get[i]) if self.pid_get[i] else '',
+                'puttime': puttimes[i],
+                'gettime': gettimes[i],
+                'deq_time': float(self.deq_time[i]),
+                'del_time': float(self.del_time[i]),
+                'total_time': float(self.total_time[i]),
+            }
+
+    def to_messages(self):
+        """dict of :py:class:`MiqMsgStat` by message id"""
+        messages = {}
+        for row in self.rows():
+            msg = MiqMsgStat()
+            for header in self.headers:
+                setattr(msg, header, row[header])
+            messages[row['msg_id'].strip('\'')] = msg
+        return messages
+
+    def to_msg_cmds(self):
+        """Rounded total, queue and execute timings of the delivered messages by command"""
+        msg_cmds = {}
+        delivered = self.total_time != 0
+        for cmd in set(self.msg_cmd):
+            selected = (self.msg_cmd == cmd) & delivered
+            msg_cmds[cmd] = {
+                'total': list(numpy.round(self.total_time[selected], 2)),
+                'queue': list(numpy.round(self.deq_time[selected], 2)),
+                'execute': list(numpy.round(self.del_time[selected], 2)),
+            }
+        return msg_cmds
 
 
 class MiqMsgBucket(object):
@@ -1094,20 +1316,23 @@ class MiqMsgBucket(object):
 
 
 class MiqWorker(object):
-
-    def __init__(self):
-        self.headers = ['worker_id', 'worker_type', 'pid', 'start_ts', 'end_ts', 'terminated']
-        self.worker_id = 0
-        self.worker_type = ''
-        self.pid = ''
-        self.start_ts = ''
-        self.end_ts = ''
-        self.terminated = ''
+    __slots__ = ('worker_id', 'worker_type', 'pid', 'start_ts', 'end_ts', 'terminated')
+    headers = list(__slots__)
+
+    def __init__(self, worker_id=0, worker_type='', pid='', start_ts='', end_ts='',
+            terminated=''):
+        # worker types and pids repeat for every recycled worker, share the strings
+        self.worker_id = worker_id
+        self.worker_type = intern(worker_type)
+        self.pid = intern(pid)
+        self.start_ts = start_ts
+        self.end_ts = end_ts
+        self.terminated = terminated
 
     def __iter__(self):
         for header in self.headers:
             yield header, getattr(self, header)
 
     def __str__(self):
-        return self.worker_id + ' : ' + self.worker_type + ' : ' + self.pid + ' : ' + \
-            str(self.start_ts) + ' : ' + str(self.end_ts) + ' : ' + self.terminated
+        return '{} : {} : {} : {} : {} : {}'.format(self.worker_id, self.worker_type, self.pid,
+            self.start_ts, self.end_ts, self.terminated)
@@ -1,18 +1,24 @@
 # -*- coding: utf-8 -*-
 import fauxfactory
 import iso8601
+import os
 import re
+import select
 import socket
 import sys
-from collections import namedtuple
+from collections import defaultdict, deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from os import path as os_path
+from threading import Condition, Event, RLock, Thread
+from time import time
 from urlparse import urlparse
+from uuid import uuid4
 
 import paramiko
 from scp import SCPClient
 import diaper
 
-from utils import conf, ports, version
+from utils import at_exit, conf, ports, version
 from utils.log import logger
 from utils.net import net_check
 from fixtures.pytest_store import store
@@ -25,6 +31,27 @@ from utils.timeutil import parsetime
 # in seconds (float)
 RUNCMD_TIMEOUT = 1200.0
 
+# Most output read off a command channel at once, in bytes
+RECV_CHUNK_SIZE = 32768
+
+# Pooled transports nobody has used for this long are closed, in seconds
+POOL_IDLE_TIMEOUT = 300.0
+
+# Most sshd configurations allow 10 sessions per connection (MaxSessions)
+MAX_CHANNELS = 10
+
+# Lines a tail subscription holds before it starts dropping the oldest ones
+TAIL_BUFFER_SIZE = 100000
+
+# How long to wait for the lines written just before a tail subscription is read, in seconds
+TAIL_SYNC_TIMEOUT = 30.0
+
+# Start of the name of the file every tail process also follows, to find where it has got to
+TAIL_SYNC_FILE = '/tmp/cfme_tests_tail_sync_'
+
+# How long to wait for a new tail process to start following its files, in seconds
+TAIL_START_TIMEOUT = 10.0
+
 
 class SSHResult(namedtuple("SSHResult", ["rc", "output"])):
     """Allows rich comparison for more convenient testing.
@@ -75,12 +102,209 @@ class SSHResult(namedtuple("SSHResult", ["rc", "output"])):
             raise ValueError('You can only compare SSHResult with str or int')
 
 
+class _PooledTransport(object):
+    def __init__(self, transport):
+        self.transport = transport
+        self.users = 0
+        self.last_used = time()
+
+
+class SSHTransportPool(object):
+    """Per-process pool of connected paramiko transports
+
+    :py:class:`SSHClient` instances connecting to the same host as the same user share one
+    transport, so only the first of them pays for the handshake. Every command opens its own
+    channel on the shared transport, so commands from several threads run concurrently.
+
+    Transports are checked to be alive before they are handed out, and transports that no client
+    has used for :py:data:`POOL_IDLE_TIMEOUT` seconds are closed.
+    """
+    def __init__(self, idle_timeout=POOL_IDLE_TIMEOUT):
+        self.idle_timeout = idle_timeout
+        self._lock = RLock()
+        self._pid = os.getpid()
+        self._transports = {}
+
+    def _check_pid(self):
+        # a forked child can't use its parent's connections
+        if os.getpid() != self._pid:
+            self._pid = os.getpid()
+            self._transports = {}
+
+    @staticmethod
+    def _healthy(transport):
+        if not transport.is_active():
+            return False
+        try:
+            transport.send_ignore()
+        except (EOFError, socket.error, paramiko.SSHException):
+            return False
+        return True
+
+    def acquire(self, key):
+        """Get a live pooled transport for ``key``, or ``None`` if there isn't one"""
+        with self._lock:
+            self._check_pid()
+            self.evict_idle()
+            pooled = self._transports.get(key)
+            if pooled is None:
+                return None
+            if not self._healthy(pooled.transport):
+                logger.trace('discarding dead pooled ssh transport for %r', key)
+                del self._transports[key]
+                diaper(pooled.transport.close)
+                return None
+            pooled.users += 1
+            pooled.last_used = time()
+            return pooled.transport
+
+    def add(self, key, transport):
+        """Put a freshly connected transport in the pool, it counts as used by its client"""
+        with self._lock:
+            self._check_pid()
+            previous = self._transports.get(key)
+            if previous is not None and previous.transport is not transport:
+                # another client won the race, keep it open for its users until it goes idle
+                return
+            pooled = self._transports[key] = _PooledTransport(transport)
+            pooled.users = 1
+
+    def release(self, key, transport):
+        """A client stopped using its transport, it stays open until it goes idle"""
+        with self._lock:
+            pooled = self._transports.get(key)
+            if pooled is None or pooled.transport is not transport:
+                # not (or no longer) pooled
+                transport.close()
+                return
+            pooled.users = max(pooled.users - 1, 0)
+            pooled.last_used = time()
+
+    def evict_idle(self):
+        with self._lock:
+            now = time()
+            for key, pooled in list(self._transports.items()):
+                if not pooled.users and now - pooled.last_used > self.idle_timeout:
+                    logger.trace('closing idle pooled ssh transport for %r', key)
+                    del self._transports[key]
+                    diaper(pooled.transport.close)
+
+    def close_all(self):
+        with self._lock:
+            transports, self._transports = self._transports, {}
+            for pooled in transports.values():
+                diaper(pooled.transport.close)
+
+
+transport_pool = SSHTransportPool()
+at_exit(transport_pool.close_all)
+
+
 _ssh_key_file = project_path.join('.generated_ssh_key')
 _ssh_pubkey_file = project_path.join('.generated_ssh_key.pub')
 
 _client_session = []
 
 
+def batch_script(commands, marker, fail_fast=True):
+    """Build the shell script :py:meth:`SSHClient.run_batch` runs
+
+    Every command is followed by a line with the marker, the index of the command and its exit
+    status, preceded by a newline in case the output of the command didn't end with one.
+    """
+    script = []
+    for index, command in enumerate(commands):
+        script.append('(\n{}\n) 2>&1'.format(command))
+        script.append('__batch_rc=$?')
+        script.append("printf '\\n%s %d %d\\n' {} {} $__batch_rc".format(marker, index))
+        if fail_fast:
+            script.append('[ $__batch_rc -eq 0 ] || exit $__batch_rc')
+    return '\n'.join(script)
+
+
+def parse_batch_output(output, marker):
+    """Split the output of a :py:func:`batch_script` into one :py:class:`SSHResult` per command"""
+    results = []
+    start = 0
+    # \r for the pseudo-tty sudo runs with
+    for match in re.finditer(r'\r?\n{} (\d+) (\d+)\r?\n'.format(re.escape(marker)), output):
+        results.append(SSHResult(int(match.group(2)), output[start:match.start()]))
+        start = match.end()
+    return results
+
+
+class SSHCommandStream(object):
+    """Output of a command running over SSH, see :py:meth:`SSHClient.stream_command`
+
+    The channel is waited on with ``select``, so waiting for output doesn't keep a CPU busy, and
+    output is read in chunks of at most :py:data:`RECV_CHUNK_SIZE` bytes, so it never has to be
+    held in memory as a whole.
+
+    Iterating over the stream yields output lines, stdout and stderr mixed in the order they
+    arrived. :py:meth:`chunks` hands out the raw chunks. Once the output is exhausted, the exit
+    status of the command is available as :py:attr:`rc`.
+    """
+    def __init__(self, channel, command, timeout, streaming=False):
+        self.channel = channel
+        self.command = command
+        self.timeout = timeout
+        self.streaming = streaming
+        self.rc = None
+
+    def chunks(self):
+        """Yield ``(is_stderr, data)`` tuples as the command produces output"""
+        channel = self.channel
+        deadline = time() + self.timeout if self.timeout else None
+        try:
+            while True:
+                # all the output has been received by the time the EOF arrives
+                eof = channel.eof_received
+                received = False
+                if channel.recv_ready():
+                    data = channel.recv(RECV_CHUNK_SIZE)
+                    if data:
+                        received = True
+                        if self.streaming:
+                            sys.stdout.write(data)
+                        yield False, data
+                if channel.recv_stderr_ready():
+                    data = channel.recv_stderr(RECV_CHUNK_SIZE)
+                    if data:
+                        received = True
+                        if self.streaming:
+                            sys.stderr.write(data)
+                        yield True, data
+                if received:
+                    continue
+                if eof or channel.closed:
+                    break
+                if deadline is None:
+                    wait = None
+                else:
+                    wait = deadline - time()
+                    if wait <= 0:
+                        raise socket.timeout()
+                # the channel is readable on new stdout or stderr data, and on EOF
+                select.select([channel], [], [], wait)
+            if deadline is None:
+                channel.status_event.wait()
+            elif not channel.status_event.wait(max(deadline - time(), 0)):
+                raise socket.timeout()
+            self.rc = channel.recv_exit_status()
+        finally:
+            channel.close()
+
+    def __iter__(self):
+        partial = ''
+        for _, data in self.chunks():
+            lines = (partial + data).split('\n')
+            partial = lines.pop()
+            for line in lines:
+                yield line + '\n'
+        if partial:
+            yield partial
+
+
 class SSHClient(paramiko.SSHClient):
     """paramiko.SSHClient wrapper
 
@@ -89,10 +313,16 @@ class SSHClient(paramiko.SSHClient):
 
     If ``container`` param is specified, then it is assumed that the VM hosts a container of CFME.
     The ``container`` param then contains the name of the container.
+
+    Connections are shared through :py:data:`transport_pool` by all clients logging in to the
+    same host and port as the same user, unless ``use_pool=False`` is passed.
     """
-    def __init__(self, stream_output=False, **connect_kwargs):
+    def __init__(self, stream_output=False, use_pool=True, **connect_kwargs):
         super(SSHClient, self).__init__()
         self._streaming = stream_output
+        self._use_pool = use_pool
+        # pool key the current transport was acquired under
+        self._pooled_key = None
         # deprecated/useless karg, included for backward-compat
         self._keystate = connect_kwargs.pop('keystate', None)
         self._container = connect_kwargs.pop('container', None)
@@ -167,8 +397,17 @@ class SSHClient(paramiko.SSHClient):
     def close(self):
         with diaper:
             _client_session.remove(self)
+        if self._pooled_key is not None and self._transport is not None:
+            transport_pool.release(self._pooled_key, self._transport)
+            self._transport = None
+        self._pooled_key = None
         super(SSHClient, self).close()
 
+    @property
+    def _pool_key(self):
+        return (
+            self._connect_kwargs['hostname'], self._connect_kwargs.get('port', 22), self.username)
+
     @property
     def connected(self):
         return self._transport and self._transport.active
@@ -181,9 +420,24 @@ class SSHClient(paramiko.SSHClient):
 
         if not self.connected:
             self._connect_kwargs.update(kwargs)
+            if self._use_pool:
+                if self._pooled_key is not None and self._transport is not None:
+                    # our pooled transport died, give it back before getting a new one
+                    transport_pool.release(self._pooled_key, self._transport)
+                    self._transport = None
+                transport = transport_pool.acquire(self._pool_key)
+                if transport is not None:
+                    logger.trace('reusing pooled ssh transport for %r', self._pool_key)
+                    self._transport = transport
+                    self._pooled_key = self._pool_key
+                    return
             self._check_port()
             # Only install ssh keys if they aren't installed (or currently being installed)
-            return super(SSHClient, self).connect(**self._connect_kwargs)
+            result = super(SSHClient, self).connect(**self._connect_kwargs)
+            if self._use_pool:
+                self._pooled_key = self._pool_key
+                transport_pool.add(self._pooled_key, self._transport)
+            return result
 
     def open_sftp(self, *args, **kwargs):
         if self.is_container:
@@ -200,23 +454,7 @@ class SSHClient(paramiko.SSHClient):
             self.connect()
         return super(SSHClient, self).get_transport(*args, **kwargs)
 
-    def run_command(
-            self, command, timeout=RUNCMD_TIMEOUT, reraise=False, ensure_host=False,
-            ensure_user=False):
-        """Run a command over SSH.
-
-        Args:
-            command: The command. Supports taking dicts as version picking.
-            timeout: Timeout after which the command execution fails.
-            reraise: Does not muffle the paramiko exceptions in the log.
-            ensure_host: Ensure that the command is run on the machine with the IP given, not any
-                container or such that we might be using by default.
-            ensure_user: Ensure that the command is run as the user we logged in, so in case we are
-                not root, setting this to True will prevent from running sudo.
-
-        Returns:
-            A :py:class:`SSHResult` instance.
-        """
+    def _open_command_channel(self, command, timeout, ensure_host, ensure_user):
         if isinstance(command, dict):
             command = version.pick(command)
         logger.info("Parsing command `{command}`".format(command=command))
@@ -233,34 +471,74 @@ class SSHClient(paramiko.SSHClient):
         logger.info("Running command `{command}`".format(command=command))
         command += '\n'
 
-        output = []
+        session = self.get_transport().open_session()
+        if uses_sudo:
+            # We need a pseudo-tty for sudo
+            session.get_pty()
+        if timeout:
+            session.settimeout(float(timeout))
+        session.exec_command(command)
+        return SSHCommandStream(session, command, timeout, streaming=self._streaming)
+
+    def stream_command(
+            self, command, timeout=RUNCMD_TIMEOUT, ensure_host=False, ensure_user=False):
+        """Run a command over SSH, handing out its output as it arrives.
+
+        Takes the same arguments as :py:meth:`run_command`, except that paramiko exceptions
+        are always raised.
+
+        Usage:
+
+            stream = ssh_client.stream_command('cat /var/www/miq/vmdb/log/evm.log')
+            for line in stream:
+                ...
+            assert stream.rc == 0
+
+        Returns:
+            A :py:class:`SSHCommandStream` instance.
+        """
+        return self._open_command_channel(command, timeout, ensure_host, ensure_user)
+
+    def run_command(
+            self, command, timeout=RUNCMD_TIMEOUT, reraise=False, ensure_host=False,
+            ensure_user=False, max_output=None):
+        """Run a command over SSH.
+
+        Args:
+            command: The command. Supports taking dicts as version picking.
+            timeout: Timeout after which the command execution fails.
+            reraise: Does not muffle the paramiko exceptions in the log.
+            ensure_host: Ensure that the command is run on the machine with the IP given, not any
+                container or such that we might be using by default.
+            ensure_user: Ensure that the command is run as the user we logged in, so in case we are
+                not root, setting this to True will prevent from running sudo.
+            max_output: If set, only the last ``max_output`` bytes of the output are kept.
+
+        Returns:
+            A :py:class:`SSHResult` instance.
+        """
+        output = deque()
+        output_size = 0
+        dropped = 0
         try:
-            session = self.get_transport().open_session()
-            if uses_sudo:
-                # We need a pseudo-tty for sudo
-                session.get_pty()
-            if timeout:
-                session.settimeout(float(timeout))
-            session.exec_command(command)
-            stdout = session.makefile()
-            stderr = session.makefile_stderr()
-            while True:
-                if session.recv_ready:
-                    for line in stdout:
-                        output.append(line)
-                        if self._streaming:
-                            sys.stdout.write(line)
-
-                if session.recv_stderr_ready:
-                    for line in stderr:
-                        output.append(line)
-                        if self._streaming:
-                            sys.stderr.write(line)
-
-                if session.exit_status_ready():
-                    break
-            exit_status = session.recv_exit_status()
-            return SSHResult(exit_status, ''.join(output))
+            stream = self._open_command_channel(command, timeout, ensure_host, ensure_user)
+            command = stream.command
+            for _, data in stream.chunks():
+                output.append(data)
+                output_size += len(data)
+                while max_output is not None and output_size > max_output:
+                    # drop whole chunks, then trim the oldest one kept
+                    excess = output_size - max_output
+                    if len(output[0]) <= excess:
+                        excess = len(output.popleft())
+                    else:
+                        output[0] = output[0][excess:]
+                    output_size -= excess
+                    dropped += excess
+            if dropped:
+                logger.warning('Dropped the first {} bytes of the output of `{}`'.format(
+                    dropped, command))
+            return SSHResult(stream.rc, ''.join(output))
         except paramiko.SSHException as exc:
             if reraise:
                 raise
@@ -276,6 +554,56 @@ class SSHClient(paramiko.SSHClient):
         # Returning two things so tuple unpacking the return works even if the ssh client fails
         return SSHResult(1, None)
 
+    def run_batch(self, commands, fail_fast=True, timeout=RUNCMD_TIMEOUT, **kwargs):
+        """Run several commands as one remote shell script, in a single round trip.
+
+        Each command runs in its own subshell with stderr merged into stdout, the same way
+        :py:meth:`run_command` reports output, so changes to the shell state (``cd``, variables)
+        don't carry over to the following commands.
+
+        Args:
+            commands: The commands. Each supports taking dicts as version picking.
+            fail_fast: If ``True``, stop at the first command that fails, otherwise run them all.
+            timeout: Timeout for the whole batch.
+            **kwargs: Passed to :py:meth:`run_command`
+
+        Returns:
+            A list of :py:class:`SSHResult` instances, one for each command that was run. With
+            ``fail_fast``, the last one is the failed command, if any failed.
+        """
+        commands = [
+            version.pick(command) if isinstance(command, dict) else command
+            for command in commands]
+        if not commands:
+            return []
+        marker = 'SSHBATCH{}'.format(fauxfactory.gen_alphanumeric(16))
+        result = self.run_command(
+            batch_script(commands, marker, fail_fast), timeout=timeout, **kwargs)
+        if result.output is None:
+            # the ssh client failed, same as run_command
+            return [SSHResult(1, None)]
+        return parse_batch_output(result.output, marker)
+
+    def run_commands_concurrently(self, commands, max_channels=MAX_CHANNELS, **kwargs):
+        """Run several commands at once, each in its own channel on this client's transport
+
+        Args:
+            commands: The commands to run
+            max_channels: How many commands may run at the same time
+            **kwargs: Passed to :py:meth:`run_command`
+
+        Returns:
+            A list of :py:class:`SSHResult` instances, in the order of ``commands``
+        """
+        commands = list(commands)
+        if not commands:
+            return []
+        # connect before the threads start, so they all share one transport
+        self.connect()
+        with ThreadPoolExecutor(max_workers=min(max_channels, len(commands))) as executor:
+            return list(executor.map(lambda command: self.run_command(command, **kwargs),
+                                     commands))
+
     def cpu_spike(self, seconds=60, cpus=2, **kwargs):
         """Creates a CPU spike of specific length and processes.
 
@@ -499,50 +827,355 @@ class SSHClient(paramiko.SSHClient):
         return {"servers": servers, "workers": workers}
 
 
+class TailSubscription(object):
+    """Bounded buffer of the lines appended to a remote file, see :py:class:`SSHTailService`
+
+    Once the buffer holds ``maxlen`` lines, the oldest lines are dropped for new ones, and counted
+    in :py:attr:`dropped`.
+    """
+    def __init__(self, service, filename, maxlen=TAIL_BUFFER_SIZE):
+        self.service = service
+        self.filename = filename
+        self.dropped = 0
+        self.closed = False
+        self._lines = deque(maxlen=maxlen)
+        self._cond = Condition()
+
+    def put(self, line):
+        with self._cond:
+            if len(self._lines) == self._lines.maxlen:
+                self.dropped += 1
+            self._lines.append(line)
+            self._cond.notify_all()
+
+    def sync(self, timeout=TAIL_SYNC_TIMEOUT):
+        """Wait until the lines written to the file before the call have arrived
+
+        See :py:meth:`_TailProcess.sync`.
+
+        Returns:
+            Whether the lines arrived in time
+        """
+        process = self.service.process_of(self.filename)
+        if process is None:
+            logger.warning('%s is not followed on %s', self.filename, self.service.ssh_client)
+            return False
+        return process.sync(timeout)
+
+    def get_lines(self, sync=True):
+        """Take all the buffered lines, without line endings
+
+        Args:
+            sync: Whether to :py:meth:`sync` first, so the lines written right before the call
+                are included
+        """
+        if sync:
+            self.sync()
+        with self._cond:
+            lines = list(self._lines)
+            self._lines.clear()
+        return lines
+
+    def wait_for(self, pattern, timeout=60):
+        """Take lines until one matches the regular expression, waiting for new lines to arrive
+
+        Returns:
+            The matching line, or ``None`` if no line matched in time.
+        """
+        regex = re.compile(pattern)
+        deadline = time() + timeout
+        with self._cond:
+            while True:
+                while self._lines:
+                    line = self._lines.popleft()
+                    if regex.search(line):
+                        return line
+                remaining = deadline - time()
+                if remaining <= 0 or self.closed:
+                    return None
+                self._cond.wait(remaining)
+
+    def close(self):
+        self.service.unsubscribe(self)
+        with self._cond:
+            self.closed = True
+            self._cond.notify_all()
+
+
+class _TailProcess(object):
+    """One remote ``tail -F`` following several files, its output is read by a thread"""
+    header = re.compile(r'^==> (.+) <==$')
+
+    def __init__(self, service, filenames):
+        self.service = service
+        self.filenames = set(filenames)
+        self.pid = None
+        self.ready = Event()
+        self.exited = False
+        self.marker_file = '{}{}'.format(TAIL_SYNC_FILE, uuid4().hex)
+        self._cond = Condition()
+        self._pending_markers = set()
+        self._not_started = set(filenames) | {self.marker_file}
+        # -F follows the file names, so it carries on with the new file after a rotation, and
+        # starts from the beginning of a truncated file. -v prints a header when the file the
+        # output comes from changes, and for every file once it is being followed.
+        command = 'echo $$; touch {marker}; exec tail -n 0 -v -F {files} {marker}'.format(
+            marker=quote(self.marker_file),
+            files=' '.join(quote(filename) for filename in sorted(filenames)))
+        self.stream = service.ssh_client.stream_command(command, timeout=None)
+        self.thread = Thread(target=self._read, name='tail {}'.format(service.ssh_client))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _read(self):
+        filename = None
+        # tail separates the output of different files with an empty line before the header
+        held_empty = False
+        try:
+            for line in self.stream:
+                # \r for the pseudo-tty sudo runs with
+                line = line.rstrip('\r\n')
+                if self.pid is None:
+                    self.pid = line.strip()
+                    continue
+                match = self.header.match(line)
+                if match:
+                    filename = match.group(1)
+                    held_empty = False
+                    self._not_started.discard(filename)
+                    if not self._not_started:
+                        self.ready.set()
+                    continue
+                if filename == self.marker_file:
+                    # markers are never empty, an empty line only comes before the next header
+                    if line:
+                        with self._cond:
+                            self._pending_markers.discard(line)
+                            self._cond.notify_all()
+                    continue
+                if held_empty:
+                    self.service.dispatch(filename, '')
+                    held_empty = False
+                if not line:
+                    held_empty = True
+                elif line.startswith('tail: '):
+                    # messages about rotation, truncation or missing files
+                    logger.debug('%s: %s', self.service.ssh_client, line)
+                else:
+                    self.service.dispatch(filename, line)
+        except Exception as e:
+            logger.warning('Tailing %s on %s failed: %s', ', '.join(self.filenames),
+                self.service.ssh_client, e)
+        finally:
+            with self._cond:
+                self.exited = True
+                self._cond.notify_all()
+            self.ready.set()
+            self.service.process_exited(self)
+
+    def sync(self, timeout=TAIL_SYNC_TIMEOUT):
+        """Wait until the lines written to the followed files before the call have arrived
+
+        A unique marker line is appended to :py:attr:`marker_file`, and as tail reads the changes
+        of its files in the order they were made, all the earlier lines have arrived once the
+        marker came through. The followed files themselves are never written to.
+
+        Returns:
+            Whether the marker came through in time
+        """
+        marker = uuid4().hex
+        with self._cond:
+            self._pending_markers.add(marker)
+        result = self.service.ssh_client.run_command(
+            'echo {} >> {}'.format(marker, quote(self.marker_file)))
+        deadline = time() + timeout
+        with self._cond:
+            if result.rc != 0:
+                self._pending_markers.discard(marker)
+                logger.warning('Could not mark %s to sync its tail: %s', self.marker_file,
+                    result.output)
+                return False
+            while marker in self._pending_markers:
+                remaining = deadline - time()
+                if remaining <= 0 or self.exited:
+                    self._pending_markers.discard(marker)
+                    logger.warning('Lines of %s did not arrive in %ss',
+                        ', '.join(sorted(self.filenames)), timeout)
+                    return False
+                self._cond.wait(remaining)
+        return True
+
+    def stop(self):
+        command = 'rm -f {}'.format(quote(self.marker_file))
+        if self.pid:
+            command = 'kill {}; {}'.format(self.pid, command)
+        self.service.ssh_client.run_command(command)
+        diaper(self.stream.channel.close)
+
+
+class SSHTailService(object):
+    """Follows remote files on one host, handing out their new lines to subscribers
+
+    Files are followed by a remote ``tail -F``, whose output is read by a background thread and
+    put into the :py:class:`TailSubscription` buffers of the file it came from. Files subscribed
+    to together are followed by one ``tail`` process; files are only followed while somebody is
+    subscribed to them. Following survives the rotation and the truncation of the files.
+
+    Get the service of a host with :py:func:`tail_service`.
+    """
+    def __init__(self, ssh_client):
+        self.ssh_client = ssh_client
+        self._lock = RLock()
+        self._subscriptions = defaultdict(list)
+        self._processes = {}
+
+    def subscribe(self, filename, maxlen=TAIL_BUFFER_SIZE):
+        """Start collecting the lines appended to a remote file from now on
+
+        Returns:
+            A :py:class:`TailSubscription`
+        """
+        return self.subscribe_many([filename], maxlen=maxlen)[0]
+
+    def subscribe_many(self, filenames, maxlen=TAIL_BUFFER_SIZE):
+        """Like :py:meth:`subscribe`, following all the new files with one process"""
+        with self._lock:
+            subscriptions = [TailSubscription(self, filename, maxlen) for filename in filenames]
+            for subscription in subscriptions:
+                self._subscriptions[subscription.filename].append(subscription)
+            new = set(filenames) - set(self._processes)
+            if new:
+                process = _TailProcess(self, new)
+                for filename in new:
+                    self._processes[filename] = process
+            else:
+                process = None
+        if process is not None and not process.ready.wait(TAIL_START_TIMEOUT):
+            logger.warning('tail on %s is not following all of %s yet',
+                self.ssh_client, ', '.join(sorted(new)))
+        return subscriptions
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            subscriptions = self._subscriptions[subscription.filename]
+            if subscription in subscriptions:
+                subscriptions.remove(subscription)
+            process = self._processes.get(subscription.filename)
+            if process is None:
+                return
+            if not any(self._subscriptions[filename] for filename in process.filenames):
+                for filename in process.filenames:
+                    del self._processes[filename]
+            else:
+                process = None
+        if process is not None:
+            process.stop()
+
+    def process_of(self, filename):
+        """The :py:class:`_TailProcess` following a file, ``None`` if it isn't followed"""
+        with self._lock:
+            return self._processes.get(filename)
+
+    def dispatch(self, filename, line):
+        with self._lock:
+            subscriptions = list(self._subscriptions.get(filename, ()))
+        for subscription in subscriptions:
+            subscription.put(line)
+
+    def process_exited(self, process):
+        with self._lock:
+            for filename in process.filenames:
+                if self._processes.get(filename) is process:
+                    del self._processes[filename]
+                    logger.warning('Stopped following %s on %s', filename, self.ssh_client)
+
+    def close(self):
+        with self._lock:
+            processes = set(self._processes.values())
+            self._processes = {}
+        for process in processes:
+            diaper(process.stop)
+
+
+_tail_services = {}
+_tail_services_lock = RLock()
+
+
+def tail_service(ssh_client):
+    """Get the :py:class:`SSHTailService` of the host an :py:class:`SSHClient` connects to
+
+    There is one service per process for every host, container and user.
+    """
+    key = (os.getpid(), ssh_client._container) + ssh_client._pool_key
+    with _tail_services_lock:
+        service = _tail_services.get(key)
+        if service is None:
+            client = SSHClient(container=ssh_client._container, **ssh_client._connect_kwargs)
+            service = _tail_services[key] = SSHTailService(client)
+        return service
+
+
+def _close_tail_services():
+    with _tail_services_lock:
+        for key, service in list(_tail_services.items()):
+            if key[0] == os.getpid():
+                diaper(service.close)
+        _tail_services.clear()
+
+
+at_exit(_close_tail_services)
+
+
 class SSHTail(SSHClient):
+    """Lines appended to a remote file since the last time it was read
 
+    The file is followed by the :py:func:`tail_service` of the host, so reading it carries on
+    through rotations of the file, and only takes the round trip that marks how far the file
+    was written, see :py:meth:`TailSubscription.sync`.
+    """
     def __init__(self, remote_filename, **connect_kwargs):
         super(SSHTail, self).__init__(stream_output=False, **connect_kwargs)
         self._remote_filename = remote_filename
-        self._sftp_client = None
-        self._remote_file_size = None
+        self._subscription = None
 
     def __iter__(self):
         for line in self.raw_lines():
             yield line.rstrip()
 
     def raw_lines(self):
-        with self as sshtail:
-            fstat = sshtail._sftp_client.stat(self._remote_filename)
-            if self._remote_file_size is not None:
-                if self._remote_file_size < fstat.st_size:
-                    remote_file = self._sftp_client.open(self._remote_filename, 'r')
-                    remote_file.seek(self._remote_file_size, 0)
-                    while (remote_file.tell() < fstat.st_size):
-                        line = remote_file.readline()  # Note the  missing rstrip() here!
-                        yield line
-            self._remote_file_size = fstat.st_size
+        if self._subscription is None:
+            # the first read only marks where the file ends
+            self.set_initial_file_end()
+            return
+        for line in self._subscription.get_lines():
+            yield line + '\n'
 
     def raw_string(self):
         return ''.join(self)
 
-    def __enter__(self):
-        self.connect(**self._connect_kwargs)
-        self._sftp_client = self.open_sftp()
-        return self
-
-    def __exit__(self, *args, **kwargs):
-        self._sftp_client.close()
+    @property
+    def dropped_lines(self):
+        """How many lines were dropped because they weren't read quickly enough"""
+        if self._subscription is None:
+            return 0
+        return self._subscription.dropped
 
     def set_initial_file_end(self):
-        with self as sshtail:
-            fstat = sshtail._sftp_client.stat(self._remote_filename)
-            self._remote_file_size = fstat.st_size  # Seed initial size of file
+        if self._subscription is not None:
+            self._subscription.close()
+        self._subscription = tail_service(self).subscribe(self._remote_filename)
 
     def lines_as_list(self):
         """Return lines as list"""
         return list(self)
 
+    def close(self):
+        subscription = getattr(self, '_subscription', None)
+        if subscription is not None:
+            self._subscription = None
+            diaper(subscription.close)
+        super(SSHTail, self).close()
+
 
 def keygen():
     """Generate temporary ssh keypair for appliance SSH auth
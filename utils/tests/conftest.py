@@ -0,0 +1,12 @@
+import pytest
+
+
+class FakeCache(dict):
+    """The get/set interface of the pytest cache, in memory"""
+    def set(self, key, value):
+        self[key] = value
+
+
+@pytest.fixture
+def fake_cache():
+    return FakeCache()
@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+import pytest
+
+from utils.events import Event, EventAttr, ExpectationMatcher
+
+VMS = {'vm1': 1, 'vm2': 2}
+
+
+class FakeEventTool(object):
+    # the parts of EventTool events are built and matched with
+    event_streams_attributes = [
+        ('id', int), ('event_type', str), ('target_type', str), ('target_id', int),
+        ('message', str)]
+
+    def process_id(self, target_type, target_name):
+        if target_type != 'VmOrTemplate' or target_name not in VMS:
+            raise ValueError('{} {} is not in the db'.format(target_type, target_name))
+        return VMS[target_name]
+
+
+class RawEvent(object):
+    # an event_streams row
+    __tablename__ = 'event_streams'
+
+    def __init__(self, id, event_type, target_type='VmOrTemplate', target_id=1, message=None):
+        self.id = id
+        self.event_type = event_type
+        self.target_type = target_type
+        self.target_id = target_id
+        self.message = message
+
+
+RAW_EVENTS = [
+    RawEvent(1, 'vm_create', target_id=1, message='created'),
+    RawEvent(2, 'vm_create', target_id=2),
+    RawEvent(3, 'vm_start', target_id=1, message='started vm1'),
+    RawEvent(4, 'vm_start', target_type='Host', target_id=1),
+    RawEvent(5, 'host_add', target_type='Host', target_id=3, message='added'),
+    RawEvent(6, 'vm_create', target_id=3),
+]
+
+EXPECTED_EVENTS = [
+    dict(event_type='vm_create'),
+    dict(event_type='vm_create', target_type='VmOrTemplate', target_id=1),
+    dict(event_type='vm_start', target_type='VmOrTemplate', target_name='vm1'),
+    dict(event_type='vm_create', target_type='VmOrTemplate', target_name='vm3'),
+    dict(target_type='Host'),
+    dict(event_type='vm_create', message=None),
+    dict(event_type='vm_start', message='vm1',
+         cmp_func=lambda expected, got: expected in got),
+    dict(target_id=None),
+    dict(event_type='vm_delete'),
+]
+
+
+@pytest.fixture
+def tool():
+    return FakeEventTool()
+
+
+def expected_event(tool, cmp_func=None, **attrs):
+    event = Event(tool)
+    for name, value in attrs.items():
+        event.add_attrs(EventAttr(cmp_func=cmp_func, **{name: value}))
+    return {'event': event, 'callback': None, 'matched_events': [], 'first_event': False}
+
+
+def test_matcher_agrees_with_event_matches(tool):
+    # The matcher finds exactly the expected events Event.matches finds
+    matcher = ExpectationMatcher(tool)
+    exp_events = [expected_event(tool, **attrs) for attrs in EXPECTED_EVENTS]
+    for exp_event in exp_events:
+        matcher.add(exp_event)
+    matcher.resolve()
+    for raw_event in RAW_EVENTS:
+        got_event = Event(tool).build_from_raw_event(raw_event)
+        expected = [exp_event for exp_event in exp_events
+                    if exp_event['event'].matches(got_event)]
+        matched = matcher.match(raw_event)
+        assert sorted(map(id, matched)) == sorted(map(id, expected)), raw_event.id
+
+
+def test_matcher_resolves_target_name(tool):
+    # An expected event of a target not in the db yet matches once the target shows up
+    matcher = ExpectationMatcher(tool)
+    exp_event = expected_event(
+        tool, event_type='vm_create', target_type='VmOrTemplate', target_name='vm3')
+    matcher.add(exp_event)
+    matcher.resolve()
+    assert matcher.match(RAW_EVENTS[5]) == []
+    VMS['vm3'] = 3
+    try:
+        matcher.resolve()
+        assert matcher.match(RAW_EVENTS[5]) == [exp_event]
+        assert matcher.match(RAW_EVENTS[1]) == []
+    finally:
+        del VMS['vm3']
+
+
+def test_matcher_first_event(tool):
+    # An expected event waiting for the first event only stops matching once it has one
+    matcher = ExpectationMatcher(tool)
+    exp_event = expected_event(tool, event_type='vm_create')
+    exp_event['first_event'] = True
+    matcher.add(exp_event)
+    assert matcher.match(RAW_EVENTS[0]) == [exp_event]
+    exp_event['matched_events'].append(Event(tool).build_from_raw_event(RAW_EVENTS[0]))
+    assert matcher.match(RAW_EVENTS[1]) == []
+
+
+def test_matcher_clear(tool):
+    # Nothing matches once the matcher is cleared
+    matcher = ExpectationMatcher(tool)
+    matcher.add(expected_event(tool, event_type='vm_create'))
+    matcher.clear()
+    assert matcher.match(RAW_EVENTS[0]) == []
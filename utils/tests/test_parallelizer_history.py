@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+from fixtures.parallelizer.history import DURATIONS_KEY, DurationHistory
+
+
+class FakeReport(object):
+    def __init__(self, nodeid, when, duration):
+        self.nodeid = nodeid
+        self.when = when
+        self.duration = duration
+
+
+def run(history, nodeid, setup=1.0, call=2.0, teardown=3.0):
+    for when, duration in (('setup', setup), ('call', call), ('teardown', teardown)):
+        history.record(FakeReport(nodeid, when, duration))
+
+
+def test_duration_sums_phases(fake_cache):
+    # A test's duration is the sum of its phases
+    history = DurationHistory(fake_cache)
+    run(history, 'test_a')
+    history.save()
+    assert history.expected('test_a') == 6.0
+    assert fake_cache[DURATIONS_KEY] == {'test_a': 6.0}
+
+
+def test_duration_setup_resets(fake_cache):
+    # A test run again, e.g. after its slave died, only counts its last attempt
+    history = DurationHistory(fake_cache)
+    run(history, 'test_a', setup=100.0)
+    run(history, 'test_a')
+    history.save()
+    assert history.expected('test_a') == 6.0
+
+
+def test_duration_missing(fake_cache):
+    # Reports without a duration add nothing
+    history = DurationHistory(fake_cache)
+    run(history, 'test_a', call=None)
+    history.save()
+    assert history.expected('test_a') == 4.0
+
+
+def test_duration_blending(fake_cache):
+    # Later runs are blended with the history kept in the cache
+    history = DurationHistory(fake_cache)
+    run(history, 'test_a', setup=0.0, call=10.0, teardown=0.0)
+    history.save()
+    history = DurationHistory(fake_cache)
+    run(history, 'test_a', setup=0.0, call=20.0, teardown=0.0)
+    run(history, 'test_b')
+    history.save()
+    history = DurationHistory(fake_cache)
+    assert len(history) == 2
+    assert history.expected('test_a') == 15.0
+    assert history.expected('test_b') == 6.0
+
+
+def test_duration_save_clears_run(fake_cache):
+    # Saving twice doesn't blend a run into the history twice
+    history = DurationHistory(fake_cache)
+    run(history, 'test_a', setup=0.0, call=10.0, teardown=0.0)
+    history.save()
+    history.save()
+    assert history.expected('test_a') == 10.0
+
+
+def test_duration_default():
+    # Unknown tests are expected to take the mean of the known ones
+    history = DurationHistory(None)
+    assert history.default == DurationHistory.unknown_duration
+    assert history.expected('test_a') == DurationHistory.unknown_duration
+    run(history, 'test_a', setup=0.0, call=10.0, teardown=0.0)
+    run(history, 'test_b', setup=0.0, call=20.0, teardown=0.0)
+    history.save()
+    assert history.default == 15.0
+    assert history.expected('test_c') == 15.0
+
+
+def test_group_duration():
+    # A group takes the known durations of its tests, the mean for the unknown ones
+    history = DurationHistory(None)
+    assert history.group_duration(['test_a', 'test_b']) == 2 * DurationHistory.unknown_duration
+    run(history, 'test_a', setup=0.0, call=10.0, teardown=0.0)
+    run(history, 'test_b', setup=0.0, call=20.0, teardown=0.0)
+    history.save()
+    assert history.group_duration([]) == 0
+    assert history.group_duration(['test_a', 'test_b', 'test_c']) == 45.0
@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+import pytest
+
+from fixtures.parallelizer.history import SwitchCostHistory
+from fixtures.parallelizer.placement import (
+    ADD_NEW, ADD_SHARED, MATCH, NO_PROVIDERS, SWITCH, ProviderPlacement, provider_keys_from_id)
+
+
+@pytest.fixture
+def switch_costs():
+    return SwitchCostHistory(None)
+
+
+def placement(switch_costs, providers_per_appliance=2):
+    # every test is expected to take 10 seconds
+    return ProviderPlacement(providers_per_appliance, switch_costs, lambda tests: 10.0 * len(tests))
+
+
+@pytest.mark.parametrize(('param_id', 'provider_keys', 'expected'), [
+    ('vsphere55', ['vsphere55', 'rhos'], ['vsphere55']),
+    ('rhos-7-small_template', ['rhos', 'rhos-7', 'vsphere55'], ['rhos-7']),
+    ('small_template-rhos-7', ['rhos', 'rhos-7'], ['rhos-7']),
+    ('vsphere55-rhos-7', ['rhos', 'rhos-7', 'vsphere55'], ['rhos-7', 'vsphere55']),
+    ('rhos7-small_template', ['rhos'], []),
+    ('vsphere55', ['vsphere5'], []),
+])
+def test_provider_keys_from_id(param_id, provider_keys, expected):
+    # Keys match only whole dash-separated runs, the longest key winning
+    assert provider_keys_from_id(param_id, provider_keys) == expected
+
+
+def test_place_empty_pool(switch_costs):
+    # Nothing to place
+    assert placement(switch_costs).place(['a'], [], [], []) is None
+
+
+def test_place_match(switch_costs):
+    # A group of a provider the slave has wins over anything before it in the pool
+    result = placement(switch_costs).place(
+        ['a'], [], [['t1'], ['t2'], ['t3']], [[], ['b'], ['a']])
+    assert result.index == 2
+    assert result.category == MATCH
+    assert result.allocation == ['a']
+    assert not result.cleanse
+    assert result.cost == 0
+
+
+def test_place_add_new(switch_costs):
+    # A provider no other slave has is added, not one another slave already has
+    result = placement(switch_costs).place(
+        ['a'], [['b']], [['t1'], ['t2'], ['t3']], [[], ['b'], ['c']])
+    assert result.index == 2
+    assert result.category == ADD_NEW
+    assert result.allocation == ['a', 'c']
+    assert not result.cleanse
+    assert result.cost == SwitchCostHistory.default_cost
+
+
+def test_place_no_providers(switch_costs):
+    # A group without providers is preferred to sharing or switching providers
+    result = placement(switch_costs, providers_per_appliance=1).place(
+        ['a'], [['b']], [['t1'], ['t2']], [['b'], []])
+    assert result.index == 1
+    assert result.category == NO_PROVIDERS
+    assert result.allocation == ['a']
+    assert not result.cleanse
+
+
+def test_place_add_shared(switch_costs):
+    # Of providers other slaves have, the one with the most remaining work per slave wins
+    result = placement(switch_costs).place(
+        [], [['a'], ['b'], ['b']], [['t1', 't2'], ['t3', 't4']], [['b'], ['a']])
+    assert result.index == 1
+    assert result.category == ADD_SHARED
+    assert result.allocation == ['a']
+    assert not result.cleanse
+    assert result.cost == SwitchCostHistory.default_cost
+    # 20s of work on a, shared with 1 other slave
+    assert result.gain == 10.0 - SwitchCostHistory.default_cost
+
+
+def test_place_switch(switch_costs):
+    # A full appliance is cleansed, the provider with the most remaining work wins
+    result = placement(switch_costs, providers_per_appliance=1).place(
+        ['a'], [], [['t1'], ['t2', 't3'], ['t4']], [['b'], ['c'], ['b', 'c']])
+    assert result.index == 1
+    assert result.category == SWITCH
+    assert result.allocation == ['c']
+    assert result.cleanse
+
+
+def test_place_switch_cost(switch_costs):
+    # Cleansing and re-adding all the group's providers is paid for with measured costs
+    switch_costs.record_cleanse(30.0)
+    switch_costs.record_add('b', 10.0)
+    result = placement(switch_costs, providers_per_appliance=2).place(
+        ['a', 'b'], [], [['t1', 't2', 't3', 't4', 't5']], [['b', 'c', 'd']])
+    assert result.category == SWITCH
+    assert result.allocation == ['b', 'c', 'd']
+    assert result.cost == 30.0 + 10.0 + 2 * SwitchCostHistory.default_cost
+    # 50s of work on each provider, nobody else works on them
+    assert result.gain == 50.0 - result.cost
+
+
+def test_place_switch_prefers_cheaper_provider(switch_costs):
+    # With the same work left, the provider that is quicker to add wins
+    switch_costs.record_add('c', 10.0)
+    result = placement(switch_costs, providers_per_appliance=1).place(
+        ['a'], [], [['t1'], ['t2']], [['b'], ['c']])
+    assert result.index == 1
+    assert result.cost == SwitchCostHistory.default_cost + 10.0
+
+
+def test_switch_costs_history(fake_cache):
+    # Costs are blended with the previous ones and survive in the cache
+    costs = SwitchCostHistory(fake_cache)
+    assert costs.cleanse_cost() == SwitchCostHistory.default_cost
+    assert costs.add_cost('a') == SwitchCostHistory.default_cost
+    costs.record_cleanse(100.0)
+    costs.record_add('a', 10.0)
+    costs.record_add('a', 20.0)
+    costs.save()
+    costs = SwitchCostHistory(fake_cache)
+    assert costs.cleanse_cost() == 100.0
+    assert costs.add_cost('a') == 15.0
+    assert costs.add_cost('b') == SwitchCostHistory.default_cost
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+import numpy
+import pytest
+
+from utils.perf import PercentileSketch
+
+#: How far off an estimate may be, in percentile points
+TOLERANCE = 0.25
+PERCENTS = [1, 10, 25, 50, 75, 90, 99, 99.9]
+
+
+def distributions():
+    random = numpy.random.RandomState(0)
+    return [
+        ('uniform', random.uniform(0, 1000, 50000)),
+        ('normal', random.normal(500, 50, 50000)),
+        ('lognormal', random.lognormal(3, 1, 50000)),
+        ('steps', random.randint(0, 5, 50000).astype(float)),
+    ]
+
+
+def assert_close(sketch, data):
+    for percent in PERCENTS:
+        estimate = sketch.percentile(percent)
+        low = numpy.percentile(data, max(percent - TOLERANCE, 0))
+        high = numpy.percentile(data, min(percent + TOLERANCE, 100))
+        assert low <= estimate <= high, percent
+
+
+@pytest.mark.parametrize(('name', 'data'), distributions())
+def test_sketch_percentiles(name, data):
+    # Percentiles are estimated close to numpy's, also once the buffer was compressed
+    sketch = PercentileSketch()
+    for batch in numpy.array_split(data, 37):
+        sketch.add(batch)
+    assert len(sketch.means) <= sketch.compression
+    assert_close(sketch, data)
+
+
+@pytest.mark.parametrize(('name', 'data'), distributions())
+def test_sketch_merge(name, data):
+    # Merged sketches estimate the percentiles of everything added to them
+    sketches = []
+    for part in numpy.array_split(data, 3):
+        sketch = PercentileSketch()
+        sketch.add(part)
+        sketches.append(sketch)
+    merged = PercentileSketch()
+    for sketch in sketches:
+        merged.merge(sketch)
+    assert merged.count == len(data)
+    assert_close(merged, data)
+
+
+def test_sketch_extremes():
+    # The 0th and 100th percentile are the exact minimum and maximum
+    data = numpy.random.RandomState(0).lognormal(3, 1, 20000)
+    sketch = PercentileSketch()
+    sketch.add(data)
+    assert sketch.percentile(0) == data.min()
+    assert sketch.percentile(100) == data.max()
+
+
+def test_sketch_statistics():
+    # Everything but the percentiles is exact
+    data = numpy.random.RandomState(0).normal(500, 50, 20000)
+    sketch = PercentileSketch()
+    for value in data[:100]:
+        sketch.add(value)
+    sketch.add(data[100:])
+    count, minimum, average, median, maximum, stddev, p90, p99 = sketch.statistics(decimals=6)
+    assert count == len(data)
+    assert minimum == round(data.min(), 6)
+    assert maximum == round(data.max(), 6)
+    assert abs(average - data.mean()) < 1e-5
+    assert abs(stddev - data.std()) < 1e-5
+    assert numpy.percentile(data, 50 - TOLERANCE) <= median <= numpy.percentile(
+        data, 50 + TOLERANCE)
+
+
+def test_sketch_empty():
+    # An empty sketch gives zeroes
+    sketch = PercentileSketch()
+    sketch.add([])
+    assert sketch.count == 0
+    assert sketch.percentile(90) == 0.0
+    assert sketch.statistics() == [0, 0, 0, 0, 0, 0, 0, 0]
+
+
+def test_sketch_single_value():
+    # All percentiles of a single value are that value
+    sketch = PercentileSketch()
+    sketch.add(7.5)
+    assert [sketch.percentile(percent) for percent in [0] + PERCENTS + [100]] == [7.5] * 10
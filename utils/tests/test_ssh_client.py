@@ -1,6 +1,8 @@
 # -*- coding: utf-8 -*-
 import pytest
 
+from utils.ssh import tail_service
+
 pytestmark = [
     pytest.mark.nondestructive,
     pytest.mark.skip_selenium,
@@ -26,3 +28,65 @@ def test_scp_client_can_put_a_file(appliance, tmpdir):
     assert "content" in tmpfile.read()
     # Clean up the server
     appliance.ssh_client.run_command("rm -f /tmp/{}".format(tmpfile.basename))
+
+
+def test_ssh_client_stream_command(appliance):
+    # Make sure streamed output arrives complete, line by line
+    stream = appliance.ssh_client.stream_command('seq 1 50000')
+    assert [line.rstrip() for line in stream] == [str(i) for i in range(1, 50001)]
+    assert stream.rc == 0
+
+
+def test_ssh_client_run_command_max_output(appliance):
+    # Make sure only the tail of the output is kept
+    exit_status, output = appliance.ssh_client.run_command('seq 1 50000', max_output=12)
+    assert exit_status == 0
+    assert output.split() == ['49999', '50000']
+
+
+@pytest.mark.parametrize('fail_fast', [True, False], ids=['fail_fast', 'continue'])
+def test_ssh_client_run_batch(appliance, fail_fast):
+    # Make sure each command of a batch gets its own result
+    results = appliance.ssh_client.run_batch(
+        ['echo first', 'printf second; false', 'echo third >&2'], fail_fast=fail_fast)
+    assert [result.rc for result in results] == ([0, 1] if fail_fast else [0, 1, 0])
+    assert [result.output for result in results] == (
+        ['first\n', 'second'] if fail_fast else ['first\n', 'second', 'third\n'])
+
+
+def test_ssh_tail_service_follows_rotation(appliance):
+    # Make sure lines are collected per file, through a rotation and a truncation
+    ssh = appliance.ssh_client
+    first, second = '/tmp/test_tail_first.log', '/tmp/test_tail_second.log'
+    ssh.run_command('rm -f {0}* {1}*; touch {0} {1}'.format(first, second))
+    try:
+        first_tail, second_tail = tail_service(ssh).subscribe_many([first, second])
+        ssh.run_command('echo one >> {0}; echo two-and-more >> {1}'.format(first, second))
+        assert first_tail.wait_for('one', timeout=10) == 'one'
+        assert second_tail.wait_for('two', timeout=10) == 'two-and-more'
+        ssh.run_command('mv {0} {0}.1; echo three > {0}'.format(first))
+        assert first_tail.wait_for('three', timeout=10) == 'three'
+        # shorter than before, so tail notices the truncation
+        ssh.run_command('echo cut > {0}'.format(second))
+        assert second_tail.wait_for('cut', timeout=10) == 'cut'
+        first_tail.close()
+        second_tail.close()
+    finally:
+        ssh.run_command('rm -f {0}* {1}*'.format(first, second))
+
+
+def test_ssh_tail_get_lines_syncs(appliance):
+    # Make sure lines written right before reading are read, without writing to the file
+    ssh = appliance.ssh_client
+    filename = '/tmp/test_tail_sync.log'
+    ssh.run_command('rm -f {0}; touch {0}'.format(filename))
+    try:
+        tail = tail_service(ssh).subscribe(filename)
+        ssh.run_command('seq 1 1000 >> {}'.format(filename))
+        assert tail.get_lines() == [str(i) for i in range(1, 1001)]
+        assert tail.get_lines() == []
+        tail.close()
+        exit_status, output = ssh.run_command('cat {}'.format(filename))
+        assert output.split() == [str(i) for i in range(1, 1001)]
+    finally:
+        ssh.run_command('rm -f {}'.format(filename))